@@ -2,9 +2,14 @@ __version__ = "0.1.0"
 
 from .training.activations_store import ActivationsStore
 from .training.cache_activations_runner import cache_activations_runner
-from .training.config import CacheActivationsRunnerConfig, LanguageModelSAERunnerConfig
+from .training.config import (
+    CacheActivationsRunnerConfig,
+    LanguageModelSAERunnerConfig,
+    PretokenizeRunnerConfig,
+)
 from .training.evals import run_evals
 from .training.lm_runner import language_model_sae_runner
+from .training.pretokenize_runner import pretokenize_runner
 from .training.sae_group import SAEGroup
 from .training.session_loader import LMSparseAutoencoderSessionloader
 from .training.sparse_autoencoder import SparseAutoencoder
@@ -13,12 +18,14 @@ from .training.train_sae_on_language_model import train_sae_group_on_language_mo
 __all__ = [
     "LanguageModelSAERunnerConfig",
     "CacheActivationsRunnerConfig",
+    "PretokenizeRunnerConfig",
     "LMSparseAutoencoderSessionloader",
     "SparseAutoencoder",
     "SAEGroup",
     "run_evals",
     "language_model_sae_runner",
     "cache_activations_runner",
+    "pretokenize_runner",
     "ActivationsStore",
     "train_sae_group_on_language_model",
 ]
@@ -21,9 +21,10 @@ from sae_vis.data_config_classes import (
 )
 from sae_vis.data_fetching_fns import get_feature_data
 from torch.nn.functional import cosine_similarity
-from tqdm import tqdm
 
 import wandb
+from sae_lens.analysis.feature_batches import FeatureBatchManifest, run_feature_batches
+from sae_lens.analysis.token_samples import get_token_sample
 from sae_lens.training.session_loader import LMSparseAutoencoderSessionloader
 
 
@@ -46,6 +47,8 @@ class DashboardRunner:
         use_wandb: bool = False,
         continue_existing_dashboard: bool = True,
         final_index: Optional[int] = None,
+        n_workers: int = 1,  # worker processes generating feature batches in parallel
+        cache_tokens: bool = True,  # reuse the prompt tokens sampled by earlier runs
     ):
         """ """
 
@@ -101,6 +104,10 @@ class DashboardRunner:
         )
         self.n_batches_to_sample_from = n_batches_to_sample_from
         self.n_prompts_to_select = n_prompts_to_select
+        self.n_workers = n_workers
+        self.token_cache_dir = (
+            f"{dashboard_parent_folder}/token_samples" if cache_tokens else None
+        )
 
         # Deal with file structure
         if not os.path.exists(dashboard_parent_folder):
@@ -130,11 +137,16 @@ class DashboardRunner:
         return dashboard_folder_name
 
     def init_sae_session(self):
+        # the store only streams prompt tokens here, so it doesn't need to fill an
+        # activation buffer. That matters most in worker processes, which each load
+        # their own session.
         (
             self.model,
             sae_group,
             self.activation_store,
-        ) = LMSparseAutoencoderSessionloader.load_session_from_pretrained(self.sae_path)
+        ) = LMSparseAutoencoderSessionloader.load_session_from_pretrained(
+            self.sae_path, create_dataloader=False
+        )
         # TODO: handle multiple autoencoders
         self.sparse_autoencoder = sae_group.autoencoders[0]
 
@@ -144,19 +156,13 @@ class DashboardRunner:
         """
         Get the tokens needed for dashboard generation.
         """
-
-        all_tokens_list = []
-        pbar = tqdm(range(n_batches_to_sample_from))
-        for _ in pbar:
-            batch_tokens = self.activation_store.get_batch_tokens()
-            batch_tokens = batch_tokens[torch.randperm(batch_tokens.shape[0])][
-                : batch_tokens.shape[0]
-            ]
-            all_tokens_list.append(batch_tokens)
-
-        all_tokens = torch.cat(all_tokens_list, dim=0)
-        all_tokens = all_tokens[torch.randperm(all_tokens.shape[0])]
-        return all_tokens[:n_prompts_to_select]
+        return get_token_sample(
+            self.activation_store,
+            self.sparse_autoencoder.cfg,
+            n_batches_to_sample_from,
+            n_prompts_to_select,
+            cache_dir=self.token_cache_dir,
+        )
 
     def get_index_to_resume_from(self):
         i = 0
@@ -293,7 +299,14 @@ class DashboardRunner:
             wandb.log({"plots/scatter_matrix": wandb.Html(plotly.io.to_html(fig))})
 
         self.n_features = self.sparse_autoencoder.cfg.d_sae
-        id_to_start_from = self.get_index_to_resume_from()
+        # the manifest knows exactly which batches are done, only dashboards from before
+        # it existed have to be resumed from their files
+        manifest = FeatureBatchManifest(
+            self.dashboard_folder, self.n_features_at_a_time
+        )
+        id_to_start_from = (
+            0 if manifest.completed_batches else self.get_index_to_resume_from()
+        )
         id_to_end_at = self.n_features if self.final_index is None else self.final_index
         assert id_to_end_at is not None  # keep pyright happy
 
@@ -321,71 +334,35 @@ class DashboardRunner:
             v: k.replace("Ġ", " ").replace("\n", "\\n") for k, v in vocab_dict.items()
         }
 
-        with torch.no_grad():
-            for interesting_features in tqdm(feature_idx):
-                print(interesting_features)
-
-                layout = SaeVisLayoutConfig(
-                    columns=[
-                        Column(
-                            SequencesConfig(
-                                stack_mode="stack-all",
-                                buffer=(self.buffer_tokens, self.buffer_tokens),
-                                compute_buffer=False,
-                                n_quantiles=10,
-                                top_acts_group_size=20,
-                                quantile_group_size=5,
-                            ),
-                            width=650,
-                        ),
-                        Column(
-                            ActsHistogramConfig(),
-                            FeatureTablesConfig(n_rows=5),
-                            width=500,
-                        ),
-                    ],
-                    height=1000,
-                )
-                feature_vis_params = SaeVisConfig(
-                    hook_point=self.sparse_autoencoder.cfg.hook_point,
-                    minibatch_size_features=256,
-                    minibatch_size_tokens=64,
-                    features=interesting_features,
-                    verbose=True,
-                    feature_centric_layout=layout,
-                )
-
-                feature_data = get_feature_data(
-                    encoder=self.sparse_autoencoder,  # type: ignore
-                    model=self.model,
-                    tokens=tokens,
-                    cfg=feature_vis_params,
-                )
-
-                for i, test_idx in enumerate(feature_data.feature_data_dict.keys()):
-                    feature_data.save_feature_centric_vis(
-                        f"{self.dashboard_folder}/data_{test_idx:04}.html",
-                        feature_idx=test_idx,
-                    )
+        def upload_to_wandb(batch_id: int, feature_ids: list[int]):
+            if not self.use_wandb:
+                return
+            for test_idx in feature_ids[:10]:
+                # upload the html as an artifact
+                artifact = wandb.Artifact(f"feature_{test_idx}", type="feature")
+                artifact.add_file(f"{self.dashboard_folder}/data_{test_idx:04}.html")
+                assert run is not None  # keep pyright happy
+                run.log_artifact(artifact)
 
-                    if i < 10 and self.use_wandb:
-                        # upload the html as an artifact
-                        artifact = wandb.Artifact(f"feature_{test_idx}", type="feature")
-                        artifact.add_file(
+                # also upload as html to dashboard
+                wandb.log(
+                    {
+                        "features/feature_dashboard": wandb.Html(
                             f"{self.dashboard_folder}/data_{test_idx:04}.html"
                         )
-                        assert run is not None  # keep pyright happy
-                        run.log_artifact(artifact)
-
-                        # also upload as html to dashboard
-                        wandb.log(
-                            {
-                                "features/feature_dashboard": wandb.Html(
-                                    f"{self.dashboard_folder}/data_{test_idx:04}.html"
-                                )
-                            },
-                            step=test_idx,
-                        )
+                    },
+                    step=test_idx,
+                )
+
+        # batches are identified by their first feature
+        run_feature_batches(
+            self,
+            {features[0]: features for features in feature_idx},
+            tokens,
+            manifest,
+            n_workers=self.n_workers,
+            on_batch_done=upload_to_wandb,
+        )
 
         if self.use_wandb:
             # when done zip the folder
@@ -404,3 +381,58 @@ class DashboardRunner:
             shutil.rmtree(self.dashboard_folder)
 
         return
+
+    @torch.no_grad()
+    def process_feature_batch(
+        self, batch_id: int, features: list[int], tokens: torch.Tensor
+    ) -> list[int]:
+        """
+        Generate and save the dashboards of one batch of features, returning the
+        features saved.
+        """
+        print(features)
+
+        layout = SaeVisLayoutConfig(
+            columns=[
+                Column(
+                    SequencesConfig(
+                        stack_mode="stack-all",
+                        buffer=(self.buffer_tokens, self.buffer_tokens),
+                        compute_buffer=False,
+                        n_quantiles=10,
+                        top_acts_group_size=20,
+                        quantile_group_size=5,
+                    ),
+                    width=650,
+                ),
+                Column(
+                    ActsHistogramConfig(),
+                    FeatureTablesConfig(n_rows=5),
+                    width=500,
+                ),
+            ],
+            height=1000,
+        )
+        feature_vis_params = SaeVisConfig(
+            hook_point=self.sparse_autoencoder.cfg.hook_point,
+            minibatch_size_features=256,
+            minibatch_size_tokens=64,
+            features=features,
+            verbose=True,
+            feature_centric_layout=layout,
+        )
+
+        feature_data = get_feature_data(
+            encoder=self.sparse_autoencoder,  # type: ignore
+            model=self.model,
+            tokens=tokens,
+            cfg=feature_vis_params,
+        )
+
+        feature_ids = list(feature_data.feature_data_dict.keys())
+        for test_idx in feature_ids:
+            feature_data.save_feature_centric_vis(
+                f"{self.dashboard_folder}/data_{test_idx:04}.html",
+                feature_idx=test_idx,
+            )
+        return feature_ids
@@ -0,0 +1,151 @@
+"""
+Runs the feature batches of a dashboard / Neuronpedia export, optionally across worker
+processes, and records the finished ones in a manifest so that an interrupted export
+picks up exactly where it stopped.
+"""
+
+import json
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Optional, Protocol
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+MANIFEST_FILENAME = "manifest.json"
+TOKENS_FILENAME = "tokens.npy"
+
+# the attributes a worker loads for itself with init_sae_session, rather than having
+# them pickled over from the parent
+_SESSION_ATTRIBUTES = ("model", "activation_store", "sparse_autoencoder")
+
+
+class FeatureBatchRunner(Protocol):
+    def init_sae_session(self) -> None: ...
+
+    def process_feature_batch(
+        self, batch_id: int, features: list[int], tokens: torch.Tensor
+    ) -> Any: ...
+
+
+class FeatureBatchManifest:
+    """
+    The ids of the feature batches that are done, in a json file next to the outputs.
+    Every update writes a new file and renames it over the old one, so the manifest is
+    never half written, and a batch is only recorded once all its outputs are.
+    """
+
+    def __init__(self, folder: str, n_features_at_a_time: int):
+        self.path = os.path.join(folder, MANIFEST_FILENAME)
+        self.n_features_at_a_time = n_features_at_a_time
+        self.completed_batches: set[int] = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest["n_features_at_a_time"] != n_features_at_a_time:
+                raise ValueError(
+                    f"{self.path} was written with n_features_at_a_time="
+                    f"{manifest['n_features_at_a_time']}, but this run has "
+                    f"{n_features_at_a_time}, so its batches don't line up"
+                )
+            self.completed_batches = set(manifest["completed_batches"])
+
+    def __contains__(self, batch_id: int) -> bool:
+        return batch_id in self.completed_batches
+
+    def mark_completed(self, batch_id: int):
+        self.completed_batches.add(batch_id)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "n_features_at_a_time": self.n_features_at_a_time,
+                    "completed_batches": sorted(self.completed_batches),
+                },
+                f,
+            )
+        os.replace(self.path + ".tmp", self.path)
+
+
+def run_feature_batches(
+    runner: FeatureBatchRunner,
+    feature_batches: dict[int, list[int]],
+    tokens: torch.Tensor,
+    manifest: FeatureBatchManifest,
+    n_workers: int = 1,
+    on_batch_done: Optional[Callable[[int, Any], None]] = None,
+):
+    """
+    Calls runner.process_feature_batch for every batch not already in the manifest, and
+    on_batch_done (in this process) with each batch's result as it finishes.
+
+    With n_workers > 1 the batches are spread over that many worker processes. Each
+    loads its own model and SAE with runner.init_sae_session, and they all share the
+    tokens read-only through a memory-mapped file rather than each getting a copy.
+    """
+    todo = {
+        batch_id: features
+        for batch_id, features in feature_batches.items()
+        if batch_id not in manifest
+    }
+    if len(todo) < len(feature_batches):
+        print(f"Skipping {len(feature_batches) - len(todo)} completed batches")
+
+    def batch_done(batch_id: int, result: Any):
+        manifest.mark_completed(batch_id)
+        if on_batch_done is not None:
+            on_batch_done(batch_id, result)
+
+    if n_workers <= 1:
+        for batch_id, features in tqdm(todo.items()):
+            batch_done(
+                batch_id, runner.process_feature_batch(batch_id, features, tokens)
+            )
+        return
+
+    tokens_path = os.path.join(os.path.dirname(manifest.path), TOKENS_FILENAME)
+    np.save(tokens_path, tokens.cpu().numpy())
+    runner_state = {
+        k: v for k, v in runner.__dict__.items() if k not in _SESSION_ATTRIBUTES
+    }
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            # forking a process that has used CUDA (or many threads) isn't safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(type(runner), runner_state, tokens_path),
+        ) as executor:
+            futures = {
+                executor.submit(_process_feature_batch, batch_id, features): batch_id
+                for batch_id, features in todo.items()
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                batch_done(futures[future], future.result())
+    finally:
+        os.remove(tokens_path)
+
+
+# each worker process's runner and tokens, set up once by _init_worker
+_worker_runner: Any = None
+_worker_tokens: Optional[torch.Tensor] = None
+
+
+def _init_worker(
+    runner_cls: type, runner_state: dict[str, Any], tokens_path: str
+) -> None:
+    global _worker_runner, _worker_tokens
+    _worker_runner = object.__new__(runner_cls)
+    _worker_runner.__dict__.update(runner_state)
+    _worker_runner.init_sae_session()
+    with warnings.catch_warnings():
+        # the tokens are only ever read, so a read-only mapping is fine
+        warnings.simplefilter("ignore", UserWarning)
+        _worker_tokens = torch.from_numpy(np.load(tokens_path, mmap_mode="r"))
+
+
+def _process_feature_batch(batch_id: int, features: list[int]) -> Any:
+    assert _worker_tokens is not None  # keep pyright happy
+    return _worker_runner.process_feature_batch(batch_id, features, _worker_tokens)
@@ -1,10 +1,11 @@
 import os
-from typing import Any, Dict, List, Optional, Union, cast
+from typing import Any, Optional, cast
 
 # set TOKENIZERS_PARALLELISM to false to avoid warnings
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 import json
 import time
+from itertools import accumulate, chain
 
 import numpy as np
 import torch
@@ -18,8 +19,9 @@ from sae_vis.data_config_classes import (
     SequencesConfig,
 )
 from sae_vis.data_fetching_fns import get_feature_data
-from tqdm import tqdm
 
+from sae_lens.analysis.feature_batches import FeatureBatchManifest, run_feature_batches
+from sae_lens.analysis.token_samples import get_token_sample
 from sae_lens.training.session_loader import LMSparseAutoencoderSessionloader
 
 OUT_OF_RANGE_TOKEN = "<|outofrange|>"
@@ -58,6 +60,8 @@ class NeuronpediaRunner:
         # start and end batch
         start_batch_inclusive: int = 0,
         end_batch_inclusive: Optional[int] = None,
+        n_workers: int = 1,  # worker processes generating feature batches in parallel
+        cache_tokens: bool = True,  # reuse the prompt tokens sampled by earlier runs
     ):
         self.sae_path = sae_path
         if init_session:
@@ -71,6 +75,10 @@ class NeuronpediaRunner:
         self.n_prompts_to_select = n_prompts_to_select
         self.start_batch = start_batch_inclusive
         self.end_batch = end_batch_inclusive
+        self.n_workers = n_workers
+        self.token_cache_dir = (
+            f"{neuronpedia_parent_folder}/token_samples" if cache_tokens else None
+        )
 
         # Deal with file structure
         if not os.path.exists(neuronpedia_parent_folder):
@@ -90,58 +98,49 @@ class NeuronpediaRunner:
         return dashboard_folder_name
 
     def init_sae_session(self):
+        # the store only streams prompt tokens here, so it doesn't need to fill an
+        # activation buffer. That matters most in worker processes, which each load
+        # their own session.
         (
             self.model,
             sae_group,
             self.activation_store,
-        ) = LMSparseAutoencoderSessionloader.load_session_from_pretrained(self.sae_path)
+        ) = LMSparseAutoencoderSessionloader.load_session_from_pretrained(
+            self.sae_path, create_dataloader=False
+        )
         # TODO: handle multiple autoencoders
         self.sparse_autoencoder = sae_group.autoencoders[0]
 
     def get_tokens(
         self, n_batches_to_sample_from: int = 2**12, n_prompts_to_select: int = 4096 * 6
     ):
-        all_tokens_list = []
-        pbar = tqdm(range(n_batches_to_sample_from))
-        for _ in pbar:
-            batch_tokens = self.activation_store.get_batch_tokens()
-            batch_tokens = batch_tokens[torch.randperm(batch_tokens.shape[0])][
-                : batch_tokens.shape[0]
-            ]
-            all_tokens_list.append(batch_tokens)
-
-        all_tokens = torch.cat(all_tokens_list, dim=0)
-        all_tokens = all_tokens[torch.randperm(all_tokens.shape[0])]
-        return all_tokens[:n_prompts_to_select]
+        return get_token_sample(
+            self.activation_store,
+            self.sparse_autoencoder.cfg,
+            n_batches_to_sample_from,
+            n_prompts_to_select,
+            cache_dir=self.token_cache_dir,
+        )
 
-    def round_list(self, to_round: list[float]):
-        return list(np.round(to_round, 3))
+    def round_list(self, to_round: Any) -> list[float]:
+        # tolist converts the whole array at once, to plain floats the json encoder
+        # doesn't have to handle one by one
+        return np.round(to_round, 3).tolist()
 
-    def to_str_tokens_safe(
-        self, vocab_dict: Dict[int, str], tokens: Union[int, List[int], torch.Tensor]
-    ):
+    def to_str_tokens_vectorized(
+        self, vocab_strs: np.ndarray[Any, Any], tokens: Any
+    ) -> Any:
         """
-        does to_str_tokens, except handles out of range
+        The string of every token in a (possibly nested) array of tokens, or
+        OUT_OF_RANGE_TOKEN for those past the end of the vocab. The vocab is an array
+        of strings, so this is a single indexing operation rather than a lookup per
+        token.
         """
-        vocab_max_index = self.model.cfg.d_vocab - 1
-        # Deal with the int case separately
-        if isinstance(tokens, int):
-            if tokens > vocab_max_index:
-                return OUT_OF_RANGE_TOKEN
-            return vocab_dict[tokens]
-
-        # If the tokens are a (possibly nested) list, turn them into a tensor
-        if isinstance(tokens, list):
-            tokens = torch.tensor(tokens)
-
-        # Get flattened list of tokens
-        str_tokens = [
-            (vocab_dict[t] if t <= vocab_max_index else OUT_OF_RANGE_TOKEN)
-            for t in tokens.flatten().tolist()
-        ]
-
-        # Reshape
-        return np.reshape(str_tokens, tokens.shape).tolist()
+        tokens = np.asarray(tokens, dtype=np.int64)
+        in_range = tokens < len(vocab_strs)
+        str_tokens = vocab_strs[np.where(in_range, tokens, 0)]
+        str_tokens[~in_range] = OUT_OF_RANGE_TOKEN
+        return str_tokens.tolist()
 
     def run(self):
         """
@@ -213,231 +212,279 @@ class NeuronpediaRunner:
         # pad with blank tokens to the actual vocab size
         for i in range(len(vocab_dict), self.model.cfg.d_vocab):
             vocab_dict[i] = OUT_OF_RANGE_TOKEN
+        # the same, as an array we can index with whole arrays of tokens
+        self.vocab_strs = np.array(
+            [vocab_dict[i] for i in range(self.model.cfg.d_vocab)], dtype=object
+        )
 
-        with torch.no_grad():
-            feature_batch_count = 0
-            for features_to_process in tqdm(feature_idx):
-                feature_batch_count = feature_batch_count + 1
-
-                if feature_batch_count < self.start_batch:
-                    # print(f"Skipping batch - it's after start_batch: {feature_batch_count}")
-                    continue
-                if self.end_batch is not None and feature_batch_count > self.end_batch:
-                    # print(f"Skipping batch - it's after end_batch: {feature_batch_count}")
-                    continue
-
-                print(f"Doing batch: {feature_batch_count}")
-
-                layout = SaeVisLayoutConfig(
-                    columns=[
-                        Column(
-                            SequencesConfig(
-                                stack_mode="stack-all",
-                                buffer=(
-                                    self.buffer_tokens_left,
-                                    self.buffer_tokens_right,
-                                ),
-                                compute_buffer=False,
-                                n_quantiles=10,
-                                top_acts_group_size=20,
-                                quantile_group_size=5,
-                            ),
-                            width=650,
-                        ),
-                        Column(
-                            ActsHistogramConfig(),
-                            FeatureTablesConfig(n_rows=5),
-                            width=500,
+        # batches are numbered from 1
+        feature_batches = {
+            batch_id: features
+            for batch_id, features in enumerate(feature_idx, start=1)
+            if batch_id >= self.start_batch
+            and (self.end_batch is None or batch_id <= self.end_batch)
+        }
+        run_feature_batches(
+            self,
+            feature_batches,
+            tokens,
+            FeatureBatchManifest(self.neuronpedia_folder, self.n_features_at_a_time),
+            n_workers=self.n_workers,
+        )
+
+        return
+
+    @torch.no_grad()
+    def process_feature_batch(
+        self, batch_id: int, features: list[int], tokens: torch.Tensor
+    ):
+        """
+        Generate the Neuronpedia outputs of one batch of features.
+        """
+        print(f"Doing batch: {batch_id}")
+
+        layout = SaeVisLayoutConfig(
+            columns=[
+                Column(
+                    SequencesConfig(
+                        stack_mode="stack-all",
+                        buffer=(
+                            self.buffer_tokens_left,
+                            self.buffer_tokens_right,
                         ),
-                    ],
-                    height=1000,
+                        compute_buffer=False,
+                        n_quantiles=10,
+                        top_acts_group_size=20,
+                        quantile_group_size=5,
+                    ),
+                    width=650,
+                ),
+                Column(
+                    ActsHistogramConfig(),
+                    FeatureTablesConfig(n_rows=5),
+                    width=500,
+                ),
+            ],
+            height=1000,
+        )
+        feature_vis_params = SaeVisConfig(
+            hook_point=self.sparse_autoencoder.cfg.hook_point,
+            minibatch_size_features=256,
+            minibatch_size_tokens=64,
+            features=features,
+            verbose=False,
+            feature_centric_layout=layout,
+        )
+
+        feature_data = get_feature_data(
+            encoder=self.sparse_autoencoder,  # type: ignore
+            model=self.model,
+            tokens=tokens,
+            cfg=feature_vis_params,
+        )
+
+        features_outputs = []
+        for _, feat_index in enumerate(feature_data.feature_data_dict.keys()):
+            feature = feature_data.feature_data_dict[feat_index]
+
+            feature_output = {}
+            feature_output["featureIndex"] = feat_index
+
+            top10_logits = self.round_list(feature.logits_table_data.top_logits)
+            bottom10_logits = self.round_list(feature.logits_table_data.bottom_logits)
+
+            # TODO: don't precompute/store these. should do it on the frontend
+            max_value = max(
+                np.absolute(bottom10_logits).max(),
+                np.absolute(top10_logits).max(),
+            )
+            neg_bg_values = self.round_list(np.absolute(bottom10_logits) / max_value)
+            pos_bg_values = self.round_list(np.absolute(top10_logits) / max_value)
+            feature_output["neg_bg_values"] = neg_bg_values
+            feature_output["pos_bg_values"] = pos_bg_values
+
+            if feature.feature_tables_data:
+                feature_output["neuron_alignment_indices"] = (
+                    feature.feature_tables_data.neuron_alignment_indices
+                )
+                feature_output["neuron_alignment_values"] = self.round_list(
+                    feature.feature_tables_data.neuron_alignment_values
+                )
+                feature_output["neuron_alignment_l1"] = self.round_list(
+                    feature.feature_tables_data.neuron_alignment_l1
+                )
+                feature_output["correlated_neurons_indices"] = (
+                    feature.feature_tables_data.correlated_neurons_indices
                 )
-                feature_vis_params = SaeVisConfig(
-                    hook_point=self.sparse_autoencoder.cfg.hook_point,
-                    minibatch_size_features=256,
-                    minibatch_size_tokens=64,
-                    features=features_to_process,
-                    verbose=False,
-                    feature_centric_layout=layout,
+                # TODO: this value doesn't exist in the new output type, commenting out for now
+                # there is a cossim value though - is that what's needed?
+                # feature_output["correlated_neurons_l1"] = self.round_list(
+                #     feature.feature_tables_data.correlated_neurons_l1
+                # )
+                feature_output["correlated_neurons_pearson"] = self.round_list(
+                    feature.feature_tables_data.correlated_neurons_pearson
                 )
+                # feature_output["correlated_features_indices"] = (
+                #     feature.feature_tables_data.correlated_features_indices
+                # )
+                # feature_output["correlated_features_l1"] = self.round_list(
+                #     feature.feature_tables_data.correlated_features_l1
+                # )
+                # feature_output["correlated_features_pearson"] = self.round_list(
+                #     feature.feature_tables_data.correlated_features_pearson
+                # )
+
+            feature_output["neg_str"] = self.to_str_tokens_vectorized(
+                self.vocab_strs, feature.logits_table_data.bottom_token_ids
+            )
+            feature_output["neg_values"] = bottom10_logits
+            feature_output["pos_str"] = self.to_str_tokens_vectorized(
+                self.vocab_strs, feature.logits_table_data.top_token_ids
+            )
+            feature_output["pos_values"] = top10_logits
+
+            # TODO: don't know what this should be in the new version
+            # feature_output["frac_nonzero"] = (
+            #     feature.middle_plots_data.frac_nonzero
+            # )
+
+            freq_hist_data = feature.acts_histogram_data
+            freq_bar_values = self.round_list(freq_hist_data.bar_values)
+            feature_output["freq_hist_data_bar_values"] = freq_bar_values
+            feature_output["freq_hist_data_tick_vals"] = self.round_list(
+                freq_hist_data.tick_vals
+            )
+
+            # TODO: don't precompute/store these. should do it on the frontend
+            freq_bar_values_clipped = (
+                0.4 * max(freq_bar_values) + 0.6 * np.array(freq_bar_values)
+            ) / max(freq_bar_values)
+            freq_bar_colors = [
+                colors.rgb2hex(rgba) for rgba in BG_COLOR_MAP(freq_bar_values_clipped)
+            ]
+            feature_output["freq_hist_data_bar_heights"] = self.round_list(
+                freq_hist_data.bar_heights
+            )
+            feature_output["freq_bar_colors"] = freq_bar_colors
+
+            logits_hist_data = feature.logits_histogram_data
+            feature_output["logits_hist_data_bar_heights"] = self.round_list(
+                logits_hist_data.bar_heights
+            )
+            feature_output["logits_hist_data_bar_values"] = self.round_list(
+                logits_hist_data.bar_values
+            )
+            feature_output["logits_hist_data_tick_vals"] = self.round_list(
+                logits_hist_data.tick_vals
+            )
+
+            # TODO: check this
+            feature_output["num_tokens_for_dashboard"] = self.n_prompts_to_select
+
+            sds = [
+                sd
+                for sgd in feature.sequence_data.seq_group_data
+                for sd in sgd.seq_data
+                if (
+                    sd.top_token_ids is not None
+                    and sd.bottom_token_ids is not None
+                    and sd.top_logits is not None
+                    and sd.bottom_logits is not None
+                )
+            ]
+            # every token of every sequence is rendered and rounded at once,
+            # then split back up by sequence and position
+            seq_lengths = [len(sd.token_ids) for sd in sds]
+            seq_strs = _unflatten(
+                self.to_str_tokens_vectorized(
+                    self.vocab_strs,
+                    list(chain.from_iterable(sd.token_ids for sd in sds)),
+                ),
+                seq_lengths,
+            )
+            seq_pos_contribs = _unflatten(
+                self._logit_contributions(
+                    self.vocab_strs,
+                    [sd.top_token_ids for sd in sds],  # type: ignore
+                    [sd.top_logits for sd in sds],  # type: ignore
+                    seq_lengths,
+                ),
+                seq_lengths,
+            )
+            seq_neg_contribs = _unflatten(
+                self._logit_contributions(
+                    self.vocab_strs,
+                    [sd.bottom_token_ids for sd in sds],  # type: ignore
+                    [sd.bottom_logits for sd in sds],  # type: ignore
+                    seq_lengths,
+                ),
+                seq_lengths,
+            )
 
-                feature_data = get_feature_data(
-                    encoder=self.sparse_autoencoder,  # type: ignore
-                    model=self.model,
-                    tokens=tokens,
-                    cfg=feature_vis_params,
+            activations = []
+            for sd, strs, posContribs, negContribs in zip(
+                sds, seq_strs, seq_pos_contribs, seq_neg_contribs
+            ):
+                activation = {}
+                activation["logitContributions"] = json.dumps(
+                    {"pos": posContribs, "neg": negContribs}
                 )
+                activation["tokens"] = strs
+                activation["values"] = self.round_list(sd.feat_acts)
+                activation["maxValue"] = max(activation["values"])
+                activation["lossValues"] = self.round_list(sd.loss_contribution)
 
-                features_outputs = []
-                for _, feat_index in enumerate(feature_data.feature_data_dict.keys()):
-                    feature = feature_data.feature_data_dict[feat_index]
-
-                    feature_output = {}
-                    feature_output["featureIndex"] = feat_index
-
-                    top10_logits = self.round_list(feature.logits_table_data.top_logits)
-                    bottom10_logits = self.round_list(
-                        feature.logits_table_data.bottom_logits
-                    )
-
-                    # TODO: don't precompute/store these. should do it on the frontend
-                    max_value = max(
-                        np.absolute(bottom10_logits).max(),
-                        np.absolute(top10_logits).max(),
-                    )
-                    neg_bg_values = self.round_list(
-                        np.absolute(bottom10_logits) / max_value
-                    )
-                    pos_bg_values = self.round_list(
-                        np.absolute(top10_logits) / max_value
-                    )
-                    feature_output["neg_bg_values"] = neg_bg_values
-                    feature_output["pos_bg_values"] = pos_bg_values
-
-                    if feature.feature_tables_data:
-                        feature_output["neuron_alignment_indices"] = (
-                            feature.feature_tables_data.neuron_alignment_indices
-                        )
-                        feature_output["neuron_alignment_values"] = self.round_list(
-                            feature.feature_tables_data.neuron_alignment_values
-                        )
-                        feature_output["neuron_alignment_l1"] = self.round_list(
-                            feature.feature_tables_data.neuron_alignment_l1
-                        )
-                        feature_output["correlated_neurons_indices"] = (
-                            feature.feature_tables_data.correlated_neurons_indices
-                        )
-                        # TODO: this value doesn't exist in the new output type, commenting out for now
-                        # there is a cossim value though - is that what's needed?
-                        # feature_output["correlated_neurons_l1"] = self.round_list(
-                        #     feature.feature_tables_data.correlated_neurons_l1
-                        # )
-                        feature_output["correlated_neurons_pearson"] = self.round_list(
-                            feature.feature_tables_data.correlated_neurons_pearson
-                        )
-                        # feature_output["correlated_features_indices"] = (
-                        #     feature.feature_tables_data.correlated_features_indices
-                        # )
-                        # feature_output["correlated_features_l1"] = self.round_list(
-                        #     feature.feature_tables_data.correlated_features_l1
-                        # )
-                        # feature_output["correlated_features_pearson"] = self.round_list(
-                        #     feature.feature_tables_data.correlated_features_pearson
-                        # )
-
-                    feature_output["neg_str"] = self.to_str_tokens_safe(
-                        vocab_dict, feature.logits_table_data.bottom_token_ids
-                    )
-                    feature_output["neg_values"] = bottom10_logits
-                    feature_output["pos_str"] = self.to_str_tokens_safe(
-                        vocab_dict, feature.logits_table_data.top_token_ids
-                    )
-                    feature_output["pos_values"] = top10_logits
-
-                    # TODO: don't know what this should be in the new version
-                    # feature_output["frac_nonzero"] = (
-                    #     feature.middle_plots_data.frac_nonzero
-                    # )
-
-                    freq_hist_data = feature.acts_histogram_data
-                    freq_bar_values = self.round_list(freq_hist_data.bar_values)
-                    feature_output["freq_hist_data_bar_values"] = freq_bar_values
-                    feature_output["freq_hist_data_tick_vals"] = self.round_list(
-                        freq_hist_data.tick_vals
-                    )
-
-                    # TODO: don't precompute/store these. should do it on the frontend
-                    freq_bar_values_clipped = [
-                        (0.4 * max(freq_bar_values) + 0.6 * v) / max(freq_bar_values)
-                        for v in freq_bar_values
-                    ]
-                    freq_bar_colors = [
-                        colors.rgb2hex(BG_COLOR_MAP(v)) for v in freq_bar_values_clipped
-                    ]
-                    feature_output["freq_hist_data_bar_heights"] = self.round_list(
-                        freq_hist_data.bar_heights
-                    )
-                    feature_output["freq_bar_colors"] = freq_bar_colors
-
-                    logits_hist_data = feature.logits_histogram_data
-                    feature_output["logits_hist_data_bar_heights"] = self.round_list(
-                        logits_hist_data.bar_heights
-                    )
-                    feature_output["logits_hist_data_bar_values"] = self.round_list(
-                        logits_hist_data.bar_values
-                    )
-                    feature_output["logits_hist_data_tick_vals"] = self.round_list(
-                        logits_hist_data.tick_vals
-                    )
-
-                    # TODO: check this
-                    feature_output["num_tokens_for_dashboard"] = (
-                        self.n_prompts_to_select
-                    )
-
-                    activations = []
-                    sdbs = feature.sequence_data
-                    for sgd in sdbs.seq_group_data:
-                        for sd in sgd.seq_data:
-                            if (
-                                sd.top_token_ids is not None
-                                and sd.bottom_token_ids is not None
-                                and sd.top_logits is not None
-                                and sd.bottom_logits is not None
-                            ):
-                                activation = {}
-                                strs = []
-                                posContribs = []
-                                negContribs = []
-                                for i in range(len(sd.token_ids)):
-                                    strs.append(
-                                        self.to_str_tokens_safe(
-                                            vocab_dict, sd.token_ids[i]
-                                        )
-                                    )
-                                    posContrib = {}
-                                    posTokens = [
-                                        self.to_str_tokens_safe(vocab_dict, j)
-                                        for j in sd.top_token_ids[i]
-                                    ]
-                                    if len(posTokens) > 0:
-                                        posContrib["t"] = posTokens
-                                        posContrib["v"] = self.round_list(
-                                            sd.top_logits[i]
-                                        )
-                                    posContribs.append(posContrib)
-                                    negContrib = {}
-                                    negTokens = [
-                                        self.to_str_tokens_safe(vocab_dict, j)  # type: ignore
-                                        for j in sd.bottom_token_ids[i]
-                                    ]
-                                    if len(negTokens) > 0:
-                                        negContrib["t"] = negTokens
-                                        negContrib["v"] = self.round_list(
-                                            sd.bottom_logits[i]
-                                        )
-                                    negContribs.append(negContrib)
-
-                                activation["logitContributions"] = json.dumps(
-                                    {"pos": posContribs, "neg": negContribs}
-                                )
-                                activation["tokens"] = strs
-                                activation["values"] = self.round_list(sd.feat_acts)
-                                activation["maxValue"] = max(activation["values"])
-                                activation["lossValues"] = self.round_list(
-                                    sd.loss_contribution
-                                )
-
-                                activations.append(activation)
-                    feature_output["activations"] = activations
-
-                    features_outputs.append(feature_output)
-
-                json_object = json.dumps(features_outputs, cls=NpEncoder)
-
-                with open(
-                    f"{self.neuronpedia_folder}/batch-{feature_batch_count}.json", "w"
-                ) as f:
-                    f.write(json_object)
+                activations.append(activation)
+            feature_output["activations"] = activations
 
-        return
+            features_outputs.append(feature_output)
+
+        json_object = json.dumps(features_outputs, cls=NpEncoder)
+
+        with open(f"{self.neuronpedia_folder}/batch-{batch_id}.json", "w") as f:
+            f.write(json_object)
+
+    def _logit_contributions(
+        self,
+        vocab_strs: np.ndarray[Any, Any],
+        token_ids: list[list[list[int]]],
+        logits: list[list[list[float]]],
+        seq_lengths: list[int],
+    ) -> list[dict[str, Any]]:
+        """
+        The logit contributions ({"t": tokens, "v": rounded logits}, or {} if there are
+        none) at the first seq_length positions of each sequence, one after the other.
+        """
+        position_token_ids = [
+            ids for seq_ids, n in zip(token_ids, seq_lengths) for ids in seq_ids[:n]
+        ]
+        position_logits = [
+            values
+            for seq_logits, n in zip(logits, seq_lengths)
+            for values in seq_logits[:n]
+        ]
+        position_lengths = [len(ids) for ids in position_token_ids]
+        position_strs = _unflatten(
+            self.to_str_tokens_vectorized(
+                vocab_strs, list(chain.from_iterable(position_token_ids))
+            ),
+            position_lengths,
+        )
+        position_values = _unflatten(
+            self.round_list(
+                np.fromiter(chain.from_iterable(position_logits), dtype=np.float64)
+            ),
+            position_lengths,
+        )
+        return [
+            {"t": strs, "v": values} if len(strs) > 0 else {}
+            for strs, values in zip(position_strs, position_values)
+        ]
+
+
+def _unflatten(flat: list[Any], lengths: list[int]) -> list[list[Any]]:
+    """
+    Split flat into consecutive lists of the given lengths.
+    """
+    ends = list(accumulate(lengths))
+    return [flat[end - length : end] for end, length in zip(ends, lengths)]
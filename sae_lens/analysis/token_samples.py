@@ -0,0 +1,85 @@
+"""
+The prompt tokens dashboards are generated from, sampled from the SAE's dataset and
+cached on disk so that later runs over the same dataset and model skip the streaming.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from sae_lens.training.activations_store import ActivationsStore
+from sae_lens.training.config import LanguageModelSAERunnerConfig
+
+
+def get_token_sample(
+    activation_store: ActivationsStore,
+    cfg: LanguageModelSAERunnerConfig,
+    n_batches_to_sample_from: int = 2**12,
+    n_prompts_to_select: int = 4096 * 6,
+    cache_dir: Optional[str] = None,
+) -> torch.Tensor:
+    """
+    n_prompts_to_select prompts, shuffled, from the first n_batches_to_sample_from
+    batches of the activation store, seeded by cfg.seed.
+
+    With a cache_dir, the sample is saved there as a .npy keyed by everything it depends
+    on (dataset, tokenizer, context size, seed and sample size) and later calls load it
+    instead of streaming the dataset again. Either way the tokens are a fresh tensor on
+    the activation store's device.
+    """
+    key = {
+        "dataset_path": cfg.dataset_path,
+        "model_name": cfg.model_name,
+        "context_size": cfg.context_size,
+        "prepend_bos": cfg.prepend_bos,
+        "store_batch_size": cfg.store_batch_size,
+        "seed": cfg.seed,
+        "n_batches_to_sample_from": n_batches_to_sample_from,
+        "n_prompts_to_select": n_prompts_to_select,
+    }
+    if cache_dir is None:
+        return _sample_tokens(activation_store, key)
+
+    key_str = json.dumps(key, sort_keys=True)
+    path = os.path.join(
+        cache_dir, f"{hashlib.sha256(key_str.encode()).hexdigest()[:16]}.npy"
+    )
+    if os.path.exists(path):
+        print(f"Loading cached tokens from {path}")
+        return torch.from_numpy(np.load(path)).to(activation_store.device)
+
+    tokens = _sample_tokens(activation_store, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, so an interrupted run never leaves a truncated sample
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, tokens.cpu().numpy())
+    os.replace(path + ".tmp", path)
+    # what the sample is, for humans
+    with open(path.removesuffix(".npy") + ".json", "w") as f:
+        f.write(key_str)
+    return tokens
+
+
+def _sample_tokens(activation_store: ActivationsStore, key: dict[str, Any]):
+    generator = torch.Generator().manual_seed(key["seed"])
+    all_tokens_list = []
+    pbar = tqdm(range(key["n_batches_to_sample_from"]))
+    for _ in pbar:
+        batch_tokens = activation_store.get_batch_tokens()
+        batch_tokens = batch_tokens[
+            torch.randperm(batch_tokens.shape[0], generator=generator).to(
+                batch_tokens.device
+            )
+        ]
+        all_tokens_list.append(batch_tokens)
+
+    all_tokens = torch.cat(all_tokens_list, dim=0)
+    all_tokens = all_tokens[
+        torch.randperm(all_tokens.shape[0], generator=generator).to(all_tokens.device)
+    ]
+    return all_tokens[: key["n_prompts_to_select"]]
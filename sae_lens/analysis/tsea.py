@@ -30,7 +30,9 @@ def get_enrichment_df(
     return df_enrichment_scores
 
 
-def calculate_batch_enrichment_scores(scores: torch.Tensor, index_lists: torch.Tensor):
+def calculate_batch_enrichment_scores(
+    scores: torch.Tensor, index_lists: torch.Tensor, chunk_size: int = 256
+):
     """
     # features with large skew
     features_top_800_by_prediction_skew = W_U_stats_df_dec["skewness"].sort_values(ascending=False).head(12000).index
@@ -45,7 +47,26 @@ def calculate_batch_enrichment_scores(scores: torch.Tensor, index_lists: torch.T
     enrichment_scores = calculate_batch_enrichment_scores(dec_projection_onto_W_U[features_top_800_by_prediction_skew], gene_sets_token_ids_tensor)
     df_enrichment_scores = pd.DataFrame(enrichment_scores.numpy(), index=gene_sets_index, columns=features_top_800_by_prediction_skew)
     """
-    n_sets, _ = index_lists.shape
+    n_scores = scores.shape[0]
+    max_deviation = torch.empty(
+        index_lists.shape[0], n_scores, device=index_lists.device
+    )
+    # features are scored a chunk at a time, so memory is bounded by the chunk size
+    for start in range(0, n_scores, chunk_size):
+        max_deviation[:, start : start + chunk_size] = _calculate_enrichment_scores(
+            scores[start : start + chunk_size], index_lists
+        ).T
+    return max_deviation
+
+
+def _calculate_enrichment_scores(scores: torch.Tensor, index_lists: torch.Tensor):
+    """
+    The running sum walks down the tokens in order of score, going up by
+    1 / list_size at each hit (a token in the list) and down by
+    1 / (vocab_size - list_size) at each miss. Between hits it only goes down, so its
+    largest deviations are right at a hit or right before one: rather than the whole
+    walk we only need the rank of each hit.
+    """
     n_scores, vocab_size = scores.shape
 
     # Ensure scores and index_lists are on the same device
@@ -54,38 +75,31 @@ def calculate_batch_enrichment_scores(scores: torch.Tensor, index_lists: torch.T
     # Create a mask for valid indices (ignore padding)
     valid_mask = index_lists != -1  # Assuming -1 is used for padding
 
-    # Initialize a mask for all scores
-    score_mask = torch.zeros(
-        n_sets, vocab_size, device=index_lists.device, dtype=torch.bool
-    )
-
-    # Set true for valid indices in score_mask
-    for i in range(n_sets):
-        score_mask[i, index_lists[i][valid_mask[i]]] = True
-
-    # Sort scores along each row
+    # the rank of every token under each feature, scattered from the sorted order
     _, sorted_indices = scores.sort(dim=1, descending=True)
-
-    # Create a mask to identify hits within the sorted indices
-    hits = (
-        score_mask.unsqueeze(1)
-        .expand(-1, n_scores, -1)
-        .gather(2, sorted_indices.unsqueeze(0).expand(n_sets, -1, -1))
+    ranks = torch.empty_like(sorted_indices).scatter_(
+        1,
+        sorted_indices,
+        torch.arange(vocab_size, device=scores.device).expand(n_scores, -1),
     )
 
+    # the ranks of each list's hits in order, (n_scores, n_sets, max_list_size),
+    # with the padding sorted to the end
+    hit_ranks = ranks[:, index_lists.clamp(min=0)]
+    hit_ranks = hit_ranks.masked_fill(~valid_mask, vocab_size).sort(dim=-1).values
+
     # Calculate hit increment and miss decrement dynamically for each list
     list_sizes = valid_mask.sum(dim=1).float()  # Actual sizes of each list
-    hit_increment = (1.0 / list_sizes).view(-1, 1, 1)  # Reshape for broadcasting
-    miss_decrement = (1.0 / (vocab_size - list_sizes)).view(
-        -1, 1, 1
-    )  # Reshape for broadcasting
-
-    # Ensure hit_increment and miss_decrement are broadcastable to the shape of hits
-    # Apply hit increment or miss decrement based on hits
-    running_sums = torch.where(hits, hit_increment, -miss_decrement).cumsum(dim=2)
-    max_deviation = running_sums.abs().max(dim=2).values
-
-    return max_deviation
+    hit_increment = (1.0 / list_sizes).view(-1, 1)
+    miss_decrement = (1.0 / (vocab_size - list_sizes)).view(-1, 1)
+
+    # the running sum right after the k-th hit and right before it
+    n_hits = torch.arange(1, index_lists.shape[1] + 1, device=scores.device)
+    n_misses = hit_ranks + 1 - n_hits
+    after_hit = n_hits * hit_increment - n_misses * miss_decrement
+    before_hit = after_hit - hit_increment
+    deviations = torch.maximum(after_hit.abs(), before_hit.abs())
+    return deviations.masked_fill(~valid_mask, 0).max(dim=-1).values
 
 
 def manhattan_plot_enrichment_scores(
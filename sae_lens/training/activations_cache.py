@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import sys
+from typing import Any
+
+import torch
+
+CACHE_METADATA_FILENAME = "cache_metadata.json"
+CACHE_SHUFFLE_INDEX_FILENAME = "shuffle_index.bin"
+CACHE_FORMAT_VERSION = 1
+
+
+class ActivationsCache:
+    """
+    A directory of cached activations, split into shards of shape (n_rows, num_layers, d_in).
+
+    Shards are stored as raw little-endian tensors (`{i}.bin`) next to a small JSON
+    header, so loading one is a memory map rather than an unpickle. Directories written
+    by older versions (one `torch.save`d `{i}.pt` per buffer, no header) can still be read.
+
+    The header also records how many dataset examples the cached activations were computed
+    from, so training can carry on streaming from the dataset once the cache runs out.
+
+    The cache can be shuffled without touching the shards: `shuffle` splits them into
+    blocks of rows and saves a random order of those blocks, which `read_order` follows.
+    """
+
+    path: str
+    dtype: torch.dtype | None
+    num_layers: int | None
+    d_in: int | None
+    shard_rows: list[int]
+    shuffle_block_size: int | None
+    n_dataset_examples: int | None
+
+    def __init__(self, path: str):
+        self.path = path
+        metadata_path = os.path.join(path, CACHE_METADATA_FILENAME)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if metadata["format_version"] > CACHE_FORMAT_VERSION:
+                raise ValueError(
+                    f"Activations cache at {path} has format version {metadata['format_version']}, which is newer than this version of sae_lens supports ({CACHE_FORMAT_VERSION})."
+                )
+            if metadata["byteorder"] != sys.byteorder:
+                raise ValueError(
+                    f"Activations cache at {path} is {metadata['byteorder']}-endian but this machine is {sys.byteorder}-endian."
+                )
+            self.is_legacy = False
+            self.dtype = _dtype_from_str(metadata["dtype"])
+            self.num_layers = metadata["num_layers"]
+            self.d_in = metadata["d_in"]
+            self.shard_rows = metadata["shard_rows"]
+            self.shuffle_block_size = metadata.get("shuffle_block_size")
+            self.n_dataset_examples = metadata.get("n_dataset_examples")
+        else:
+            # legacy cache, we only learn shard shapes by loading them
+            self.is_legacy = True
+            self.dtype = None
+            self.num_layers = None
+            self.d_in = None
+            self.shard_rows = []
+            self.shuffle_block_size = None
+            self.n_dataset_examples = None
+            self._n_legacy_shards = len(
+                [f for f in os.listdir(path) if re.fullmatch(r"\d+\.pt", f)]
+            )
+
+    @classmethod
+    def create(
+        cls,
+        path: str,
+        num_layers: int,
+        d_in: int,
+        dtype: torch.dtype,
+    ) -> "ActivationsCache":
+        """
+        Start a new, empty cache at `path` in the memory-mapped format.
+        """
+        os.makedirs(path, exist_ok=True)
+        _write_metadata(
+            path,
+            {
+                "format_version": CACHE_FORMAT_VERSION,
+                "byteorder": sys.byteorder,
+                "dtype": str(dtype).removeprefix("torch."),
+                "num_layers": num_layers,
+                "d_in": d_in,
+                "shard_rows": [],
+                "shuffle_block_size": None,
+                "n_dataset_examples": None,
+            },
+        )
+        return cls(path)
+
+    @property
+    def n_shards(self) -> int:
+        if self.is_legacy:
+            return self._n_legacy_shards
+        return len(self.shard_rows)
+
+    @property
+    def n_activations(self) -> int:
+        if self.is_legacy:
+            # we assume all files have the same number of tokens
+            # (which seems reasonable since that's what our caching script does)
+            if self.n_shards == 0:
+                return 0
+            return self.load_shard(0).shape[0] * self.n_shards
+        return sum(self.shard_rows)
+
+    def load_shard(self, idx: int) -> torch.Tensor:
+        """
+        Load shard `idx`. For the memory-mapped format this is zero-copy: pages are
+        only read from disk when the returned tensor is used, and writing to it
+        doesn't change the file.
+        """
+        if self.is_legacy:
+            return torch.load(os.path.join(self.path, f"{idx}.pt"))
+        # keep pyright happy
+        assert self.dtype is not None
+        assert self.num_layers is not None and self.d_in is not None
+        n_rows = self.shard_rows[idx]
+        shape = (n_rows, self.num_layers, self.d_in)
+        if n_rows == 0:
+            return torch.empty(shape, dtype=self.dtype)
+        flat = torch.from_file(
+            self._shard_path(idx),
+            shared=False,
+            size=n_rows * self.num_layers * self.d_in,
+            dtype=self.dtype,
+        )
+        return flat.view(shape)
+
+    def write_shard(
+        self,
+        idx: int,
+        activations: torch.Tensor,
+        n_dataset_examples: int | None = None,
+    ):
+        """
+        Write `activations` as shard `idx`, either appending a new shard
+        or overwriting an existing one. Pass `n_dataset_examples` when appending
+        to record how many dataset examples the whole cache now covers.
+        """
+        if self.is_legacy:
+            torch.save(activations, os.path.join(self.path, f"{idx}.pt"))
+            self._n_legacy_shards = max(self._n_legacy_shards, idx + 1)
+            return
+        if idx > self.n_shards:
+            raise ValueError(
+                f"Can't write shard {idx}, the cache only has {self.n_shards} shards."
+            )
+        assert activations.shape[1:] == (
+            self.num_layers,
+            self.d_in,
+        ), f"Expected activations of shape (n, {self.num_layers}, {self.d_in}), got {tuple(activations.shape)}"
+        data = activations.detach().to("cpu", self.dtype).contiguous()
+        _write_bytes(self._shard_path(idx), data)
+
+        if idx == self.n_shards:
+            self.shard_rows.append(data.shape[0])
+        else:
+            self.shard_rows[idx] = data.shape[0]
+        # the saved block order only covers the shards as they were when shuffled
+        self.shuffle_block_size = None
+        if n_dataset_examples is not None:
+            self.n_dataset_examples = n_dataset_examples
+        self._save_metadata()
+
+    def shuffle(self, seed: int, block_size: int = 1024):
+        """
+        Shuffle the cache by saving a random order of blocks of `block_size` rows.
+        Only the index is written, so this is cheap and can be redone (e.g. per epoch)
+        with a new seed. Rows within a block keep their order, so they should already be
+        shuffled locally, as the buffers written by cache_activations_runner are.
+        """
+        if self.is_legacy:
+            raise ValueError(
+                "Index shuffling needs a cache in the memory-mapped format, use shuffle_activations_pairwise for .pt caches."
+            )
+        n_blocks = len(self._blocks(block_size))
+        generator = torch.Generator().manual_seed(seed)
+        block_order = torch.randperm(n_blocks, generator=generator)
+        _write_bytes(
+            os.path.join(self.path, CACHE_SHUFFLE_INDEX_FILENAME),
+            block_order.to(torch.int64),
+        )
+        self.shuffle_block_size = block_size
+        self._save_metadata()
+
+    def read_order(self) -> list[tuple[int, int, int | None]]:
+        """
+        The order to read the cache in, as (shard, start_row, end_row) segments.
+        An end_row of None means the end of the shard.
+        """
+        if self.shuffle_block_size is None:
+            return [(idx, 0, None) for idx in range(self.n_shards)]
+        blocks = self._blocks(self.shuffle_block_size)
+        if len(blocks) == 0:
+            return []
+        block_order = torch.from_file(
+            os.path.join(self.path, CACHE_SHUFFLE_INDEX_FILENAME),
+            shared=False,
+            size=len(blocks),
+            dtype=torch.int64,
+        )
+        return [blocks[i] for i in block_order.tolist()]
+
+    def _blocks(self, block_size: int) -> list[tuple[int, int, int | None]]:
+        # blocks never span two shards, the last block of a shard may be short
+        return [
+            (idx, start, min(start + block_size, n_rows))
+            for idx, n_rows in enumerate(self.shard_rows)
+            for start in range(0, n_rows, block_size)
+        ]
+
+    def _shard_path(self, idx: int) -> str:
+        return os.path.join(self.path, f"{idx}.bin")
+
+    def _save_metadata(self):
+        assert self.dtype is not None  # keep pyright happy
+        _write_metadata(
+            self.path,
+            {
+                "format_version": CACHE_FORMAT_VERSION,
+                "byteorder": sys.byteorder,
+                "dtype": str(self.dtype).removeprefix("torch."),
+                "num_layers": self.num_layers,
+                "d_in": self.d_in,
+                "shard_rows": self.shard_rows,
+                "shuffle_block_size": self.shuffle_block_size,
+                "n_dataset_examples": self.n_dataset_examples,
+            },
+        )
+
+
+def _write_bytes(path: str, tensor: torch.Tensor):
+    with open(path + ".tmp", "wb") as f:
+        # numpy has no bfloat16, so write the raw bytes
+        f.write(tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def _write_metadata(path: str, metadata: dict[str, Any]):
+    # write then rename, so an interrupted run never leaves a half-written header
+    metadata_path = os.path.join(path, CACHE_METADATA_FILENAME)
+    with open(metadata_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def _dtype_from_str(name: str) -> torch.dtype:
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f"Unknown dtype in activations cache metadata: {name}")
+    return dtype
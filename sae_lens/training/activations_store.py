@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import contextlib
+import itertools
 import os
-from typing import Any, Iterator, Literal, TypeVar, cast
+import queue
+import threading
+from typing import Callable, Iterator, Literal, TypeVar, cast
 
 import torch
 from datasets import (
@@ -10,10 +14,12 @@ from datasets import (
     IterableDataset,
     IterableDatasetDict,
     load_dataset,
+    load_from_disk,
 )
-from torch.utils.data import DataLoader
 from transformer_lens import HookedTransformer
+from transformer_lens.hook_points import HookPoint
 
+from sae_lens.training.activations_cache import ActivationsCache
 from sae_lens.training.config import (
     CacheActivationsRunnerConfig,
     LanguageModelSAERunnerConfig,
@@ -42,13 +48,14 @@ class ActivationsStore:
         dataset: HfDataset | None = None,
         create_dataloader: bool = True,
     ) -> "ActivationsStore":
-        cached_activations_path = cfg.cached_activations_path
-        # set cached_activations_path to None if we're not using cached activations
-        if (
-            isinstance(cfg, LanguageModelSAERunnerConfig)
-            and not cfg.use_cached_activations
-        ):
-            cached_activations_path = None
+        # only read from the cache when training on cached activations,
+        # the caching runner streams from the model and writes to it instead
+        cached_activations_path = (
+            cfg.cached_activations_path
+            if isinstance(cfg, LanguageModelSAERunnerConfig)
+            and cfg.use_cached_activations
+            else None
+        )
         return cls(
             model=model,
             dataset=dataset or cfg.dataset_path,
@@ -64,8 +71,16 @@ class ActivationsStore:
             prepend_bos=cfg.prepend_bos,
             device=cfg.device,
             dtype=cfg.dtype,
+            storage_dtype=(
+                cfg.storage_dtype
+                if isinstance(cfg, LanguageModelSAERunnerConfig)
+                else None
+            ),
             cached_activations_path=cached_activations_path,
             create_dataloader=create_dataloader,
+            prefetch_activations=isinstance(cfg, LanguageModelSAERunnerConfig)
+            and cfg.prefetch_activations,
+            autocast_lm=cfg.autocast_lm,
         )
 
     def __init__(
@@ -84,14 +99,15 @@ class ActivationsStore:
         prepend_bos: bool,
         device: str | torch.device,
         dtype: torch.dtype,
+        storage_dtype: torch.dtype | None = None,
         cached_activations_path: str | None = None,
         create_dataloader: bool = True,
+        prefetch_activations: bool = False,
+        autocast_lm: bool = False,
     ):
         self.model = model
         self.dataset = (
-            load_dataset(dataset, split="train", streaming=True)
-            if isinstance(dataset, str)
-            else dataset
+            _load_dataset_from_path(dataset) if isinstance(dataset, str) else dataset
         )
         self.hook_point = hook_point
         self.hook_point_layers = hook_point_layers
@@ -105,7 +121,15 @@ class ActivationsStore:
         self.prepend_bos = prepend_bos
         self.device = device
         self.dtype = dtype
+        # activations are kept in this dtype while buffered, and cast to dtype when served
+        self.storage_dtype = storage_dtype or dtype
+        self.autocast_lm = autocast_lm
         self.cached_activations_path = cached_activations_path
+        # Held while the store uses the model or the dataset iterator. Anything else
+        # running the model (e.g. evals) must hold it too while prefetching is on,
+        # since hooks added by one thread would otherwise fire in the other.
+        self.model_lock = threading.RLock()
+        self._prefetcher: _BufferPrefetcher | None = None
 
         self.iterable_dataset = iter(self.dataset)
 
@@ -127,6 +151,9 @@ class ActivationsStore:
                 "Dataset must have a 'tokens', 'input_ids', or 'text' column."
             )
         self.iterable_dataset = iter(self.dataset)  # Reset iterator after checking
+        # documents streamed from the dataset but not yet packed into a batch
+        self._leftover_documents: list[torch.Tensor] = []
+        self._n_dataset_examples_pulled = 0
 
         if cached_activations_path is not None:  # EDIT: load from multi-layer acts
             assert self.cached_activations_path is not None  # keep pyright happy
@@ -135,153 +162,186 @@ class ActivationsStore:
                 self.cached_activations_path
             ), f"Cache directory {self.cached_activations_path} does not exist. Consider double-checking your dataset, model, and hook names."
 
-            self.next_cache_idx = 0  # which file to open next
-            self.next_idx_within_buffer = 0  # where to start reading from in that file
-
-            # Check that we have enough data on disk
-            first_buffer = torch.load(f"{self.cached_activations_path}/0.pt")
-            buffer_size_on_disk = first_buffer.shape[0]
-            n_buffers_on_disk = len(os.listdir(self.cached_activations_path))
-            # Note: we're assuming all files have the same number of tokens
-            # (which seems reasonable imo since that's what our script does)
-            n_activations_on_disk = buffer_size_on_disk * n_buffers_on_disk
-            assert (
-                n_activations_on_disk > self.total_training_tokens
-            ), f"Only {n_activations_on_disk/1e6:.1f}M activations on disk, but total_training_tokens is {self.total_training_tokens/1e6:.1f}M."
-
-            # TODO add support for "mixed loading" (ie use cache until you run out, then switch over to streaming from HF)
+            self.activations_cache = ActivationsCache(self.cached_activations_path)
+            # the cache is read as a list of (file, start, end) segments, in shuffled
+            # order if the cache has a shuffle index
+            self.cache_read_order = self.activations_cache.read_order()
+            self.next_cache_idx = 0  # which segment to read next
+            # where to start reading from in that segment
+            self.next_idx_within_buffer = 0
+            # set once the cache runs out and we've switched to streaming from the dataset
+            self.streaming_after_cache = False
+
+            # Check that we have enough data on disk, or know where to carry on streaming from
+            n_activations_on_disk = self.activations_cache.n_activations
+            if n_activations_on_disk <= self.total_training_tokens:
+                assert (
+                    self.activations_cache.n_dataset_examples is not None
+                ), f"Only {n_activations_on_disk/1e6:.1f}M activations on disk, but total_training_tokens is {self.total_training_tokens/1e6:.1f}M. The cache doesn't record which dataset examples it was computed from, so we can't carry on streaming after it."
+                print(
+                    f"Only {n_activations_on_disk/1e6:.1f}M activations on disk, but total_training_tokens is {self.total_training_tokens/1e6:.1f}M. "
+                    f"The rest will be streamed from the dataset, starting after the {self.activations_cache.n_dataset_examples} examples the cache covers."
+                )
 
         if create_dataloader:
-            # fill buffer half a buffer, so we can mix it with a new buffer
-            self.storage_buffer = self.get_buffer(self.n_batches_in_buffer // 2)
+            # fill the mixing buffer halfway, so we can mix it with a new half buffer
+            self._init_mixing_buffer(
+                self.get_buffer(self.n_batches_in_buffer // 2, shuffle=False)
+            )
+            if prefetch_activations:
+                self._prefetcher = _BufferPrefetcher(
+                    lambda: self.get_buffer(
+                        self.n_batches_in_buffer // 2, shuffle=False
+                    ),
+                    device=torch.device(self.device),
+                )
             self.dataloader = self.get_data_loader()
 
+    @property
+    def storage_buffer(self) -> torch.Tensor:
+        """
+        The activations currently held back in the mixing buffer: a view of it, in
+        `storage_dtype`. Casting all of it to `dtype` at once could take as much memory
+        as the whole mixing buffer, so callers upcast as they go.
+        """
+        return self._mixing_buffer[: self._n_stored]
+
     def get_batch_tokens(self):
         """
         Streams a batch of tokens from a dataset.
+
+        Documents are concatenated into one flat token stream which is then cut
+        into `context_size` rows in one go (see `_pack_tokens`). Like packing one
+        document at a time, each batch starts on a fresh document and the rest of
+        the document the last row ends in is dropped. Documents that were pulled
+        from the dataset but not reached are carried over to the next call.
         """
 
         batch_size = self.store_batch_size
         context_size = self.context_size
-        device = self.device
-
-        batch_tokens = torch.zeros(
-            size=(0, context_size), device=device, dtype=torch.long, requires_grad=False
-        )
 
-        current_batch = []
-        current_length = 0
-
-        # pbar = tqdm(total=batch_size, desc="Filling batches")
-        while batch_tokens.shape[0] < batch_size:
-            tokens = self._get_next_dataset_tokens()
-            token_len = tokens.shape[0]
-
-            # TODO: Fix this so that we are limiting how many tokens we get from the same context.
-            assert self.model.tokenizer is not None  # keep pyright happy
-            while token_len > 0 and batch_tokens.shape[0] < batch_size:
-                # Space left in the current batch
-                space_left = context_size - current_length
+        assert self.model.tokenizer is not None  # keep pyright happy
+        bos_token_id = self.model.tokenizer.bos_token_id if self.prepend_bos else None
+
+        with self.model_lock:
+            # Every row consumes at most context_size tokens of the stream, so once
+            # the stream is longer than that we know which document the last row
+            # ends in.
+            n_tokens_needed = batch_size * context_size
+            documents = self._leftover_documents
+            n_tokens_in_stream = sum(doc.shape[0] for doc in documents)
+            while n_tokens_in_stream <= n_tokens_needed:
+                tokens = self._get_next_dataset_tokens()
+                documents.append(tokens)
+                n_tokens_in_stream += tokens.shape[0]
+
+            batch_tokens, n_tokens_consumed = _pack_tokens(
+                torch.cat(documents, dim=0),
+                n_rows=batch_size,
+                context_size=context_size,
+                bos_token_id=bos_token_id,
+            )
 
-                # If the current tokens fit entirely into the remaining space
-                if token_len <= space_left:
-                    current_batch.append(tokens[:token_len])
-                    current_length += token_len
+            # drop everything up to and including the document the last row ended in
+            document_end = 0
+            for i, doc in enumerate(documents):
+                document_end += doc.shape[0]
+                if document_end > n_tokens_consumed:
+                    self._leftover_documents = documents[i + 1 :]
                     break
 
-                else:
-                    # Take as much as will fit
-                    current_batch.append(tokens[:space_left])
-
-                    # Remove used part, add BOS
-                    tokens = tokens[space_left:]
-                    token_len -= space_left
-
-                    # only add BOS if it's not already the first token
-                    if self.prepend_bos:
-                        bos_token_id_tensor = torch.tensor(
-                            [self.model.tokenizer.bos_token_id],
-                            device=tokens.device,
-                            dtype=torch.long,
-                        )
-                        if tokens[0] != bos_token_id_tensor:
-                            tokens = torch.cat(
-                                (
-                                    bos_token_id_tensor,
-                                    tokens,
-                                ),
-                                dim=0,
-                            )
-                            token_len += 1
-                    current_length = context_size
-
-                # If a batch is full, concatenate and move to next batch
-                if current_length == context_size:
-                    full_batch = torch.cat(current_batch, dim=0)
-                    batch_tokens = torch.cat(
-                        (batch_tokens, full_batch.unsqueeze(0)), dim=0
-                    )
-                    current_batch = []
-                    current_length = 0
-
-            # pbar.n = batch_tokens.shape[0]
-            # pbar.refresh()
-        return batch_tokens[:batch_size]
+        return batch_tokens
 
-    def get_activations(self, batch_tokens: torch.Tensor):
+    def get_activations(
+        self, batch_tokens: torch.Tensor, out: torch.Tensor | None = None
+    ) -> torch.Tensor:
         """
         Returns activations of shape (batches, context, num_layers, d_in)
 
         d_in may result from a concatenated head dimension.
+
+        Hooks copy each activation straight into `out` (or a new tensor in `dtype`),
+        and the forward pass stops as soon as the last one has fired.
         """
         layers = self.hook_point_layers
         act_names = [self.hook_point.format(layer=layer) for layer in layers]
         hook_point_max_layer = max(layers)
-        layerwise_activations = self.model.run_with_cache(
-            batch_tokens,
-            names_filter=act_names,
-            stop_at_layer=hook_point_max_layer + 1,
-            prepend_bos=self.prepend_bos,
-        )[1]
-        activations_list = [layerwise_activations[act_name] for act_name in act_names]
-        if self.hook_point_head_index is not None:
-            activations_list = [
-                act[:, :, self.hook_point_head_index] for act in activations_list
-            ]
-        elif activations_list[0].ndim > 3:  # if we have a head dimension
-            # flatten the head dimension
-            activations_list = [
-                act.view(act.shape[0], act.shape[1], -1) for act in activations_list
-            ]
-
-        # Stack along a new dimension to keep separate layers distinct
-        stacked_activations = torch.stack(activations_list, dim=2)
-
-        return stacked_activations
-
-    def get_buffer(self, n_batches_in_buffer: int):
+        if out is None:
+            out = torch.empty(
+                (*batch_tokens.shape, len(layers), self.d_in),
+                dtype=self.dtype,
+                device=batch_tokens.device,
+            )
+        n_captured = 0
+
+        def capture_hook(act: torch.Tensor, hook: HookPoint):
+            nonlocal n_captured
+            if self.hook_point_head_index is not None:
+                act = act[:, :, self.hook_point_head_index]
+            elif act.ndim > 3:  # if we have a head dimension
+                # flatten the head dimension
+                act = act.flatten(2)
+            out[:, :, act_names.index(cast(str, hook.name))].copy_(act)
+            n_captured += 1
+            if n_captured == len(act_names):
+                raise _StopForward
+
+        with (
+            self.model_lock,
+            torch.inference_mode(),
+            torch.autocast(
+                device_type=torch.device(self.device).type,
+                enabled=self.autocast_lm,
+            ),
+        ):
+            try:
+                self.model.run_with_hooks(
+                    batch_tokens,
+                    fwd_hooks=[(act_name, capture_hook) for act_name in act_names],
+                    stop_at_layer=hook_point_max_layer + 1,
+                    prepend_bos=self.prepend_bos,
+                )
+            except _StopForward:
+                pass
+        assert n_captured == len(act_names), "Not every hook point was reached"
+
+        return out
+
+    def get_buffer(
+        self, n_batches_in_buffer: int, shuffle: bool = True
+    ) -> torch.Tensor:
+        """
+        Get a buffer of activations in `storage_dtype`, of shape (n_tokens, num_layers, d_in).
+        Live activations are shuffled unless `shuffle` is False, which the mixing buffer uses
+        as it shuffles anyway. Cached activations are returned in the order they're read.
+        """
         context_size = self.context_size
         batch_size = self.store_batch_size
         d_in = self.d_in
         total_size = batch_size * n_batches_in_buffer
         num_layers = len(self.hook_point_layers)  # Number of hook points or layers
 
-        if self.cached_activations_path is not None:
+        if self.cached_activations_path is not None and not self.streaming_after_cache:
             # Load the activations from disk
             buffer_size = total_size * context_size
             # Initialize an empty tensor with an additional dimension for layers
-            new_buffer = torch.zeros(
+            new_buffer = torch.empty(
                 (buffer_size, num_layers, d_in),
-                dtype=self.dtype,
+                dtype=self.storage_dtype,
                 device=self.device,
             )
             n_tokens_filled = 0
 
             # Assume activations for different layers are stored separately and need to be combined
             while n_tokens_filled < buffer_size:
-                if not os.path.exists(
-                    f"{self.cached_activations_path}/{self.next_cache_idx}.pt"
-                ):
+                if self.next_cache_idx >= len(self.cache_read_order):
+                    if self.activations_cache.n_dataset_examples is not None:
+                        # mixed loading: carry on with live activations from here
+                        self._start_streaming_after_cache()
+                        if n_tokens_filled == 0:
+                            return self.get_buffer(n_batches_in_buffer, shuffle=shuffle)
+                        return new_buffer[:n_tokens_filled, ...]
+
                     print(
                         "\n\nWarning: Ran out of cached activation files earlier than expected."
                     )
@@ -297,9 +357,10 @@ class ActivationsStore:
                     new_buffer = new_buffer[:n_tokens_filled, ...]
                     return new_buffer
 
-                activations = torch.load(
-                    f"{self.cached_activations_path}/{self.next_cache_idx}.pt"
-                )
+                shard_idx, start, end = self.cache_read_order[self.next_cache_idx]
+                activations = self.activations_cache.load_shard(shard_idx)[
+                    start + self.next_idx_within_buffer : end
+                ]
                 taking_subset_of_file = False
                 if n_tokens_filled + activations.shape[0] > buffer_size:
                     activations = activations[: buffer_size - n_tokens_filled, ...]
@@ -310,7 +371,7 @@ class ActivationsStore:
                 ] = activations
 
                 if taking_subset_of_file:
-                    self.next_idx_within_buffer = activations.shape[0]
+                    self.next_idx_within_buffer += activations.shape[0]
                 else:
                     self.next_cache_idx += 1
                     self.next_idx_within_buffer = 0
@@ -321,62 +382,83 @@ class ActivationsStore:
 
         refill_iterator = range(0, batch_size * n_batches_in_buffer, batch_size)
         # Initialize empty tensor buffer of the maximum required size with an additional dimension for layers
-        new_buffer = torch.zeros(
+        new_buffer = torch.empty(
             (total_size, context_size, num_layers, d_in),
-            dtype=self.dtype,
+            dtype=self.storage_dtype,
             device=self.device,
         )
 
         for refill_batch_idx_start in refill_iterator:
             refill_batch_tokens = self.get_batch_tokens()
-            refill_activations = self.get_activations(refill_batch_tokens)
-            new_buffer[
-                refill_batch_idx_start : refill_batch_idx_start + batch_size, ...
-            ] = refill_activations
+            self.get_activations(
+                refill_batch_tokens,
+                out=new_buffer[
+                    refill_batch_idx_start : refill_batch_idx_start + batch_size, ...
+                ],
+            )
 
             # pbar.update(1)
 
         new_buffer = new_buffer.reshape(-1, num_layers, d_in)
-        new_buffer = new_buffer[torch.randperm(new_buffer.shape[0])]
+        if shuffle:
+            new_buffer = new_buffer[torch.randperm(new_buffer.shape[0])]
 
         return new_buffer
 
     def get_data_loader(
         self,
-    ) -> Iterator[Any]:
+    ) -> Iterator[torch.Tensor]:
         """
-        Return a torch.utils.dataloader which you can get batches from.
+        Refill the mixing buffer and return an iterator over batches of the served half.
 
         Should automatically refill the buffer when it gets to n % full.
         (better mixing if you refill and shuffle regularly).
 
+        Each batch is a copy, gathered from the buffer in random order. Refilling in place
+        leaves the served rows mostly in the order they were read, so they need a shuffle
+        before they can be served as consecutive views. Any in place shuffle moves every
+        row at least once, which costs as much as gathering the batches, so they're
+        gathered instead.
         """
 
         batch_size = self.train_batch_size
 
-        # 1. # create new buffer by mixing stored and new buffer
-        mixing_buffer = torch.cat(
-            [self.get_buffer(self.n_batches_in_buffer // 2), self.storage_buffer],
-            dim=0,
+        # 1. put a new half buffer in after the stored activations
+        new_buffer = (
+            self._prefetcher.get()
+            if self._prefetcher is not None
+            else self.get_buffer(self.n_batches_in_buffer // 2, shuffle=False)
         )
-
-        mixing_buffer = mixing_buffer[torch.randperm(mixing_buffer.shape[0])]
-
-        # 2.  put 50 % in storage
-        self.storage_buffer = mixing_buffer[: mixing_buffer.shape[0] // 2]
-
-        # 3. put other 50 % in a dataloader
-        dataloader = iter(
-            DataLoader(
-                # TODO: seems like a typing bug?
-                cast(Any, mixing_buffer[mixing_buffer.shape[0] // 2 :]),
-                batch_size=batch_size,
-                shuffle=True,
-            )
+        n_filled = self._n_stored + new_buffer.shape[0]
+        self._mixing_buffer[self._n_stored : n_filled] = new_buffer
+        del new_buffer
+
+        # 2. pick a random 50 % of the filled rows to keep in storage, and swap the
+        # ones past the stored half with the ones in it that are served instead, so the
+        # stored half stays at the front of the buffer
+        n_stored = n_filled // 2
+        perm = torch.randperm(n_filled, device=self._mixing_buffer.device)
+        kept, served = perm[:n_stored], perm[n_stored:]
+        kept_after = kept[kept >= n_stored]
+        served_before = served[served < n_stored]
+        swapped = self._mixing_buffer[served_before]
+        self._mixing_buffer[served_before] = self._mixing_buffer[kept_after]
+        self._mixing_buffer[kept_after] = swapped
+        del swapped
+        self._n_stored = n_stored
+
+        # 3. serve the other 50 % in random order, gathering a batch at a time, so
+        # there's never a shuffled (or cast) copy of the whole served half. The rows
+        # swapped in from storage are in random order but the new ones aren't, hence
+        # the gather rather than consecutive views. The next refill only overwrites them
+        # once every batch has been served.
+        return _iterate_batches(
+            self._mixing_buffer[n_stored:n_filled],
+            batch_size,
+            order=torch.randperm(n_filled - n_stored, device=perm.device),
+            dtype=self.dtype,
         )
 
-        return dataloader
-
     def next_batch(self):
         """
         Get the next batch from the current DataLoader.
@@ -390,8 +472,58 @@ class ActivationsStore:
             self.dataloader = self.get_data_loader()
             return next(self.dataloader)
 
+    def _init_mixing_buffer(self, first_buffer: torch.Tensor):
+        # The mixing buffer is allocated once and refilled in place: each refill writes
+        # a new half buffer over the rows served last time, so a refill never needs
+        # more than the mixing buffer, one half buffer in flight and the rows it swaps.
+        n_half = first_buffer.shape[0]
+        self._mixing_buffer = torch.empty(
+            (2 * n_half, *first_buffer.shape[1:]),
+            dtype=self.storage_dtype,
+            device=self.device,
+        )
+        self._mixing_buffer[:n_half] = first_buffer
+        # the stored activations are always the first _n_stored rows
+        self._n_stored = n_half
+
+    def close(self):
+        """
+        Stop prefetching activations in the background, if it's on.
+
+        The store keeps working afterwards, refilling its buffer synchronously.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    @property
+    def n_dataset_examples_consumed(self) -> int:
+        """
+        How many examples from the start of the dataset have been used so far. Examples
+        pulled ahead but not yet reached by a batch don't count.
+        """
+        return self._n_dataset_examples_pulled - len(self._leftover_documents)
+
+    def _start_streaming_after_cache(self):
+        n_examples = self.activations_cache.n_dataset_examples
+        assert n_examples is not None  # keep pyright happy
+        print(
+            f"Ran out of cached activations, streaming the rest from the dataset starting at example {n_examples}."
+        )
+        with self.model_lock:
+            self.streaming_after_cache = True
+            # skip the examples the cache was computed from, so no tokens are repeated
+            self.iterable_dataset = (
+                iter(self.dataset.skip(n_examples))
+                if isinstance(self.dataset, (Dataset, IterableDataset))
+                else itertools.islice(iter(self.dataset), n_examples, None)
+            )
+            self._leftover_documents = []
+            self._n_dataset_examples_pulled = n_examples
+
     def _get_next_dataset_tokens(self) -> torch.Tensor:
         device = self.device
+        self._n_dataset_examples_pulled += 1
         if not self.is_dataset_tokenized:
             s = next(self.iterable_dataset)[self.tokens_column]
             tokens = self.model.to_tokens(
@@ -404,11 +536,10 @@ class ActivationsStore:
                 len(tokens.shape) == 1
             ), f"tokens.shape should be 1D but was {tokens.shape}"
         else:
-            tokens = torch.tensor(
+            tokens = torch.as_tensor(
                 next(self.iterable_dataset)[self.tokens_column],
                 dtype=torch.long,
                 device=device,
-                requires_grad=False,
             )
             if (
                 not self.prepend_bos
@@ -418,6 +549,153 @@ class ActivationsStore:
         return tokens
 
 
+class _StopForward(Exception):
+    """
+    Raised by the capture hooks once every activation we need is in, to skip the
+    rest of the forward pass.
+    """
+
+
+class _BufferPrefetcher:
+    """
+    Produces buffers on a background thread, keeping at most `max_prefetched`
+    finished buffers waiting in a queue.
+
+    On CUDA the buffers are produced on a separate stream, so the refill can run
+    alongside the training kernels on the default stream.
+    """
+
+    def __init__(
+        self,
+        get_buffer: Callable[[], torch.Tensor],
+        device: torch.device,
+        max_prefetched: int = 1,
+    ):
+        self._get_buffer = get_buffer
+        self._queue: queue.Queue[torch.Tensor | BaseException] = queue.Queue(
+            maxsize=max_prefetched
+        )
+        self._stop = threading.Event()
+        self._stream = (
+            cast(torch.cuda.Stream, torch.cuda.Stream(device))
+            if device.type == "cuda"
+            else None
+        )
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self) -> torch.Tensor:
+        item = self._queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        if self._stream is not None:
+            # the buffer was allocated on our stream but will be used (and freed) on
+            # the consumer's, so stop the allocator from reusing it too early
+            item.record_stream(torch.cuda.current_stream(item.device))
+        return item
+
+    def close(self):
+        self._stop.set()
+        # unblock the producer if it's waiting for space in the queue
+        with contextlib.suppress(queue.Empty):
+            while True:
+                self._queue.get_nowait()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            stream_ctx = (
+                torch.cuda.stream(self._stream)
+                if self._stream is not None
+                else contextlib.nullcontext()
+            )
+            try:
+                with stream_ctx:
+                    item: torch.Tensor | BaseException = self._get_buffer()
+                if self._stream is not None:
+                    self._stream.synchronize()
+            except BaseException as e:  # re-raised in the consumer thread by get()
+                item = e
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, BaseException):
+                return
+
+
+def _load_dataset_from_path(path: str) -> HfDataset:
+    # datasets written with save_to_disk (e.g. by pretokenize_runner) are read straight
+    # from their memory-mapped arrow files, anything else is streamed from the hub
+    if os.path.exists(os.path.join(path, "state.json")):
+        return load_from_disk(path).with_format("torch")
+    return load_dataset(path, split="train", streaming=True)
+
+
+def _iterate_batches(
+    activations: torch.Tensor,
+    batch_size: int,
+    order: torch.Tensor | None = None,
+    dtype: torch.dtype | None = None,
+) -> Iterator[torch.Tensor]:
+    # batches of `activations` in `order` (consecutive if None), cast to dtype if given.
+    # Without an order or a cast they're views, otherwise each batch is a copy. The last
+    # batch may be short
+    for start in range(0, activations.shape[0], batch_size):
+        if order is None:
+            batch = activations[start : start + batch_size]
+        else:
+            batch = activations[order[start : start + batch_size]]
+        yield batch if dtype is None else batch.to(dtype)
+
+
+def _pack_tokens(
+    token_stream: torch.Tensor,
+    n_rows: int,
+    context_size: int,
+    bos_token_id: int | None,
+) -> tuple[torch.Tensor, int]:
+    """
+    Cut a flat stream of concatenated documents into `n_rows` rows of `context_size`.
+
+    If `bos_token_id` is given, every row after the first that doesn't already start
+    with a BOS token gets one inserted, so that row only consumes `context_size - 1`
+    tokens of the stream. The stream must hold at least `n_rows * context_size` tokens.
+
+    Returns the `(n_rows, context_size)` batch and the number of stream tokens used.
+    """
+    assert (
+        token_stream.shape[0] >= n_rows * context_size
+    ), f"Need at least {n_rows * context_size} tokens, got {token_stream.shape[0]}"
+
+    if bos_token_id is None:
+        n_consumed = n_rows * context_size
+        return token_stream[:n_consumed].view(n_rows, context_size), n_consumed
+
+    # Where each row starts only depends on whether the previous rows needed a
+    # BOS inserted, so walk the row starts on the host (one sync for the whole
+    # batch) and gather all rows from the stream at once.
+    is_bos = (token_stream[: n_rows * context_size] == bos_token_id).tolist()
+    row_starts: list[int] = []
+    bos_inserted: list[bool] = []
+    pos = 0
+    for row in range(n_rows):
+        insert_bos = row > 0 and not is_bos[pos]
+        row_starts.append(pos - int(insert_bos))
+        bos_inserted.append(insert_bos)
+        pos += context_size - int(insert_bos)
+
+    device = token_stream.device
+    gather_idx = torch.tensor(row_starts, device=device).unsqueeze(1) + torch.arange(
+        context_size, device=device
+    )
+    batch_tokens = token_stream[gather_idx.clamp(min=0)]
+    batch_tokens[torch.tensor(bos_inserted, device=device), 0] = bos_token_id
+    return batch_tokens, pos
+
+
 T = TypeVar("T")
 
 
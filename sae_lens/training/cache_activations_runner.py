@@ -1,11 +1,11 @@
 import math
 import os
 
-import torch
 from tqdm import tqdm
 from transformer_lens import HookedTransformer
 
-from sae_lens.training.activations_store import ActivationsStore
+from sae_lens.training.activations_cache import ActivationsCache
+from sae_lens.training.activations_store import ActivationsStore, listify
 from sae_lens.training.config import CacheActivationsRunnerConfig
 from sae_lens.training.utils import shuffle_activations_pairwise
 
@@ -20,14 +20,19 @@ def cache_activations_runner(cfg: CacheActivationsRunnerConfig):
     )
 
     # if the activations directory exists and has files in it, raise an exception
-    assert activations_store.cached_activations_path is not None
-    if os.path.exists(activations_store.cached_activations_path):
-        if len(os.listdir(activations_store.cached_activations_path)) > 0:
+    cached_activations_path = cfg.cached_activations_path
+    assert cached_activations_path is not None
+    if os.path.exists(cached_activations_path):
+        if len(os.listdir(cached_activations_path)) > 0:
             raise Exception(
-                f"Activations directory ({activations_store.cached_activations_path}) is not empty. Please delete it or specify a different path. Exiting the script to prevent accidental deletion of files."
+                f"Activations directory ({cached_activations_path}) is not empty. Please delete it or specify a different path. Exiting the script to prevent accidental deletion of files."
             )
-    else:
-        os.makedirs(activations_store.cached_activations_path)
+    activations_cache = ActivationsCache.create(
+        cached_activations_path,
+        num_layers=len(listify(cfg.hook_point_layer)),
+        d_in=cfg.d_in,
+        dtype=cfg.dtype,
+    )
 
     print(f"Started caching {cfg.total_training_tokens} activations")
     tokens_per_buffer = (
@@ -37,30 +42,44 @@ def cache_activations_runner(cfg: CacheActivationsRunnerConfig):
     # for i in tqdm(range(n_buffers), desc="Caching activations"):
     for i in range(n_buffers):
         buffer = activations_store.get_buffer(cfg.n_batches_in_buffer)
-        torch.save(buffer, f"{activations_store.cached_activations_path}/{i}.pt")
+        activations_cache.write_shard(
+            i,
+            buffer,
+            # lets training carry on streaming from the dataset once the cache runs out
+            n_dataset_examples=activations_store.n_dataset_examples_consumed,
+        )
         del buffer
 
-        if i % cfg.shuffle_every_n_buffers == 0 and i > 0:
+        if (
+            cfg.shuffle_mode == "pairwise"
+            and i % cfg.shuffle_every_n_buffers == 0
+            and i > 0
+        ):
             # Shuffle the buffers on disk
 
             # Do random pairwise shuffling between the last shuffle_every_n_buffers buffers
             for _ in range(cfg.n_shuffles_with_last_section):
                 shuffle_activations_pairwise(
-                    activations_store.cached_activations_path,
+                    cached_activations_path,
                     buffer_idx_range=(i - cfg.shuffle_every_n_buffers, i),
                 )
 
             # Do more random pairwise shuffling between all the buffers
             for _ in range(cfg.n_shuffles_in_entire_dir):
                 shuffle_activations_pairwise(
-                    activations_store.cached_activations_path,
+                    cached_activations_path,
                     buffer_idx_range=(0, i),
                 )
 
+    if cfg.shuffle_mode == "index":
+        # each buffer is already shuffled, so shuffling blocks of rows mixes globally
+        activations_cache.shuffle(seed=cfg.seed, block_size=cfg.shuffle_block_size)
+        return
+
     # More final shuffling (mostly in case we didn't end on an i divisible by shuffle_every_n_buffers)
     if n_buffers > 1:
         for _ in tqdm(range(cfg.n_shuffles_final), desc="Final shuffling"):
             shuffle_activations_pairwise(
-                activations_store.cached_activations_path,
+                cached_activations_path,
                 buffer_idx_range=(0, n_buffers),
             )
@@ -0,0 +1,119 @@
+import atexit
+import copy
+import queue
+import threading
+from typing import Callable, Optional, TypeVar, cast
+
+import torch
+
+T = TypeVar("T")
+
+
+class CheckpointWriter:
+    """
+    Runs checkpoint writes (and wandb uploads) on a background thread, in the order they
+    were submitted, with at most `max_pending` of them waiting. Submitting blocks while
+    the queue is full, which bounds the memory held by snapshots waiting to be written.
+
+    An exception from a write is re-raised in the training thread by the next submit,
+    flush or close. Pending writes are flushed when the interpreter exits, so a
+    checkpoint that was submitted is always written unless the process is killed.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        self._queue: queue.Queue[Optional[Callable[[], None]]] = queue.Queue(
+            maxsize=max_pending
+        )
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, write: Callable[[], None]):
+        if self._closed:
+            raise RuntimeError("CheckpointWriter is closed")
+        self._raise_error()
+        self._queue.put(write)
+
+    def flush(self):
+        """Wait for every submitted write to finish."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            write = self._queue.get()
+            try:
+                if write is None:
+                    return
+                # after a failure, keep draining the queue so nothing waits on it
+                if self._error is None:
+                    write()
+            except BaseException as e:  # re-raised in the training thread
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+def snapshot_to_cpu(obj: T) -> tuple[T, Optional[torch.cuda.Event]]:
+    """
+    A deep copy of obj with every tensor it holds (module parameters and buffers, and
+    tensors in its attributes, lists and dicts) copied to the CPU, for writing out while
+    training carries on with the originals.
+
+    CUDA tensors are copied into pinned memory without blocking, and the copies are
+    only complete once the returned event has been synchronized, which the writer
+    thread should do before reading them. Because the copies are queued on the current
+    stream, later in-place updates to the originals don't affect them.
+    """
+    memo = {}
+    _collect_cpu_copies(obj, memo, seen=set())
+    snapshot = copy.deepcopy(obj, memo)
+    event = None
+    if any(t.is_pinned() for t in memo.values() if isinstance(t, torch.Tensor)):
+        event = cast(torch.cuda.Event, torch.cuda.current_stream().record_event())
+    return snapshot, event
+
+
+def _collect_cpu_copies(obj: object, memo: dict[int, object], seen: set[int]):
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, torch.Tensor):
+        memo[id(obj)] = _cpu_copy(obj)
+        return
+    if isinstance(obj, dict):
+        children = list(obj.values())
+    elif isinstance(obj, (list, tuple)):
+        children = list(obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        # including modules, whose parameters and buffers are in dicts in their __dict__
+        children = list(vars(obj).values())
+    else:
+        return
+    for child in children:
+        _collect_cpu_copies(child, memo, seen)
+
+
+def _cpu_copy(tensor: torch.Tensor) -> torch.Tensor:
+    cpu_tensor = torch.empty_like(
+        tensor, device="cpu", pin_memory=tensor.is_cuda
+    ).copy_(tensor.detach(), non_blocking=tensor.is_cuda)
+    if isinstance(tensor, torch.nn.Parameter):
+        return torch.nn.Parameter(cpu_tensor, requires_grad=tensor.requires_grad)
+    return cpu_tensor
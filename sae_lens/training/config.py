@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, Optional, cast
+from typing import Any, Literal, Optional, cast
 
 import torch
 
@@ -33,11 +33,20 @@ class LanguageModelSAERunnerConfig:
     total_training_tokens: int = 2_000_000
     store_batch_size: int = 32
     train_batch_size: int = 4096
+    prefetch_activations: bool = (
+        False  # refill the activation buffer on a background thread while training
+    )
+    autocast_lm: bool = (
+        False  # run the model under torch.autocast when generating activations
+    )
 
     # Misc
     device: str | torch.device = "cpu"
     seed: int = 42
     dtype: torch.dtype = torch.float32
+    storage_dtype: Optional[torch.dtype] = (
+        None  # dtype the activation buffer is kept in, e.g. torch.bfloat16 to halve its memory. Defaults to dtype
+    )
     prepend_bos: bool = True
 
     # SAE Parameters
@@ -45,6 +54,9 @@ class LanguageModelSAERunnerConfig:
     expansion_factor: int | list[int] = 4
     from_pretrained_path: Optional[str] = None
     d_sae: Optional[int] = None
+    sparse_decode: bool = (
+        False  # decode only the active features with an embedding bag, faster for large, sparse SAEs
+    )
 
     # Training Parameters
     l1_coefficient: float | list[float] = 1e-3
@@ -60,6 +72,12 @@ class LanguageModelSAERunnerConfig:
     lr_decay_steps: int | list[int] = 0
     n_restart_cycles: int | list[int] = 1  # used only for cosineannealingwarmrestarts
     train_batch_size: int = 4096
+    fused_sae_training: bool = (
+        False  # train SAEs of the same size as one stacked module with batched matmuls and a single optimizer
+    )
+    sync_free_training: bool = (
+        False  # never wait for the device during a training step, losses only reach the progress bar every wandb_log_frequency steps
+    )
 
     # Resampling protocol args
     use_ghost_grads: bool | list[bool] = (
@@ -76,10 +94,16 @@ class LanguageModelSAERunnerConfig:
     run_name: Optional[str] = None
     wandb_entity: Optional[str] = None
     wandb_log_frequency: int = 10
+    eval_tokens_path: Optional[str] = (
+        None  # save the held-out eval tokens here, or load them if the file exists
+    )
 
     # Misc
     n_checkpoints: int = 0
     checkpoint_path: str = "checkpoints"
+    async_checkpointing: bool = (
+        False  # copy checkpoints to the CPU and write (and upload) them on a background thread
+    )
     verbose: bool = True
 
     def __post_init__(self):
@@ -108,6 +132,10 @@ class LanguageModelSAERunnerConfig:
             print(
                 "Warning: We are initializing b_dec to zeros. This is probably not what you want."
             )
+        if self.sparse_decode and self.sync_free_training:
+            raise ValueError(
+                "sparse_decode can't be used with sync_free_training: it waits for the device on every step to count the active features"
+            )
 
         self.device: str | torch.device = torch.device(self.device)
 
@@ -191,6 +219,9 @@ class CacheActivationsRunnerConfig:
     total_training_tokens: int = 2_000_000
     store_batch_size: int = 32
     train_batch_size: int = 4096
+    autocast_lm: bool = (
+        False  # run the model under torch.autocast when generating activations
+    )
 
     # Misc
     device: str | torch.device = "cpu"
@@ -199,6 +230,11 @@ class CacheActivationsRunnerConfig:
     prepend_bos: bool = True
 
     # Activation caching stuff
+    shuffle_mode: Literal["index", "pairwise"] = (
+        "index"  # "index" saves a shuffled block order and leaves the data on disk untouched, "pairwise" rewrites pairs of buffers
+    )
+    shuffle_block_size: int = 1024  # rows per block when shuffling by index
+    # the rest only apply to pairwise shuffling
     shuffle_every_n_buffers: int = 10
     n_shuffles_with_last_section: int = 10
     n_shuffles_in_entire_dir: int = 10
@@ -215,6 +251,33 @@ class CacheActivationsRunnerConfig:
             )
 
 
+@dataclass
+class PretokenizeRunnerConfig:
+    """
+    Configuration for tokenizing a text dataset ahead of training.
+    """
+
+    tokenizer_name: str = "gpt2"
+    dataset_path: str = "NeelNanda/c4-10k"
+    dataset_split: str = "train"
+    column_name: str = "text"
+    context_size: int = 128
+    prepend_bos: bool = (
+        True  # start every row, and separate documents, with a BOS token
+    )
+    num_proc: int = 4  # worker processes tokenizing in parallel
+    batch_size: int = (
+        1000  # documents per tokenizer call. Each batch's last partial row is dropped
+    )
+    save_path: Optional[str] = (
+        None  # Defaults to "tokenized/{dataset}/{tokenizer}_{context_size}"
+    )
+
+    def __post_init__(self):
+        if self.save_path is None:
+            self.save_path = f"tokenized/{self.dataset_path.replace('/', '_')}/{self.tokenizer_name.replace('/', '_')}_{self.context_size}"
+
+
 def _default_cached_activations_path(
     dataset_path: str,
     model_name: str,
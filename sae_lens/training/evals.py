@@ -1,17 +1,74 @@
-from functools import partial
-from typing import Any, Mapping, cast
+import os
+from typing import Any, Mapping, NamedTuple, Optional, Sequence, cast
 
 import pandas as pd
 import torch
 from tqdm import tqdm
 from transformer_lens import HookedTransformer
-from transformer_lens.utils import get_act_name
 
 import wandb
 from sae_lens.training.activations_store import ActivationsStore
+from sae_lens.training.logit_metrics import (
+    VOCAB_CHUNK_SIZE,
+    LossDeltaHistogram,
+    kl_divergence,
+    token_losses,
+    unembed_logsumexp,
+)
 from sae_lens.training.sparse_autoencoder import SparseAutoencoder
 
 
+class EvalTokens:
+    """
+    A fixed set of held-out token batches to evaluate on. They're sampled from the
+    activation store once, before training (or loaded from `path`, if it exists), so
+    evals don't take tokens from the training stream and every eval sees the same
+    tokens. The model's final residual stream on them is computed the first time it's
+    needed and then reused, so it must be the same, frozen, model every time. The
+    residuals are kept on the CPU (pinned, when the model is on the GPU) and moved to
+    the model's device a batch at a time, so they don't hold on to its memory.
+    """
+
+    def __init__(self, batches: torch.Tensor):
+        self.batches = batches  # (n_batches, batch_size, context_size)
+        self._clean_residuals: Optional[list[torch.Tensor]] = None
+
+    @classmethod
+    def from_activation_store(
+        cls,
+        activation_store: ActivationsStore,
+        n_batches: int = 10,
+        path: Optional[str] = None,
+    ) -> "EvalTokens":
+        if path is not None and os.path.exists(path):
+            return cls(torch.load(path, weights_only=True))
+        batches = torch.stack(
+            [activation_store.get_batch_tokens() for _ in range(n_batches)]
+        )
+        if path is not None:
+            # write then rename, so an interrupted run never leaves a truncated file
+            torch.save(batches, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return cls(batches)
+
+    def __len__(self) -> int:
+        return self.batches.shape[0]
+
+    @torch.no_grad()
+    def clean_residuals(self, model: HookedTransformer) -> list[torch.Tensor]:
+        """The model's final residual on each batch, on the CPU."""
+        if self._clean_residuals is None:
+            self._clean_residuals = []
+            for batch_tokens in self.batches:
+                residual = final_residual(model, batch_tokens)
+                self._clean_residuals.append(
+                    torch.empty_like(
+                        residual, device="cpu", pin_memory=residual.is_cuda
+                    ).copy_(residual)
+                )
+        return self._clean_residuals
+
+
 @torch.no_grad()
 def run_evals(
     sparse_autoencoder: SparseAutoencoder,
@@ -19,62 +76,71 @@ def run_evals(
     model: HookedTransformer,
     n_training_steps: int,
     suffix: str = "",
+    eval_tokens: Optional[EvalTokens] = None,
 ) -> Mapping[str, Any]:
-    hook_point = sparse_autoencoder.cfg.hook_point
-    hook_point_layer = sparse_autoencoder.hook_point_layer
-    hook_point_head_index = sparse_autoencoder.cfg.hook_point_head_index
+    return run_group_evals(
+        [sparse_autoencoder],
+        activation_store,
+        model,
+        n_training_steps,
+        suffixes=[suffix],
+        eval_tokens=eval_tokens,
+    )
 
-    ### Evals
-    eval_tokens = activation_store.get_batch_tokens()
 
-    # Get Reconstruction Score
-    losses_df = recons_loss_batched(
-        sparse_autoencoder,
+@torch.no_grad()
+def run_group_evals(
+    sparse_autoencoders: Sequence[SparseAutoencoder],
+    activation_store: ActivationsStore,
+    model: HookedTransformer,
+    n_training_steps: int,
+    suffixes: Optional[Sequence[str]] = None,
+    eval_tokens: Optional[EvalTokens] = None,
+) -> Mapping[str, Any]:
+    """
+    run_evals for every SAE in a group at once, sharing the model's forward passes
+    between them. Each SAE's metrics are logged with its suffix, so the suffixes must
+    tell them apart.
+    """
+    if suffixes is None:
+        suffixes = [""] * len(sparse_autoencoders)
+
+    ### Evals
+    # Get Reconstruction Score, and the l2 norms and KL from the same forward passes
+    loss_delta_histograms = [LossDeltaHistogram() for _ in sparse_autoencoders]
+    losses_dfs = group_recons_loss_batched(
+        sparse_autoencoders,
         model,
         activation_store,
         n_batches=10,
+        eval_tokens=eval_tokens,
+        loss_delta_histograms=loss_delta_histograms,
     )
 
-    recons_score = losses_df["score"].mean()
-    ntp_loss = losses_df["loss"].mean()
-    recons_loss = losses_df["recons_loss"].mean()
-    zero_abl_loss = losses_df["zero_abl_loss"].mean()
-
-    # get cache
-    _, cache = model.run_with_cache(
-        eval_tokens,
-        prepend_bos=False,
-        names_filter=[get_act_name("pattern", hook_point_layer), hook_point],
-    )
-
-    has_head_dim_key_substrings = ["hook_q", "hook_k", "hook_v", "hook_z"]
-    if hook_point_head_index is not None:
-        original_act = cache[hook_point][:, :, hook_point_head_index]
-    elif any(substring in hook_point for substring in has_head_dim_key_substrings):
-        original_act = cache[hook_point].flatten(-2, -1)
-    else:
-        original_act = cache[hook_point]
-
-    sae_out, _, _, _, _, _ = sparse_autoencoder(original_act)
-    del cache
-
-    if "cuda" in str(model.cfg.device):
-        torch.cuda.empty_cache()
-
-    l2_norm_in = torch.norm(original_act, dim=-1)
-    l2_norm_out = torch.norm(sae_out, dim=-1)
-    l2_norm_ratio = l2_norm_out / l2_norm_in
-
-    metrics = {
-        # l2 norms
-        f"metrics/l2_norm{suffix}": l2_norm_out.mean().item(),
-        f"metrics/l2_ratio{suffix}": l2_norm_ratio.mean().item(),
-        # CE Loss
-        f"metrics/CE_loss_score{suffix}": recons_score,
-        f"metrics/ce_loss_without_sae{suffix}": ntp_loss,
-        f"metrics/ce_loss_with_sae{suffix}": recons_loss,
-        f"metrics/ce_loss_with_ablation{suffix}": zero_abl_loss,
-    }
+    metrics = {}
+    for losses_df, loss_delta_histogram, suffix in zip(
+        losses_dfs, loss_delta_histograms, suffixes
+    ):
+        recons_score = losses_df["score"].mean()
+        ntp_loss = losses_df["loss"].mean()
+        recons_loss = losses_df["recons_loss"].mean()
+        zero_abl_loss = losses_df["zero_abl_loss"].mean()
+
+        metrics.update(
+            {
+                # l2 norms
+                f"metrics/l2_norm{suffix}": losses_df["l2_norm"].mean(),
+                f"metrics/l2_ratio{suffix}": losses_df["l2_ratio"].mean(),
+                # CE Loss
+                f"metrics/CE_loss_score{suffix}": recons_score,
+                f"metrics/ce_loss_without_sae{suffix}": ntp_loss,
+                f"metrics/ce_loss_with_sae{suffix}": recons_loss,
+                f"metrics/ce_loss_with_ablation{suffix}": zero_abl_loss,
+                # downstream distribution
+                f"metrics/kl_div{suffix}": losses_df["kl_div"].mean(),
+                f"metrics/ce_loss_delta_per_token{suffix}": loss_delta_histogram.to_wandb(),
+            }
+        )
 
     if wandb.run is not None:
         wandb.log(
@@ -90,27 +156,99 @@ def recons_loss_batched(
     model: HookedTransformer,
     activation_store: ActivationsStore,
     n_batches: int = 100,
+    eval_tokens: Optional[EvalTokens] = None,
 ):
-    losses = []
-    for _ in tqdm(range(n_batches)):
-        batch_tokens = activation_store.get_batch_tokens()
-        score, loss, recons_loss, zero_abl_loss = get_recons_loss(
-            sparse_autoencoder, model, batch_tokens
+    """
+    The reconstruction metrics on n_batches fresh batches from the activation store, or
+    on eval_tokens if given, reusing their clean residuals.
+    """
+    return group_recons_loss_batched(
+        [sparse_autoencoder],
+        model,
+        activation_store,
+        n_batches=n_batches,
+        eval_tokens=eval_tokens,
+    )[0]
+
+
+def group_recons_loss_batched(
+    sparse_autoencoders: Sequence[SparseAutoencoder],
+    model: HookedTransformer,
+    activation_store: ActivationsStore,
+    n_batches: int = 100,
+    eval_tokens: Optional[EvalTokens] = None,
+    loss_delta_histograms: Optional[Sequence[LossDeltaHistogram]] = None,
+) -> list[pd.DataFrame]:
+    """
+    recons_loss_batched for every SAE in a group, one DataFrame each, on the same
+    batches. Each SAE's per token loss deltas are added to its histogram in
+    loss_delta_histograms, if given.
+    """
+    if eval_tokens is None:
+        batches = (activation_store.get_batch_tokens() for _ in range(n_batches))
+        clean_residuals: list[Optional[torch.Tensor]] = [None] * n_batches
+    else:
+        batches = eval_tokens.batches
+        clean_residuals = list(eval_tokens.clean_residuals(model))
+
+    losses: list[list[tuple[float, ...]]] = [[] for _ in sparse_autoencoders]
+    for batch_tokens, clean_residual in tqdm(
+        zip(batches, clean_residuals), total=len(clean_residuals)
+    ):
+        if clean_residual is not None:
+            clean_residual = clean_residual.to(model.cfg.device, non_blocking=True)
+        group_recons_metrics = get_group_recons_metrics(
+            sparse_autoencoders, model, batch_tokens, clean_residual=clean_residual
         )
-        losses.append(
-            (
-                score.mean().item(),
-                loss.mean().item(),
-                recons_loss.mean().item(),
-                zero_abl_loss.mean().item(),
+        for i, recons_metrics in enumerate(group_recons_metrics):
+            if loss_delta_histograms is not None:
+                loss_delta_histograms[i].update(recons_metrics.loss_delta)
+            losses[i].append(
+                (
+                    recons_metrics.score.mean().item(),
+                    recons_metrics.loss.mean().item(),
+                    recons_metrics.recons_loss.mean().item(),
+                    recons_metrics.zero_abl_loss.mean().item(),
+                    recons_metrics.l2_norm_out.mean().item(),
+                    (recons_metrics.l2_norm_out / recons_metrics.l2_norm_in)
+                    .mean()
+                    .item(),
+                    recons_metrics.kl_div.mean().item(),
+                )
             )
+
+    return [
+        pd.DataFrame(
+            sae_losses,
+            columns=cast(
+                Any,
+                [
+                    "score",
+                    "loss",
+                    "recons_loss",
+                    "zero_abl_loss",
+                    "l2_norm",
+                    "l2_ratio",
+                    "kl_div",
+                ],
+            ),
         )
+        for sae_losses in losses
+    ]
 
-    losses = pd.DataFrame(
-        losses, columns=cast(Any, ["score", "loss", "recons_loss", "zero_abl_loss"])
-    )
 
-    return losses
+class ReconsMetrics(NamedTuple):
+    score: torch.Tensor
+    loss: torch.Tensor
+    recons_loss: torch.Tensor
+    zero_abl_loss: torch.Tensor
+    # the norms of the SAE's input and output at every position
+    l2_norm_in: torch.Tensor
+    l2_norm_out: torch.Tensor
+    # KL(clean || spliced) at every position, and the spliced - clean loss at every
+    # position but the last
+    kl_div: torch.Tensor
+    loss_delta: torch.Tensor
 
 
 @torch.no_grad()
@@ -119,54 +257,252 @@ def get_recons_loss(
     model: HookedTransformer,
     batch_tokens: torch.Tensor,
 ):
-    hook_point = sparse_autoencoder.cfg.hook_point
-    loss = model(batch_tokens, return_type="loss")
-    head_index = sparse_autoencoder.cfg.hook_point_head_index
+    recons_metrics = get_recons_metrics(sparse_autoencoder, model, batch_tokens)
+    return (
+        recons_metrics.score,
+        recons_metrics.loss,
+        recons_metrics.recons_loss,
+        recons_metrics.zero_abl_loss,
+    )
 
-    def standard_replacement_hook(activations: torch.Tensor, hook: Any):
-        activations = sparse_autoencoder.forward(activations).sae_out.to(
-            activations.dtype
-        )
-        return activations
 
-    def all_head_replacement_hook(activations: torch.Tensor, hook: Any):
-        new_activations = sparse_autoencoder.forward(
-            activations.flatten(-2, -1)
-        ).sae_out.to(activations.dtype)
-        new_activations = new_activations.reshape(
-            activations.shape
-        )  # reshape to match original shape
-        return new_activations
-
-    def single_head_replacement_hook(activations: torch.Tensor, hook: Any):
-        new_activations = sparse_autoencoder.forward(
-            activations[:, :, head_index]
-        ).sae_out.to(activations.dtype)
-        activations[:, :, head_index] = new_activations
-        return activations
+@torch.no_grad()
+def get_recons_metrics(
+    sparse_autoencoder: SparseAutoencoder,
+    model: HookedTransformer,
+    batch_tokens: torch.Tensor,
+) -> ReconsMetrics:
+    """
+    The model's loss on batch_tokens as is, with the SAE spliced in at its hook point and
+    with the hook point zero ablated, from a single forward pass. See
+    get_group_recons_metrics.
+    """
+    return get_group_recons_metrics([sparse_autoencoder], model, batch_tokens)[0]
 
-    has_head_dim_key_substrings = ["hook_q", "hook_k", "hook_v", "hook_z"]
-    if any(substring in hook_point for substring in has_head_dim_key_substrings):
-        if head_index is None:
-            replacement_hook = all_head_replacement_hook
+
+@torch.no_grad()
+def get_group_recons_metrics(
+    sparse_autoencoders: Sequence[SparseAutoencoder],
+    model: HookedTransformer,
+    batch_tokens: torch.Tensor,
+    max_copies_per_pass: Optional[int] = 8,
+    clean_residual: Optional[torch.Tensor] = None,
+    vocab_chunk_size: int = VOCAB_CHUNK_SIZE,
+) -> list[ReconsMetrics]:
+    """
+    get_recons_metrics for every SAE in a group, sharing the forward passes.
+
+    The layers before the earliest hook point are run once. The rest of the model is run
+    on copies of the batch stacked along the batch dim: one left alone for the clean
+    loss, one per SAE with it spliced in at its hook point, and one per hook point zero
+    ablated, shared by all the SAEs there. The hook at each hook point only touches its
+    own copies, so every copy reaches its hook point unchanged.
+
+    The passes stop at the final residual stream, and the losses and KL(clean || spliced)
+    are computed from it vocab_chunk_size logits at a time (see logit_metrics), so the
+    logits of the copies are never materialized. Pass the model's final residual on
+    batch_tokens (see final_residual), if already known, to skip the clean copy.
+
+    At most max_copies_per_pass copies go through the model together, more take several
+    passes over the shared prefix, which bounds the memory a large group needs.
+    """
+    hook_points = list(dict.fromkeys(sae.cfg.hook_point for sae in sparse_autoencoders))
+    # the hook point each copy is intervened on, and the SAE spliced in there. The
+    # clean copy has neither and the ablated ones have no SAE.
+    copies: list[tuple[Optional[str], Optional[int]]] = []
+    if clean_residual is None:
+        copies.append((None, None))
+    copies += [(sae.cfg.hook_point, i) for i, sae in enumerate(sparse_autoencoders)]
+    copies += [(hook_point, None) for hook_point in hook_points]
+
+    # each hook point is in block hook_point_layer, so everything before the earliest of
+    # those blocks is the same for all copies
+    layer = min(sae.hook_point_layer for sae in sparse_autoencoders)
+    shares_prefix = all(
+        sae.cfg.hook_point.startswith(f"blocks.{sae.hook_point_layer}.")
+        for sae in sparse_autoencoders
+    )
+    residual: Optional[torch.Tensor] = None
+    pos_embed = {}
+    if shares_prefix:
+        prefix_hooks = []
+        if model.cfg.positional_embedding_type == "shortformer":
+
+            def save_pos_embed(pos_embed_act: torch.Tensor, hook: Any):
+                pos_embed["act"] = pos_embed_act
+
+            prefix_hooks.append(("hook_pos_embed", save_pos_embed))
+        residual = model.run_with_hooks(
+            batch_tokens, stop_at_layer=layer, fwd_hooks=prefix_hooks
+        )
+
+    l2_norms: dict[int, tuple[torch.Tensor, torch.Tensor]] = {}
+    pass_size = max_copies_per_pass or len(copies)
+    pass_final_residuals = []
+    for pass_start in range(0, len(copies), pass_size):
+        pass_copies = copies[pass_start : pass_start + pass_size]
+        n_copies = len(pass_copies)
+        fwd_hooks: list[Any] = [
+            (
+                hook_point,
+                _intervention_hook(
+                    sparse_autoencoders, pass_copies, hook_point, l2_norms
+                ),
+            )
+            for hook_point in dict.fromkeys(
+                hook_point for hook_point, _ in pass_copies if hook_point is not None
+            )
+        ]
+        # last, so it sees the interventions if one is at the same hook point
+        save_final_residual = _SaveFinalResidual(model)
+        fwd_hooks.append((save_final_residual.hook_point, save_final_residual))
+        if residual is not None:
+            model.run_with_hooks(
+                residual.repeat(n_copies, 1, 1),
+                start_at_layer=layer,
+                tokens=batch_tokens.repeat(n_copies, 1),
+                shortformer_pos_embed=(
+                    pos_embed["act"].repeat(n_copies, 1, 1)
+                    if "act" in pos_embed
+                    else None
+                ),
+                return_type=None,
+                fwd_hooks=fwd_hooks,
+            )
         else:
-            replacement_hook = single_head_replacement_hook
-    else:
-        replacement_hook = standard_replacement_hook
+            # a hook point outside the blocks, so there's no prefix to share
+            model.run_with_hooks(
+                batch_tokens.repeat(n_copies, 1),
+                return_type=None,
+                fwd_hooks=fwd_hooks,
+            )
+        pass_final_residuals.append(
+            save_final_residual.residual.unflatten(0, (n_copies, -1))
+        )
+    final_residuals = torch.cat(pass_final_residuals)
+
+    if clean_residual is None:
+        clean_residual, final_residuals = final_residuals[0], final_residuals[1:]
+    lses = torch.stack(
+        [
+            unembed_logsumexp(model, final_residual, vocab_chunk_size)
+            for final_residual in final_residuals
+        ]
+    )
+    losses = torch.stack(
+        [
+            token_losses(model, final_residual, batch_tokens, lse)
+            for final_residual, lse in zip(final_residuals, lses)
+        ]
+    )
+    n_saes = len(sparse_autoencoders)
+    clean_lse = unembed_logsumexp(model, clean_residual, vocab_chunk_size)
+    clean_losses = token_losses(model, clean_residual, batch_tokens, clean_lse)
+    loss = clean_losses.mean()
+    kl_divs = kl_divergence(
+        model,
+        clean_residual,
+        clean_lse,
+        final_residuals[:n_saes],
+        lses[:n_saes],
+        vocab_chunk_size,
+    )
+    loss_deltas = losses[:n_saes] - clean_losses
+    losses = losses.flatten(1).mean(dim=-1)
+    recons_losses = losses[:n_saes]
+    zero_abl_losses = dict(zip(hook_points, losses[n_saes:]))
+
+    group_recons_metrics = []
+    for i, sae in enumerate(sparse_autoencoders):
+        recons_loss = recons_losses[i]
+        zero_abl_loss = zero_abl_losses[sae.cfg.hook_point]
+        score = (zero_abl_loss - recons_loss) / (zero_abl_loss - loss)
+        group_recons_metrics.append(
+            ReconsMetrics(
+                score=score,
+                loss=loss,
+                recons_loss=recons_loss,
+                zero_abl_loss=zero_abl_loss,
+                l2_norm_in=l2_norms[i][0],
+                l2_norm_out=l2_norms[i][1],
+                kl_div=kl_divs[i],
+                loss_delta=loss_deltas[i],
+            )
+        )
+    return group_recons_metrics
 
-    recons_loss = model.run_with_hooks(
+
+@torch.no_grad()
+def final_residual(
+    model: HookedTransformer, batch_tokens: torch.Tensor
+) -> torch.Tensor:
+    """
+    The model's final residual stream on batch_tokens, after ln_final, which is all
+    the metrics in logit_metrics need.
+    """
+    save_final_residual = _SaveFinalResidual(model)
+    model.run_with_hooks(
         batch_tokens,
-        return_type="loss",
-        fwd_hooks=[(hook_point, partial(replacement_hook))],
+        return_type=None,
+        fwd_hooks=[(save_final_residual.hook_point, save_final_residual)],
     )
+    return save_final_residual.residual
 
-    zero_abl_loss = model.run_with_hooks(
-        batch_tokens, return_type="loss", fwd_hooks=[(hook_point, zero_ablate_hook)]
+
+class _SaveFinalResidual:
+    def __init__(self, model: HookedTransformer):
+        self.model = model
+        self.hook_point = f"blocks.{model.cfg.n_layers - 1}.hook_resid_post"
+        self.residual = torch.empty(0)
+
+    def __call__(self, residual: torch.Tensor, hook: Any):
+        if self.model.cfg.normalization_type is not None:
+            self.residual = self.model.ln_final(residual)
+        else:
+            self.residual = residual
+
+
+def _intervention_hook(
+    sparse_autoencoders: Sequence[SparseAutoencoder],
+    copies: list[tuple[Optional[str], Optional[int]]],
+    hook_point: str,
+    l2_norms: dict[int, tuple[torch.Tensor, torch.Tensor]],
+):
+    has_head_dim_key_substrings = ["hook_q", "hook_k", "hook_v", "hook_z"]
+    has_head_dim = any(
+        substring in hook_point for substring in has_head_dim_key_substrings
     )
 
-    score = (zero_abl_loss - recons_loss) / (zero_abl_loss - loss)
+    def intervention_hook(activations: torch.Tensor, hook: Any):
+        for copy, (copy_hook_point, sae_index) in zip(
+            activations.chunk(len(copies)), copies
+        ):
+            if copy_hook_point != hook_point:
+                continue
+            if sae_index is None:
+                copy.zero_()
+                continue
+            sae = sparse_autoencoders[sae_index]
+            head_index = sae.cfg.hook_point_head_index
+            if has_head_dim and head_index is not None:
+                original_act = copy[:, :, head_index]
+            elif has_head_dim:
+                original_act = copy.flatten(-2, -1)
+            else:
+                original_act = copy
+            sae_out = sae.reconstruct(original_act)
+            l2_norms[sae_index] = (
+                torch.norm(original_act, dim=-1),
+                torch.norm(sae_out, dim=-1),
+            )
+            # copy is a view of activations, so this writes into them
+            if has_head_dim and head_index is not None:
+                copy[:, :, head_index] = sae_out.to(activations.dtype)
+            else:
+                copy.copy_(sae_out.reshape(copy.shape))
+        return activations
 
-    return score, loss, recons_loss, zero_abl_loss
+    return intervention_hook
 
 
 def zero_ablate_hook(activations: torch.Tensor, hook: Any):
@@ -0,0 +1,182 @@
+import torch
+from torch import nn
+
+from sae_lens.training.sparse_autoencoder import ForwardOutput, SparseAutoencoder
+
+
+class FusedSAEGroup(nn.Module):
+    """
+    Several SAEs of the same shape trained as one module: their weights are stacked along
+    a leading `n_saes` dimension and every forward / backward pass is a batched matmul
+    instead of one small kernel per SAE.
+
+    The member SAEs' parameters are re-pointed at their slice of the stacked weights, so
+    they always see the current weights (for evals, checkpoints etc.) without any copying.
+    Anything that replaces a member parameter's `.data` (e.g. the `initialize_b_dec_*`
+    methods) breaks that link, so build the group after initializing the SAEs.
+
+    Members may differ in their hook layer, l1 coefficient, lp norm, ghost grads and
+    dead feature window. Outputs are stacked the same way: `sae_out` is
+    (n_saes, batch, d_in), and the losses are one value per member.
+    """
+
+    def __init__(self, saes: list[SparseAutoencoder]):
+        super().__init__()
+        assert len(saes) > 0, "a FusedSAEGroup needs at least one SAE"
+        first = saes[0]
+        for sae in saes:
+            assert (sae.d_in, sae.d_sae, sae.dtype) == (
+                first.d_in,
+                first.d_sae,
+                first.dtype,
+            ), "all SAEs in a FusedSAEGroup must have the same d_in, d_sae and dtype"
+        self.saes = saes
+        self.d_in = first.d_in
+        self.d_sae = first.d_sae
+        self.dtype = first.dtype
+        self.device = first.W_enc.device
+        self.sync_free_training = first.cfg.sync_free_training
+
+        with torch.no_grad():
+            self.W_enc = nn.Parameter(torch.stack([sae.W_enc for sae in saes]))
+            self.b_enc = nn.Parameter(torch.stack([sae.b_enc for sae in saes]))
+            self.W_dec = nn.Parameter(torch.stack([sae.W_dec for sae in saes]))
+            self.b_dec = nn.Parameter(torch.stack([sae.b_dec for sae in saes]))
+        for i, sae in enumerate(saes):
+            sae.W_enc.data = self.W_enc.data[i]
+            sae.b_enc.data = self.b_enc.data[i]
+            sae.W_dec.data = self.W_dec.data[i]
+            sae.b_dec.data = self.b_dec.data[i]
+
+        self.lp_norms = [sae.lp_norm for sae in saes]
+        self.register_buffer(
+            "l1_coefficients",
+            torch.tensor(
+                [sae.l1_coefficient for sae in saes],
+                dtype=self.dtype,
+                device=self.device,
+            ),
+        )
+        self.register_buffer(
+            "use_ghost_grads",
+            torch.tensor([sae.use_ghost_grads for sae in saes], device=self.device),
+        )
+        self.register_buffer(
+            "dead_feature_windows",
+            torch.tensor(
+                [sae.cfg.dead_feature_window for sae in saes], device=self.device
+            ),
+        )
+
+    def __len__(self):
+        return len(self.saes)
+
+    def forward(
+        self, x: torch.Tensor, dead_neuron_mask: torch.Tensor | None = None
+    ) -> ForwardOutput:
+        """
+        x is (n_saes, batch, d_in), each member's input. dead_neuron_mask, if given,
+        is (n_saes, d_sae).
+        """
+        x = x.to(self.dtype)
+        sae_in = x - self.b_dec[:, None, :]
+        hidden_pre = torch.baddbmm(self.b_enc[:, None, :], sae_in, self.W_enc)
+        feature_acts = torch.nn.functional.relu(hidden_pre)
+        sae_out = torch.baddbmm(self.b_dec[:, None, :], feature_acts, self.W_dec)
+
+        per_item_mse_loss = _per_item_mse_loss_with_target_norm(sae_out, x)
+        ghost_grad_loss = torch.zeros(len(self), dtype=self.dtype, device=self.device)
+        # one check for the whole group, rather than one per member. Members without
+        # dead neurons get no ghost grad loss anyway, so in sync free mode skip the check.
+        if (
+            self.training
+            and dead_neuron_mask is not None
+            and any(sae.use_ghost_grads for sae in self.saes)
+            and (self.sync_free_training or dead_neuron_mask.any())
+        ):
+            ghost_grad_loss = self.calculate_ghost_grad_loss(
+                x=x,
+                sae_out=sae_out,
+                per_item_mse_loss=per_item_mse_loss,
+                hidden_pre=hidden_pre,
+                dead_neuron_mask=dead_neuron_mask & self.use_ghost_grads[:, None],
+            )
+
+        mse_loss = per_item_mse_loss.mean(dim=(1, 2))
+        if len(set(self.lp_norms)) == 1:
+            sparsity = feature_acts.norm(p=self.lp_norms[0], dim=-1).mean(dim=1)
+        else:
+            sparsity = torch.stack(
+                [
+                    acts.norm(p=lp_norm, dim=-1).mean()
+                    for acts, lp_norm in zip(feature_acts, self.lp_norms)
+                ]
+            )
+        l1_loss = self.l1_coefficients * sparsity
+        loss = mse_loss + l1_loss + ghost_grad_loss
+
+        return ForwardOutput(
+            sae_out=sae_out,
+            feature_acts=feature_acts,
+            loss=loss,
+            mse_loss=mse_loss,
+            l1_loss=l1_loss,
+            ghost_grad_loss=ghost_grad_loss,
+        )
+
+    def calculate_ghost_grad_loss(
+        self,
+        x: torch.Tensor,
+        sae_out: torch.Tensor,
+        per_item_mse_loss: torch.Tensor,
+        hidden_pre: torch.Tensor,
+        dead_neuron_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        # same as SparseAutoencoder.calculate_ghost_grad_loss, but members have different
+        # numbers of dead neurons, so rather than selecting them we give live neurons a
+        # pre-activation of -inf, which exp sends to exactly 0.
+        residual = x - sae_out
+        l2_norm_residual = torch.norm(residual, dim=-1)
+
+        feature_acts_dead_neurons_only = torch.exp(
+            hidden_pre.masked_fill(~dead_neuron_mask[:, None, :], float("-inf"))
+        )
+        ghost_out = torch.bmm(feature_acts_dead_neurons_only, self.W_dec)
+        l2_norm_ghost_out = torch.norm(ghost_out, dim=-1)
+        norm_scaling_factor = l2_norm_residual / (1e-6 + l2_norm_ghost_out * 2)
+        ghost_out = ghost_out * norm_scaling_factor[..., None].detach()
+
+        per_item_mse_loss_ghost_resid = _per_item_mse_loss_with_target_norm(
+            ghost_out, residual.detach()
+        )
+        mse_rescaling_factor = (
+            per_item_mse_loss / (per_item_mse_loss_ghost_resid + 1e-6)
+        ).detach()
+        per_item_mse_loss_ghost_resid = (
+            mse_rescaling_factor * per_item_mse_loss_ghost_resid
+        )
+
+        # members without dead neurons (or ghost grads) get no ghost grad loss
+        has_dead_neurons = dead_neuron_mask.any(dim=-1)
+        return per_item_mse_loss_ghost_resid.mean(dim=(1, 2)) * has_dead_neurons
+
+    @torch.no_grad()
+    def set_decoder_norm_to_unit_norm(self):
+        self.W_dec.data /= torch.norm(self.W_dec.data, dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def remove_gradient_parallel_to_decoder_directions(self):
+        assert self.W_dec.grad is not None  # keep pyright happy
+        parallel_component = (self.W_dec.grad * self.W_dec.data).sum(
+            dim=-1, keepdim=True
+        )
+        self.W_dec.grad -= parallel_component * self.W_dec.data
+
+
+def _per_item_mse_loss_with_target_norm(
+    preds: torch.Tensor, target: torch.Tensor
+) -> torch.Tensor:
+    # the batch is dim 1 here, after the members
+    target_centered = target - target.mean(dim=1, keepdim=True)
+    normalization = target_centered.norm(dim=-1, keepdim=True)
+    return torch.nn.functional.mse_loss(preds, target, reduction="none") / normalization
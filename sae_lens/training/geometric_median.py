@@ -86,6 +86,133 @@ def compute_geometric_median(
     )
 
 
+@torch.no_grad()
+def compute_approximate_geometric_median(
+    points: torch.Tensor,
+    weights: Optional[torch.Tensor] = None,
+    eps: float = 1e-6,
+    maxiter: int = 100,
+    ftol: float = 1e-20,
+    max_points: Optional[int] = 2**16,
+    chunk_size: int = 2**14,
+    init_median: Optional[torch.Tensor] = None,
+    generator: Optional[torch.Generator] = None,
+    do_log: bool = False,
+):
+    """
+    A faster `compute_geometric_median` for large sets of points, e.g. a whole
+    activation buffer:
+        - Only a random subsample of `max_points` points is used (None to use them all).
+        - Points are visited `chunk_size` rows at a time, so no temporary is ever the
+          size of `points`, and `points` can be a strided view (or a lower precision
+          dtype) without being copied up front.
+        - Each Weiszfeld iteration is a single pass: the distances to the current
+          median give both its objective value and the next median.
+        - `init_median` warm starts the iterations, e.g. from a previously computed
+          median of similar points. Defaults to the weighted mean.
+        - Points of shape ``(n, k, d)`` are k sets of points, e.g. the activations of k
+          layers, whose k medians are computed together in the same passes.
+
+    :param points: ``torch.Tensor`` of shape ``(n, d)`` or ``(n, k, d)``
+    :param weights: Optional ``torch.Tensor`` of shape :math:``(n,)``.
+    :param eps: Smallest allowed value of denominator, to avoid divide by zero.
+        Equivalently, this is a smoothing parameter. Default 1e-6.
+    :param maxiter: Maximum number of Weiszfeld iterations. Default 100
+    :param ftol: If objective value does not improve by at least this `ftol` fraction (for every set of points), terminate the algorithm. Default 1e-20.
+    :param max_points: Number of points to subsample, None to use all of them. Default 2**16.
+    :param chunk_size: Number of points to process at once. Default 2**14.
+    :param init_median: Optional ``torch.Tensor`` of shape :math:``(d,)`` (or :math:``(k, d)``) to start from.
+    :param generator: Optional ``torch.Generator`` for the subsampling.
+    :param do_log: If true will return a log of function values encountered through the course of the algorithm
+    :return: SimpleNamespace object with fields
+        - `median`: estimate of the geometric median, a float32 ``torch.Tensor`` of shape :math:``(d,)`` (or :math:``(k, d)``)
+        - `termination`: string explaining how the algorithm terminated.
+        - `logs`: function values encountered through the course of the algorithm in a list (None if do_log is false).
+    """
+    single_set = points.ndim == 2
+    if single_set:
+        points = points.unsqueeze(1)
+        if init_median is not None:
+            init_median = init_median.unsqueeze(0)
+    if max_points is not None and points.shape[0] > max_points:
+        sample = torch.randperm(points.shape[0], generator=generator)[:max_points]
+        sample = sample.to(points.device)
+        points = points[sample]
+        if weights is not None:
+            weights = weights[sample]
+    if weights is None:
+        weights = torch.ones((points.shape[0],), device=points.device)
+    weights = weights.float()
+    _, n_sets, d = points.shape
+
+    def weiszfeld_pass(
+        median: torch.Tensor | None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        # the objective values at median, and the next median. With no median, the
+        # weighted mean.
+        objective_value = torch.zeros(n_sets, device=points.device)
+        weighted_sum = torch.zeros(n_sets, d, device=points.device)
+        weight_sum = torch.zeros(n_sets, device=points.device)
+        for chunk, chunk_weights in zip(
+            points.split(chunk_size), weights.split(chunk_size)
+        ):
+            chunk = chunk.float()
+            chunk_weights = chunk_weights[:, None].expand(-1, n_sets)
+            if median is not None:
+                norms = torch.linalg.norm(chunk - median, dim=-1)
+                objective_value += (norms * chunk_weights).sum(dim=0)
+                chunk_weights = chunk_weights / torch.clamp(norms, min=eps)
+            weighted_sum += torch.einsum("nk,nkd->kd", chunk_weights, chunk)
+            weight_sum += chunk_weights.sum(dim=0)
+        return objective_value, weighted_sum / weight_sum[:, None]
+
+    if init_median is None:
+        _, median = weiszfeld_pass(None)
+    else:
+        median = init_median.to(device=points.device, dtype=torch.float32)
+    objective_value, next_median = weiszfeld_pass(median)
+    logs = [objective_value] if do_log else None
+
+    # Weiszfeld iterations
+    early_termination = False
+    pbar = tqdm.tqdm(range(maxiter))
+    for _ in pbar:
+        prev_obj_value = objective_value
+        next_objective_value, following_median = weiszfeld_pass(next_median)
+        # stop at the better of the two medians if we've converged
+        converged = (
+            prev_obj_value - next_objective_value
+        ).abs() <= ftol * next_objective_value
+        if converged.all():
+            improved = next_objective_value <= prev_obj_value
+            median = torch.where(improved[:, None], next_median, median)
+            early_termination = True
+            break
+        median, objective_value = next_median, next_objective_value
+        next_median = following_median
+
+        if logs is not None:
+            logs.append(objective_value)
+        pbar.set_description(f"Objective value: {objective_value.sum():.4f}")
+    if not early_termination:
+        # each iteration improves on the last
+        median = next_median
+
+    if single_set:
+        median = median[0]
+        if logs is not None:
+            logs = [value[0] for value in logs]
+    return SimpleNamespace(
+        median=median,
+        termination=(
+            "function value converged within tolerance"
+            if early_termination
+            else "maximum iterations reached"
+        ),
+        logs=logs,
+    )
+
+
 if __name__ == "__main__":
     import time
 
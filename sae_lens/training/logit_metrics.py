@@ -0,0 +1,118 @@
+"""
+Metrics on a model's output distribution, computed from its final (normalized) residual
+stream a chunk of the vocab at a time, so the full logits of a batch are never
+materialized and nothing leaves the device until it's summarized.
+"""
+
+from typing import Optional
+
+import numpy as np
+import torch
+from transformer_lens import HookedTransformer
+
+import wandb
+
+VOCAB_CHUNK_SIZE = 4096
+
+
+def _logits(
+    model: HookedTransformer, residual: torch.Tensor, vocab_slice: slice
+) -> torch.Tensor:
+    return (
+        residual.float() @ model.W_U[:, vocab_slice].float()
+        + model.b_U[vocab_slice].float()
+    )
+
+
+@torch.no_grad()
+def unembed_logsumexp(
+    model: HookedTransformer,
+    residual: torch.Tensor,
+    vocab_chunk_size: int = VOCAB_CHUNK_SIZE,
+) -> torch.Tensor:
+    """
+    The logsumexp of the logits at every position of residual (..., d_model), in fp32.
+    """
+    lse = torch.full(residual.shape[:-1], -torch.inf, device=residual.device)
+    for start in range(0, model.cfg.d_vocab_out, vocab_chunk_size):
+        chunk_logits = _logits(model, residual, slice(start, start + vocab_chunk_size))
+        lse = torch.logaddexp(lse, chunk_logits.logsumexp(dim=-1))
+    return lse
+
+
+@torch.no_grad()
+def token_losses(
+    model: HookedTransformer,
+    residual: torch.Tensor,
+    tokens: torch.Tensor,
+    lse: torch.Tensor,
+) -> torch.Tensor:
+    """
+    The next token cross entropy loss at every position but the last, like the model's
+    loss_per_token, from residual (batch, pos, d_model) and its logsumexp.
+    """
+    next_tokens = tokens[:, 1:]
+    target_logits = (residual[:, :-1].float() * model.W_U.T[next_tokens].float()).sum(
+        dim=-1
+    ) + model.b_U[next_tokens].float()
+    return lse[:, :-1] - target_logits
+
+
+@torch.no_grad()
+def kl_divergence(
+    model: HookedTransformer,
+    clean_residual: torch.Tensor,
+    clean_lse: torch.Tensor,
+    residuals: torch.Tensor,
+    lses: torch.Tensor,
+    vocab_chunk_size: int = VOCAB_CHUNK_SIZE,
+) -> torch.Tensor:
+    """
+    KL(clean || other) at every position, for each of the other residuals stacked along
+    the first dim of residuals, with their logsumexps stacked in lses.
+
+    With p = softmax(clean_logits), sum_v p_v (log p_v - log q_v) is
+    sum_v p_v (clean_logits_v - logits_v) + lse - clean_lse, so one pass over the vocab
+    is enough and the clean logits of each chunk are shared between all the others.
+    """
+    cross = torch.zeros(lses.shape, device=residuals.device)
+    for start in range(0, model.cfg.d_vocab_out, vocab_chunk_size):
+        vocab_slice = slice(start, start + vocab_chunk_size)
+        clean_logits = _logits(model, clean_residual, vocab_slice)
+        clean_probs = (clean_logits - clean_lse.unsqueeze(-1)).exp()
+        for i, residual in enumerate(residuals):
+            logits = _logits(model, residual, vocab_slice)
+            cross[i] += (clean_probs * (clean_logits - logits)).sum(dim=-1)
+    return cross + lses - clean_lse
+
+
+class LossDeltaHistogram:
+    """
+    Counts of per token loss deltas (loss with the SAE - clean loss) in n_bins equal bins
+    between min and max, accumulated on the device across batches. Deltas outside the
+    range are counted in the end bins.
+    """
+
+    def __init__(
+        self,
+        min: float = -1.0,
+        max: float = 4.0,
+        n_bins: int = 100,
+        device: Optional[str | torch.device] = None,
+    ):
+        self.min = min
+        self.max = max
+        self.counts = torch.zeros(n_bins, device=device)
+
+    def update(self, loss_deltas: torch.Tensor):
+        self.counts = self.counts.to(loss_deltas.device)
+        self.counts += torch.histc(
+            loss_deltas.float().clamp(self.min, self.max),
+            bins=self.counts.shape[0],
+            min=self.min,
+            max=self.max,
+        )
+
+    def to_wandb(self) -> wandb.Histogram:
+        bin_edges = np.linspace(self.min, self.max, self.counts.shape[0] + 1)
+        return wandb.Histogram(np_histogram=(self.counts.cpu().numpy(), bin_edges))
@@ -2,6 +2,10 @@
 Took the LR scheduler from my previous work: https://github.com/jbloomAus/DecisionTransformerInterpretability/blob/ee55df35cdb92e81d689c72fb9dd5a7252893363/src/decision_transformer/utils.py#L425
 """
 
+import math
+from typing import Iterable
+
+import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 
@@ -96,3 +100,75 @@ def _get_main_scheduler(
         )
     else:
         raise ValueError(f"Unsupported scheduler: {scheduler_name}")
+
+
+class LearningRateHolder(optim.Optimizer):
+    """
+    An optimizer with no parameters, which only holds a learning rate for a scheduler to
+    update. Lets each member of a StackedAdam keep its own `get_scheduler` schedule.
+    """
+
+    def __init__(self, lr: float):
+        super().__init__([torch.zeros(0)], dict(lr=lr))
+
+    def step(self, closure: None = None) -> None:  # type: ignore
+        pass
+
+
+class StackedAdam(optim.Optimizer):
+    """
+    Adam over parameters that stack `n` independent members along their first dimension,
+    such as the weights of a FusedSAEGroup. Each step updates every member at once, with
+    member `i` using `lr_holders[i]`'s current learning rate. Otherwise it matches
+    `torch.optim.Adam` with its defaults.
+    """
+
+    def __init__(
+        self,
+        params: Iterable[torch.Tensor],
+        lr_holders: list[LearningRateHolder],
+        betas: tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+    ):
+        super().__init__(params, dict(betas=betas, eps=eps))
+        self.lr_holders = lr_holders
+        self._lrs: list[float] = []
+        self._lrs_on_device: dict[tuple[torch.device, torch.dtype], torch.Tensor] = {}
+
+    @torch.no_grad()
+    def step(self, closure: None = None) -> None:  # type: ignore
+        lrs = [holder.param_groups[0]["lr"] for holder in self.lr_holders]
+        if lrs != self._lrs:
+            # only copy the lrs to the device when a scheduler changed them
+            self._lrs = lrs
+            self._lrs_on_device = {}
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+                state = self.state[param]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(param)
+                    state["exp_avg_sq"] = torch.zeros_like(param)
+                state["step"] += 1
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+                exp_avg.lerp_(param.grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2_sqrt = math.sqrt(1 - beta2 ** state["step"])
+                denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(group["eps"])
+                key = (param.device, param.dtype)
+                if key not in self._lrs_on_device:
+                    self._lrs_on_device[key] = torch.tensor(
+                        lrs, dtype=param.dtype, device=param.device
+                    )
+                step_size = (self._lrs_on_device[key] / -bias_correction1).view(
+                    -1, *[1] * (param.ndim - 1)
+                )
+                param.add_(exp_avg / denom * step_size)
+        # keep the schedulers from warning that they stepped before their optimizer
+        for holder in self.lr_holders:
+            holder.step()
@@ -0,0 +1,82 @@
+from typing import Any, cast
+
+from datasets import Dataset, load_dataset
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from sae_lens.training.config import PretokenizeRunnerConfig
+
+
+def pretokenize_runner(
+    cfg: PretokenizeRunnerConfig, dataset: Dataset | None = None
+) -> Dataset:
+    """
+    Tokenize a text dataset with a pool of worker processes and save it, packed into rows
+    of exactly `context_size` tokens, to `cfg.save_path`. Passing that path as the
+    `dataset_path` of a LanguageModelSAERunnerConfig lets the ActivationsStore read the
+    (memory-mapped) tokens directly, with no tokenization during training.
+
+    Each batch of `cfg.batch_size` documents is packed on its own, so the tokens at the
+    end of a batch that don't fill a row are dropped: at most context_size - 1 tokens
+    per batch.
+    """
+    assert cfg.save_path is not None  # keep pyright happy
+    tokenizer = AutoTokenizer.from_pretrained(cfg.tokenizer_name)
+    bos_token_id = None
+    if cfg.prepend_bos:
+        bos_token_id = tokenizer.bos_token_id
+        if bos_token_id is None:
+            raise ValueError(
+                f"prepend_bos is set, but the {cfg.tokenizer_name} tokenizer has no BOS token"
+            )
+    if dataset is None:
+        loaded_dataset = load_dataset(cfg.dataset_path, split=cfg.dataset_split)
+        assert isinstance(loaded_dataset, Dataset)
+        dataset = loaded_dataset
+
+    tokenized_dataset = dataset.map(
+        _tokenize_and_pack,
+        batched=True,
+        batch_size=cfg.batch_size,
+        num_proc=cfg.num_proc if cfg.num_proc > 1 else None,
+        remove_columns=dataset.column_names,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "column_name": cfg.column_name,
+            "context_size": cfg.context_size,
+            "bos_token_id": bos_token_id,
+        },
+        desc="Tokenizing",
+    )
+    tokenized_dataset.save_to_disk(cfg.save_path)
+    return tokenized_dataset
+
+
+def _tokenize_and_pack(
+    examples: dict[str, list[Any]],
+    tokenizer: PreTrainedTokenizerBase,
+    column_name: str,
+    context_size: int,
+    bos_token_id: int | None,
+) -> dict[str, list[list[int]]]:
+    # Tokenize the whole batch in one call, join the documents into one stream (each
+    # starting with BOS) and cut it into rows the same way the ActivationsStore packs
+    # documents: rows that don't already start with BOS get one. Rows are then used
+    # as they are at training time. The tail of each batch that doesn't fill a row is
+    # dropped.
+    documents = cast(
+        list[list[int]],
+        tokenizer(examples[column_name], add_special_tokens=False)["input_ids"],
+    )
+    bos = [bos_token_id] if bos_token_id is not None else []
+    stream = [token for document in documents for token in bos + document]
+
+    rows: list[list[int]] = []
+    start = 0
+    while True:
+        row_bos = bos if bos and stream[start : start + 1] != bos else []
+        end = start + context_size - len(row_bos)
+        if end > len(stream):
+            break
+        rows.append(row_bos + stream[start:end])
+        start = end
+    return {"tokens": rows}
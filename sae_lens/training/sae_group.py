@@ -83,6 +83,9 @@ class SAEGroup:
                         path,
                         pickle_module=fake_pickle,
                     )
+                    # async checkpoints are written from a CPU copy of the group
+                    if isinstance(group, SAEGroup):
+                        group.to(group.cfg.device)
                 else:
                     map_loc = "mps" if torch.backends.mps.is_available() else "cpu"
                     group = torch.load(
@@ -20,7 +20,7 @@ class LMSparseAutoencoderSessionloader:
         self.cfg = cfg
 
     def load_session(
-        self,
+        self, create_dataloader: bool = True
     ) -> Tuple[HookedTransformer, SAEGroup, ActivationsStore]:
         """
         Loads a session for training a sparse autoencoder on a language model.
@@ -28,17 +28,22 @@ class LMSparseAutoencoderSessionloader:
 
         model = self.get_model(self.cfg.model_name)
         model.to(self.cfg.device)
-        activations_loader = self.get_activations_loader(self.cfg, model)
+        activations_loader = self.get_activations_loader(
+            self.cfg, model, create_dataloader=create_dataloader
+        )
         sparse_autoencoder = self.initialize_sparse_autoencoder(self.cfg)
 
         return model, sparse_autoencoder, activations_loader
 
     @classmethod
     def load_session_from_pretrained(
-        cls, path: str
+        cls, path: str, create_dataloader: bool = True
     ) -> Tuple[HookedTransformer, SAEGroup, ActivationsStore]:
         """
         Loads a session for analysing a pretrained sparse autoencoder group.
+
+        Without create_dataloader the activation store only streams tokens, and doesn't
+        run the model to fill its activation buffer.
         """
         # if torch.backends.mps.is_available():
         #     cfg = torch.load(path, map_location="mps")["cfg"]
@@ -56,10 +61,12 @@ class LMSparseAutoencoderSessionloader:
             sparse_autoencoder.load_state_dict(sparse_autoencoders["state_dict"])
             model, sparse_autoencoders, activations_loader = cls(
                 sparse_autoencoder.cfg
-            ).load_session()
+            ).load_session(create_dataloader=create_dataloader)
             sparse_autoencoders.autoencoders[0] = sparse_autoencoder
         elif type(sparse_autoencoders) is SAEGroup:
-            model, _, activations_loader = cls(sparse_autoencoders.cfg).load_session()
+            model, _, activations_loader = cls(sparse_autoencoders.cfg).load_session(
+                create_dataloader=create_dataloader
+            )
         else:
             raise ValueError(
                 "The loaded sparse_autoencoders object is neither an SAE dict nor a SAEGroup"
@@ -88,7 +95,10 @@ class LMSparseAutoencoderSessionloader:
         return sparse_autoencoder
 
     def get_activations_loader(
-        self, cfg: LanguageModelSAERunnerConfig, model: HookedTransformer
+        self,
+        cfg: LanguageModelSAERunnerConfig,
+        model: HookedTransformer,
+        create_dataloader: bool = True,
     ):
         """
         Loads a DataLoaderBuffer for the activations of a language model.
@@ -97,6 +107,7 @@ class LMSparseAutoencoderSessionloader:
         activations_loader = ActivationsStore.from_config(
             model,
             cfg,
+            create_dataloader=create_dataloader,
         )
 
         return activations_loader
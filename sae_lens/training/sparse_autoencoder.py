@@ -5,7 +5,7 @@ https://github.com/ArthurConmy/sae/blob/main/sae/model.py
 import gzip
 import os
 import pickle
-from typing import NamedTuple
+from typing import Any, NamedTuple
 
 import einops
 import torch
@@ -38,6 +38,10 @@ class SparseAutoencoder(HookedRootModule):
     hook_point_layer: int
     dtype: torch.dtype
     device: str | torch.device
+    # the indices of the dead neurons, and the version of the dead neuron mask they were
+    # looked up for. Not saved with the SAE, see __getstate__
+    _dead_neuron_indices: torch.Tensor | None = None
+    _dead_neuron_indices_version: int | None = None
 
     def __init__(
         self,
@@ -102,7 +106,12 @@ class SparseAutoencoder(HookedRootModule):
 
         self.setup()  # Required for `HookedRootModule`s
 
-    def forward(self, x: torch.Tensor, dead_neuron_mask: torch.Tensor | None = None):
+    def forward(
+        self,
+        x: torch.Tensor,
+        dead_neuron_mask: torch.Tensor | None = None,
+        dead_neuron_mask_version: int | None = None,
+    ):
         # move x to correct dtype
         x = x.to(self.dtype)
         sae_in = self.hook_sae_in(
@@ -119,32 +128,51 @@ class SparseAutoencoder(HookedRootModule):
         )
         feature_acts = self.hook_hidden_post(torch.nn.functional.relu(hidden_pre))
 
-        sae_out = self.hook_sae_out(
-            einops.einsum(
+        if self.cfg.sparse_decode:
+            decoded = _sparse_decode(feature_acts, self.W_dec)
+        else:
+            decoded = einops.einsum(
                 feature_acts,
                 self.W_dec,
                 "... d_sae, d_sae d_in -> ... d_in",
             )
-            + self.b_dec
-        )
+        sae_out = self.hook_sae_out(decoded + self.b_dec)
 
         # add config for whether l2 is normalized:
         per_item_mse_loss = _per_item_mse_loss_with_target_norm(sae_out, x)
         ghost_grad_loss = torch.tensor(0.0, dtype=self.dtype, device=self.device)
         # gate on config and training so evals is not slowed down.
-        if (
-            self.use_ghost_grads
-            and self.training
-            and dead_neuron_mask is not None
-            and dead_neuron_mask.sum() > 0
-        ):
-            ghost_grad_loss = self.calculate_ghost_grad_loss(
-                x=x,
-                sae_out=sae_out,
-                per_item_mse_loss=per_item_mse_loss,
-                hidden_pre=hidden_pre,
-                dead_neuron_mask=dead_neuron_mask,
-            )
+        if self.use_ghost_grads and self.training and dead_neuron_mask is not None:
+            if self.cfg.sync_free_training:
+                # checking for dead neurons on the host would wait for the device,
+                # so always compute the loss and zero it if there are none
+                ghost_grad_loss = self.calculate_ghost_grad_loss(
+                    x=x,
+                    sae_out=sae_out,
+                    per_item_mse_loss=per_item_mse_loss,
+                    hidden_pre=hidden_pre,
+                    dead_neuron_mask=dead_neuron_mask,
+                    sync_free=True,
+                ) * dead_neuron_mask.any()
+            else:
+                # whether there are any dead neurons is known on the host from their
+                # (possibly cached) indices, without another sync
+                dead_neuron_indices = self.get_dead_neuron_indices(
+                    dead_neuron_mask, dead_neuron_mask_version
+                )
+                if dead_neuron_indices.numel() > 0:
+                    # cached indices may all have come back to life since
+                    ghost_grad_loss = (
+                        self.calculate_ghost_grad_loss(
+                            x=x,
+                            sae_out=sae_out,
+                            per_item_mse_loss=per_item_mse_loss,
+                            hidden_pre=hidden_pre,
+                            dead_neuron_mask=dead_neuron_mask,
+                            dead_neuron_indices=dead_neuron_indices,
+                        )
+                        * dead_neuron_mask.any()
+                    )
 
         mse_loss = per_item_mse_loss.mean()
         sparsity = feature_acts.norm(p=self.lp_norm, dim=1).mean(dim=(0,))
@@ -160,6 +188,44 @@ class SparseAutoencoder(HookedRootModule):
             ghost_grad_loss=ghost_grad_loss,
         )
 
+    @torch.inference_mode()
+    def encode(
+        self, x: torch.Tensor, out: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """
+        The feature activations for x, for inference: unlike forward this skips the hook
+        points and the losses, and tracks no gradients. Pass `out` to write the
+        activations into a preallocated (..., d_sae) tensor of the SAE's dtype.
+        """
+        sae_in = x.to(self.dtype) - self.b_dec
+        hidden_pre = torch.matmul(sae_in, self.W_enc, out=out)
+        return hidden_pre.add_(self.b_enc).relu_()
+
+    @torch.inference_mode()
+    def decode(
+        self, feature_acts: torch.Tensor, out: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """
+        The SAE output for the given feature activations, for inference. Pass `out` to
+        write it into a preallocated (..., d_in) tensor of the SAE's dtype.
+        """
+        if self.cfg.sparse_decode:
+            decoded = _sparse_decode(feature_acts, self.W_dec)
+            sae_out = decoded if out is None else out.copy_(decoded)
+        else:
+            sae_out = torch.matmul(feature_acts, self.W_dec, out=out)
+        return sae_out.add_(self.b_dec)
+
+    @torch.inference_mode()
+    def reconstruct(
+        self, x: torch.Tensor, out: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """
+        decode(encode(x)), i.e. forward's sae_out without the rest. `out` may be x
+        itself, to overwrite the input with its reconstruction.
+        """
+        return self.decode(self.encode(x), out=out)
+
     @torch.no_grad()
     def initialize_b_dec_with_precalculated(self, origin: torch.Tensor):
         out = torch.tensor(origin, dtype=self.dtype, device=self.device)
@@ -312,14 +378,34 @@ class SparseAutoencoder(HookedRootModule):
         per_item_mse_loss: torch.Tensor,
         hidden_pre: torch.Tensor,
         dead_neuron_mask: torch.Tensor,
+        sync_free: bool = False,
+        dead_neuron_indices: torch.Tensor | None = None,
     ) -> torch.Tensor:
         # 1.
         residual = x - sae_out
         l2_norm_residual = torch.norm(residual, dim=-1)
 
         # 2.
-        feature_acts_dead_neurons_only = torch.exp(hidden_pre[:, dead_neuron_mask])
-        ghost_out = feature_acts_dead_neurons_only @ self.W_dec[dead_neuron_mask, :]
+        if sync_free:
+            # selecting the dead neurons needs their count on the host, instead give
+            # live neurons a pre-activation of -inf, which exp sends to exactly 0.
+            feature_acts_dead_neurons_only = torch.exp(
+                hidden_pre.masked_fill(~dead_neuron_mask, float("-inf"))
+            )
+            ghost_out = feature_acts_dead_neurons_only @ self.W_dec
+        else:
+            # exp(hidden_pre[:, dead]) @ W_dec[dead], a chunk of dead neurons at a time
+            if dead_neuron_indices is None:
+                dead_neuron_indices = self.get_dead_neuron_indices(dead_neuron_mask)
+            # the indices may be from an earlier mask, neurons that have come back to
+            # life since then are weighted by 0
+            ghost_out = _GhostDecode.apply(
+                hidden_pre,
+                self.W_dec,
+                dead_neuron_indices,
+                dead_neuron_mask[dead_neuron_indices].to(hidden_pre.dtype),
+            )
+            assert isinstance(ghost_out, torch.Tensor)  # keep pyright happy
         l2_norm_ghost_out = torch.norm(ghost_out, dim=-1)
         norm_scaling_factor = l2_norm_residual / (1e-6 + l2_norm_ghost_out * 2)
         ghost_out = ghost_out * norm_scaling_factor[:, None].detach()
@@ -337,6 +423,84 @@ class SparseAutoencoder(HookedRootModule):
 
         return per_item_mse_loss_ghost_resid.mean()
 
+    @torch.no_grad()
+    def get_dead_neuron_indices(
+        self, dead_neuron_mask: torch.Tensor, version: int | None = None
+    ) -> torch.Tensor:
+        """
+        The indices of the dead neurons in dead_neuron_mask. Looking them up waits for
+        the device, so with a version they're cached and only looked up again when the
+        version changes, which training does whenever a neuron has just died. Until then
+        they're the indices of the mask the version was first seen with, which may
+        include neurons that have come back to life since.
+        """
+        if (
+            version is None
+            or self._dead_neuron_indices is None
+            or version != self._dead_neuron_indices_version
+        ):
+            self._dead_neuron_indices = dead_neuron_mask.nonzero().squeeze(-1)
+            self._dead_neuron_indices_version = version
+        return self._dead_neuron_indices
+
+    def __getstate__(self) -> dict[str, Any]:
+        # the dead neuron indices belong to a training run (and device), not the SAE
+        state = super().__getstate__()
+        state["_dead_neuron_indices"] = None
+        state["_dead_neuron_indices_version"] = None
+        return state
+
+
+# how many dead neurons ghost grads handle at once, which bounds their memory use to
+# (batch_size, GHOST_GRAD_CHUNK_SIZE) for the activations of the dead neurons
+GHOST_GRAD_CHUNK_SIZE = 4096
+
+
+class _GhostDecode(torch.autograd.Function):
+    """
+    (exp(hidden_pre[:, dead_neuron_indices]) * weights) @ W_dec[dead_neuron_indices],
+    computed a chunk of dead neurons at a time. Neither the dead neurons' activations nor their
+    decoder rows are ever gathered all at once: the backward pass recomputes each chunk's
+    activations rather than saving them.
+    """
+
+    @staticmethod
+    def forward(
+        ctx: Any,
+        hidden_pre: torch.Tensor,
+        W_dec: torch.Tensor,
+        dead_neuron_indices: torch.Tensor,
+        weights: torch.Tensor,
+    ) -> torch.Tensor:
+        ctx.save_for_backward(hidden_pre, W_dec, dead_neuron_indices, weights)
+        ghost_out = hidden_pre.new_zeros(hidden_pre.shape[0], W_dec.shape[1])
+        for chunk, chunk_weights in zip(
+            dead_neuron_indices.split(GHOST_GRAD_CHUNK_SIZE),
+            weights.split(GHOST_GRAD_CHUNK_SIZE),
+        ):
+            feature_acts = hidden_pre.index_select(1, chunk).exp_().mul_(chunk_weights)
+            ghost_out.addmm_(feature_acts, W_dec.index_select(0, chunk))
+        return ghost_out
+
+    @staticmethod
+    def backward(
+        ctx: Any, *grad_outputs: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, None, None]:
+        (grad_ghost_out,) = grad_outputs
+        hidden_pre, W_dec, dead_neuron_indices, weights = ctx.saved_tensors
+        grad_hidden_pre = torch.zeros_like(hidden_pre)
+        grad_W_dec = torch.zeros_like(W_dec)
+        for chunk, chunk_weights in zip(
+            dead_neuron_indices.split(GHOST_GRAD_CHUNK_SIZE),
+            weights.split(GHOST_GRAD_CHUNK_SIZE),
+        ):
+            feature_acts = hidden_pre.index_select(1, chunk).exp_().mul_(chunk_weights)
+            grad_W_dec.index_copy_(0, chunk, feature_acts.T @ grad_ghost_out)
+            # d w * exp(x) / dx = w * exp(x)
+            grad_feature_acts = grad_ghost_out @ W_dec.index_select(0, chunk).T
+            grad_hidden_pre.index_copy_(1, chunk, grad_feature_acts.mul_(feature_acts))
+        return grad_hidden_pre, grad_W_dec, None, None
+
 
 def _per_item_mse_loss_with_target_norm(
     preds: torch.Tensor, target: torch.Tensor
@@ -349,3 +513,32 @@ def _per_item_mse_loss_with_target_norm(
     target_centered = target - target.mean(dim=0, keepdim=True)
     normalization = target_centered.norm(dim=-1, keepdim=True)
     return torch.nn.functional.mse_loss(preds, target, reduction="none") / normalization
+
+
+# above this fraction of active features the dense matmul is faster than a sparse decode
+SPARSE_DECODE_MAX_DENSITY = 0.03
+
+
+def _sparse_decode(feature_acts: torch.Tensor, W_dec: torch.Tensor) -> torch.Tensor:
+    """
+    feature_acts @ W_dec, only reading the decoder rows of active features: an embedding
+    bag over each item's nonzero features, weighted by their activations. Falls back to
+    the dense matmul when too many features are active for this to pay off. Both the
+    choice and the nonzero lookup wait for the device, hence no sync free training.
+    """
+    flat_feature_acts = feature_acts.reshape(-1, feature_acts.shape[-1])
+    # the density of a few items is enough to pick the faster path
+    sample = flat_feature_acts[:256]
+    if torch.count_nonzero(sample) > SPARSE_DECODE_MAX_DENSITY * sample.numel():
+        return feature_acts @ W_dec
+    # nonzero is in row-major order, so each item's features are contiguous
+    items, features = flat_feature_acts.nonzero(as_tuple=True)
+    counts = torch.bincount(items, minlength=flat_feature_acts.shape[0])
+    decoded = torch.nn.functional.embedding_bag(
+        features,
+        W_dec,
+        offsets=counts.cumsum(0) - counts,
+        mode="sum",
+        per_sample_weights=flat_feature_acts[items, features],
+    )
+    return decoded.reshape(*feature_acts.shape[:-1], W_dec.shape[-1])
@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass
 from typing import Any, NamedTuple, cast
 
@@ -9,9 +10,11 @@ from transformer_lens import HookedTransformer
 
 import wandb
 from sae_lens.training.activations_store import ActivationsStore
-from sae_lens.training.evals import run_evals
-from sae_lens.training.geometric_median import compute_geometric_median
-from sae_lens.training.optim import get_scheduler
+from sae_lens.training.checkpoint_writer import CheckpointWriter, snapshot_to_cpu
+from sae_lens.training.evals import EvalTokens, run_group_evals
+from sae_lens.training.fused_sae_group import FusedSAEGroup
+from sae_lens.training.geometric_median import compute_approximate_geometric_median
+from sae_lens.training.optim import LearningRateHolder, StackedAdam, get_scheduler
 from sae_lens.training.sae_group import SAEGroup
 from sae_lens.training.sparse_autoencoder import SparseAutoencoder
 
@@ -27,12 +30,29 @@ class SAETrainContext:
     n_frac_active_tokens: int
     optimizer: Optimizer
     scheduler: LRScheduler
+    # bumped whenever a neuron dies, so the SAE looks its dead neuron indices up again
+    dead_neuron_mask_version: int = 0
 
     @property
     def feature_sparsity(self) -> torch.Tensor:
         return self.act_freq_scores / self.n_frac_active_tokens
 
 
+@dataclass
+class FusedSAETrainContext:
+    """
+    Context to track during training for a FusedSAEGroup. The tensors stack those of its
+    members' SAETrainContexts, which are views into them.
+    """
+
+    fused_sae_group: FusedSAEGroup
+    member_indices: list[int]  # positions of the members in the SAEGroup
+    layer_ids: torch.Tensor  # index of each member's layer in the activations
+    act_freq_scores: torch.Tensor
+    n_forward_passes_since_fired: torch.Tensor
+    optimizer: StackedAdam
+
+
 @dataclass
 class TrainSAEGroupOutput:
     sae_group: SAEGroup
@@ -91,91 +111,163 @@ def train_sae_group_on_language_model(
     if not isinstance(all_layers, list):
         all_layers = [all_layers]
 
+    fused = sae_group.cfg.fused_sae_training
     train_contexts = [
-        _build_train_context(sae, total_training_steps) for sae in sae_group
+        _build_train_context(sae, total_training_steps, fused=fused)
+        for sae in sae_group
     ]
     _init_sae_group_b_decs(sae_group, activation_store, all_layers)
+    fused_train_contexts = (
+        _build_fused_train_contexts(sae_group, train_contexts, all_layers)
+        if fused
+        else []
+    )
+    wandb_suffixes = [
+        _wandb_log_suffix(sae_group.cfg, sae.cfg) for sae in sae_group.autoencoders
+    ]
+    # evals only run when logging to wandb. Their tokens are taken out of the stream
+    # once, before training, rather than at every eval.
+    eval_tokens = (
+        EvalTokens.from_activation_store(
+            activation_store, path=sae_group.cfg.eval_tokens_path
+        )
+        if use_wandb
+        else None
+    )
+
+    # checkpoints are written (and uploaded) on a background thread, training only waits
+    # for the tensors to be copied to the CPU
+    checkpoint_writer = (
+        CheckpointWriter() if sae_group.cfg.async_checkpointing else None
+    )
+
+    # the losses shown in the progress bar stay on the device until it's updated, which in
+    # sync free mode is only every wandb_log_frequency steps
+    sync_free = sae_group.cfg.sync_free_training
+    pbar_update_frequency = wandb_log_frequency if sync_free else 1
+    pbar_mse_losses: list[torch.Tensor] = []
+    pbar_l1_losses: list[torch.Tensor] = []
 
     pbar = tqdm(total=total_training_tokens, desc="Training SAE")
     checkpoint_paths: list[str] = []
-    while n_training_tokens < total_training_tokens:
-        # Do a training step.
-        layer_acts = activation_store.next_batch()
-        n_training_tokens += batch_size
-
-        mse_losses: list[torch.Tensor] = []
-        l1_losses: list[torch.Tensor] = []
-
-        for (
-            sparse_autoencoder,
-            ctx,
-        ) in zip(sae_group, train_contexts):
-            wandb_suffix = _wandb_log_suffix(sae_group.cfg, sparse_autoencoder.cfg)
-            step_output = _train_step(
-                sparse_autoencoder=sparse_autoencoder,
-                layer_acts=layer_acts,
-                ctx=ctx,
-                feature_sampling_window=feature_sampling_window,
-                use_wandb=use_wandb,
-                n_training_steps=n_training_steps,
-                all_layers=all_layers,
-                batch_size=batch_size,
-                wandb_suffix=wandb_suffix,
-            )
-            mse_losses.append(step_output.mse_loss)
-            l1_losses.append(step_output.l1_loss)
-            if use_wandb:
-                with torch.no_grad():
-                    if (n_training_steps + 1) % wandb_log_frequency == 0:
-                        wandb.log(
-                            _build_train_step_log_dict(
-                                sparse_autoencoder,
-                                step_output,
-                                ctx,
-                                wandb_suffix,
-                                n_training_tokens,
-                            ),
-                            step=n_training_steps,
-                        )
-
-                    # record loss frequently, but not all the time.
-                    if (n_training_steps + 1) % (wandb_log_frequency * 10) == 0:
-                        sparse_autoencoder.eval()
-                        run_evals(
-                            sparse_autoencoder,
-                            activation_store,
-                            model,
-                            n_training_steps,
-                            suffix=wandb_suffix,
-                        )
-                        sparse_autoencoder.train()
-
-        # checkpoint if at checkpoint frequency
-        if checkpoint_thresholds and n_training_tokens > checkpoint_thresholds[0]:
-            checkpoint_path = _save_checkpoint(
-                sae_group,
-                train_contexts=train_contexts,
-                checkpoint_name=n_training_tokens,
-            ).path
-            checkpoint_paths.append(checkpoint_path)
-            checkpoint_thresholds.pop(0)
-
-        ###############
-
-        n_training_steps += 1
-        pbar.set_description(
-            f"{n_training_steps}| MSE Loss {torch.stack(mse_losses).mean().item():.3f} | L1 {torch.stack(l1_losses).mean().item():.3f}"
+    try:
+        while n_training_tokens < total_training_tokens:
+            # Do a training step.
+            layer_acts = activation_store.next_batch()
+            n_training_tokens += batch_size
+
+            mse_losses: list[torch.Tensor] = []
+            l1_losses: list[torch.Tensor] = []
+
+            step_outputs: list[TrainStepOutput | None] = [None] * len(sae_group)
+            for fused_ctx in fused_train_contexts:
+                fused_step_outputs = _fused_train_step(
+                    fused_ctx=fused_ctx,
+                    layer_acts=layer_acts,
+                    member_contexts=[
+                        train_contexts[i] for i in fused_ctx.member_indices
+                    ],
+                    feature_sampling_window=feature_sampling_window,
+                    use_wandb=use_wandb,
+                    n_training_steps=n_training_steps,
+                    batch_size=batch_size,
+                    wandb_suffixes=[
+                        wandb_suffixes[i] for i in fused_ctx.member_indices
+                    ],
+                )
+                for i, step_output in zip(fused_ctx.member_indices, fused_step_outputs):
+                    step_outputs[i] = step_output
+
+            for sparse_autoencoder, ctx, wandb_suffix, step_output in zip(
+                sae_group, train_contexts, wandb_suffixes, step_outputs
+            ):
+                if step_output is None:
+                    step_output = _train_step(
+                        sparse_autoencoder=sparse_autoencoder,
+                        layer_acts=layer_acts,
+                        ctx=ctx,
+                        feature_sampling_window=feature_sampling_window,
+                        use_wandb=use_wandb,
+                        n_training_steps=n_training_steps,
+                        all_layers=all_layers,
+                        batch_size=batch_size,
+                        wandb_suffix=wandb_suffix,
+                    )
+                mse_losses.append(step_output.mse_loss)
+                l1_losses.append(step_output.l1_loss)
+                if use_wandb:
+                    with torch.no_grad():
+                        if (n_training_steps + 1) % wandb_log_frequency == 0:
+                            wandb.log(
+                                _build_train_step_log_dict(
+                                    sparse_autoencoder,
+                                    step_output,
+                                    ctx,
+                                    wandb_suffix,
+                                    n_training_tokens,
+                                ),
+                                step=n_training_steps,
+                            )
+
+            # record loss frequently, but not all the time. The whole group is evaluated at
+            # once, so the SAEs share the model's forward passes.
+            if use_wandb and (n_training_steps + 1) % (wandb_log_frequency * 10) == 0:
+                sae_group.eval()
+                # the store may be using the model on its prefetch thread
+                with activation_store.model_lock:
+                    run_group_evals(
+                        sae_group.autoencoders,
+                        activation_store,
+                        model,
+                        n_training_steps,
+                        suffixes=wandb_suffixes,
+                        eval_tokens=eval_tokens,
+                    )
+                sae_group.train()
+
+            # checkpoint if at checkpoint frequency
+            if checkpoint_thresholds and n_training_tokens > checkpoint_thresholds[0]:
+                checkpoint_path = _save_checkpoint(
+                    sae_group,
+                    train_contexts=train_contexts,
+                    checkpoint_name=n_training_tokens,
+                    checkpoint_writer=checkpoint_writer,
+                ).path
+                checkpoint_paths.append(checkpoint_path)
+                checkpoint_thresholds.pop(0)
+
+            ###############
+
+            n_training_steps += 1
+            pbar_mse_losses.append(torch.stack(mse_losses).mean())
+            pbar_l1_losses.append(torch.stack(l1_losses).mean())
+            if n_training_steps % pbar_update_frequency == 0:
+                pbar.set_description(
+                    f"{n_training_steps}| MSE Loss {torch.stack(pbar_mse_losses).mean().item():.3f} | L1 {torch.stack(pbar_l1_losses).mean().item():.3f}"
+                )
+                pbar_mse_losses.clear()
+                pbar_l1_losses.clear()
+            pbar.update(batch_size)
+
+        # stop any background buffer refills, the store still works synchronously after
+        activation_store.close()
+
+        # save final sae group to checkpoints folder
+        final_checkpoint = _save_checkpoint(
+            sae_group,
+            train_contexts=train_contexts,
+            checkpoint_name="final",
+            wandb_aliases=["final_model"],
+            checkpoint_writer=checkpoint_writer,
         )
-        pbar.update(batch_size)
-
-    # save final sae group to checkpoints folder
-    final_checkpoint = _save_checkpoint(
-        sae_group,
-        train_contexts=train_contexts,
-        checkpoint_name="final",
-        wandb_aliases=["final_model"],
-    )
-    checkpoint_paths.append(final_checkpoint.path)
+        checkpoint_paths.append(final_checkpoint.path)
+    finally:
+        # on errors too, so no refill thread is left running and every checkpoint
+        # submitted so far still gets written. Once the writer is closed they're all
+        # on disk (and uploaded)
+        activation_store.close()
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
 
     return TrainSAEGroupOutput(
         sae_group=sae_group,
@@ -203,7 +295,7 @@ def _wandb_log_suffix(cfg: Any, hyperparams: Any):
 
 
 def _build_train_context(
-    sae: SparseAutoencoder, total_training_steps: int
+    sae: SparseAutoencoder, total_training_steps: int, fused: bool = False
 ) -> SAETrainContext:
     assert not isinstance(sae.cfg.lr, list), "lr must not be a list for a single SAE"
     assert not isinstance(
@@ -232,7 +324,12 @@ def _build_train_context(
     )
     n_frac_active_tokens = 0
 
-    optimizer = Adam(sae.parameters(), lr=sae.cfg.lr)
+    # members of a FusedSAEGroup share one StackedAdam, their own optimizer only holds the lr
+    optimizer = (
+        LearningRateHolder(sae.cfg.lr)
+        if fused
+        else Adam(sae.parameters(), lr=sae.cfg.lr)
+    )
     assert sae.cfg.lr_end is not None  # this is set in config post-init
     scheduler = get_scheduler(
         sae.cfg.lr_scheduler_name,
@@ -254,31 +351,88 @@ def _build_train_context(
     )
 
 
+def _build_fused_train_contexts(
+    sae_group: SAEGroup,
+    train_contexts: list[SAETrainContext],
+    all_layers: list[int],
+) -> list[FusedSAETrainContext]:
+    """
+    Fuse the SAEs of the group that have the same shape, which means all of them unless
+    expansion_factor is swept. Must be called after the b_decs are initialized.
+    """
+    members_by_shape: dict[int, list[int]] = {}
+    for i, sae in enumerate(sae_group):
+        members_by_shape.setdefault(sae.d_sae, []).append(i)
+
+    fused_train_contexts: list[FusedSAETrainContext] = []
+    for member_indices in members_by_shape.values():
+        saes = [sae_group.autoencoders[i] for i in member_indices]
+        member_contexts = [train_contexts[i] for i in member_indices]
+        fused_sae_group = FusedSAEGroup(saes)
+
+        act_freq_scores = torch.stack([ctx.act_freq_scores for ctx in member_contexts])
+        n_forward_passes_since_fired = torch.stack(
+            [ctx.n_forward_passes_since_fired for ctx in member_contexts]
+        )
+        for i, ctx in enumerate(member_contexts):
+            ctx.act_freq_scores = act_freq_scores[i]
+            ctx.n_forward_passes_since_fired = n_forward_passes_since_fired[i]
+
+        optimizer = StackedAdam(
+            fused_sae_group.parameters(),
+            lr_holders=[
+                cast(LearningRateHolder, ctx.optimizer) for ctx in member_contexts
+            ],
+        )
+        layer_ids = torch.tensor(
+            [all_layers.index(sae.hook_point_layer) for sae in saes],
+            device=fused_sae_group.device,
+        )
+        fused_train_contexts.append(
+            FusedSAETrainContext(
+                fused_sae_group=fused_sae_group,
+                member_indices=member_indices,
+                layer_ids=layer_ids,
+                act_freq_scores=act_freq_scores,
+                n_forward_passes_since_fired=n_forward_passes_since_fired,
+                optimizer=optimizer,
+            )
+        )
+    return fused_train_contexts
+
+
 def _init_sae_group_b_decs(
     sae_group: SAEGroup, activation_store: ActivationsStore, all_layers: list[int]
 ) -> None:
     """
     extract all activations at a certain layer and use for sae b_dec initialization
     """
-    geometric_medians = {}
+    # the statistics of every layer in the buffer at once, on its device, and only once
+    # however many SAEs share a layer. The buffer is in its storage dtype: the mean
+    # accumulates in fp32, and the median upcasts a chunk of it at a time.
+    storage_buffer = activation_store.storage_buffer.detach()
+    init_methods = {sae.cfg.b_dec_init_method for sae in sae_group}
+    layer_means = None
+    layer_medians = None
+    if "mean" in init_methods:
+        layer_means = storage_buffer.mean(dim=0, dtype=torch.float32)
+    if "geometric_median" in init_methods:
+        layer_medians = compute_approximate_geometric_median(
+            storage_buffer,
+            maxiter=100,
+            # the mean is where the median search starts anyway
+            init_median=layer_means,
+        ).median
+
     for sae in sae_group:
         hyperparams = sae.cfg
         sae_layer_id = all_layers.index(sae.hook_point_layer)
         if hyperparams.b_dec_init_method == "geometric_median":
-            layer_acts = activation_store.storage_buffer.detach()[:, sae_layer_id, :]
-            # get geometric median of the activations if we're using those.
-            if sae_layer_id not in geometric_medians:
-                median = compute_geometric_median(
-                    layer_acts,
-                    maxiter=100,
-                ).median
-                geometric_medians[sae_layer_id] = median
-            sae.initialize_b_dec_with_precalculated(geometric_medians[sae_layer_id])
+            assert layer_medians is not None  # keep pyright happy
+            sae.initialize_b_dec_with_precalculated(layer_medians[sae_layer_id])
         elif hyperparams.b_dec_init_method == "mean":
-            layer_acts = activation_store.storage_buffer.detach().cpu()[
-                :, sae_layer_id, :
-            ]
-            sae.initialize_b_dec_with_mean(layer_acts)
+            assert layer_means is not None  # keep pyright happy
+            sae.initialize_b_dec_with_precalculated(layer_means[sae_layer_id])
 
 
 @dataclass
@@ -314,33 +468,23 @@ def _train_step(
 
     # log and then reset the feature sparsity every feature_sampling_window steps
     if (n_training_steps + 1) % feature_sampling_window == 0:
-        feature_sparsity = ctx.feature_sparsity
-        log_feature_sparsity = _log_feature_sparsity(feature_sparsity)
-
-        if use_wandb:
-            wandb_histogram = wandb.Histogram(log_feature_sparsity.numpy())
-            wandb.log(
-                {
-                    f"metrics/mean_log10_feature_sparsity{wandb_suffix}": log_feature_sparsity.mean().item(),
-                    f"plots/feature_density_line_chart{wandb_suffix}": wandb_histogram,
-                    f"sparsity/below_1e-5{wandb_suffix}": (feature_sparsity < 1e-5)
-                    .sum()
-                    .item(),
-                    f"sparsity/below_1e-6{wandb_suffix}": (feature_sparsity < 1e-6)
-                    .sum()
-                    .item(),
-                },
-                step=n_training_steps,
-            )
-
-        ctx.act_freq_scores = torch.zeros(
-            sparse_autoencoder.cfg.d_sae, device=sparse_autoencoder.cfg.device
-        )
-        ctx.n_frac_active_tokens = 0
+        _log_and_reset_feature_sparsity(ctx, use_wandb, n_training_steps, wandb_suffix)
 
+    dead_feature_window = sparse_autoencoder.cfg.dead_feature_window
     ghost_grad_neuron_mask = (
-        ctx.n_forward_passes_since_fired > sparse_autoencoder.cfg.dead_feature_window
+        ctx.n_forward_passes_since_fired > dead_feature_window
     ).bool()
+    dead_neuron_mask_version = None
+    if (
+        sparse_autoencoder.use_ghost_grads
+        and not sparse_autoencoder.cfg.sync_free_training
+    ):
+        # a neuron joins the mask on the step its count passes the window, so only then
+        # do the cached dead neuron indices need looking up again. Neurons that fire
+        # again leave the mask, but the cached indices weight them by 0.
+        if (ctx.n_forward_passes_since_fired == dead_feature_window + 1).any():
+            ctx.dead_neuron_mask_version += 1
+        dead_neuron_mask_version = ctx.dead_neuron_mask_version
 
     # Forward and Backward Passes
     (
@@ -353,10 +497,12 @@ def _train_step(
     ) = sparse_autoencoder(
         sae_in,
         ghost_grad_neuron_mask,
+        dead_neuron_mask_version=dead_neuron_mask_version,
     )
     did_fire = (feature_acts > 0).float().sum(-2) > 0
     ctx.n_forward_passes_since_fired += 1
-    ctx.n_forward_passes_since_fired[did_fire] = 0
+    # unlike indexing with did_fire, masked_fill doesn't need to sync with the device
+    ctx.n_forward_passes_since_fired.masked_fill_(did_fire, 0)
 
     with torch.no_grad():
         # Calculate the sparsities, and add it to a list, calculate sparsity metrics
@@ -381,6 +527,99 @@ def _train_step(
     )
 
 
+def _fused_train_step(
+    fused_ctx: FusedSAETrainContext,
+    layer_acts: torch.Tensor,
+    member_contexts: list[SAETrainContext],
+    feature_sampling_window: int,
+    use_wandb: bool,
+    n_training_steps: int,
+    batch_size: int,
+    wandb_suffixes: list[str],
+) -> list[TrainStepOutput]:
+    """
+    The same as `_train_step` for every member of a FusedSAEGroup, in one go.
+    """
+    fused_sae_group = fused_ctx.fused_sae_group
+    sae_in = layer_acts.transpose(0, 1).index_select(0, fused_ctx.layer_ids)
+
+    fused_sae_group.train()
+    fused_sae_group.set_decoder_norm_to_unit_norm()
+
+    if (n_training_steps + 1) % feature_sampling_window == 0:
+        for ctx, wandb_suffix in zip(member_contexts, wandb_suffixes):
+            _log_and_reset_feature_sparsity(
+                ctx, use_wandb, n_training_steps, wandb_suffix
+            )
+
+    ghost_grad_neuron_mask = (
+        fused_ctx.n_forward_passes_since_fired
+        > fused_sae_group.dead_feature_windows[:, None]
+    )
+
+    output = fused_sae_group(sae_in, ghost_grad_neuron_mask)
+    did_fire = (output.feature_acts > 0).any(dim=1)
+    fused_ctx.n_forward_passes_since_fired += 1
+    fused_ctx.n_forward_passes_since_fired.masked_fill_(did_fire, 0)
+
+    with torch.no_grad():
+        fused_ctx.act_freq_scores += (output.feature_acts.abs() > 0).float().sum(1)
+        for ctx in member_contexts:
+            ctx.n_frac_active_tokens += batch_size
+
+    fused_ctx.optimizer.zero_grad()
+    # members don't share parameters, so each gets the gradient of its own loss
+    output.loss.sum().backward()
+    fused_sae_group.remove_gradient_parallel_to_decoder_directions()
+    fused_ctx.optimizer.step()
+    for ctx in member_contexts:
+        ctx.scheduler.step()
+
+    return [
+        TrainStepOutput(
+            sae_in=sae_in[i],
+            sae_out=output.sae_out[i],
+            feature_acts=output.feature_acts[i],
+            loss=output.loss[i],
+            mse_loss=output.mse_loss[i],
+            l1_loss=output.l1_loss[i],
+            ghost_grad_loss=output.ghost_grad_loss[i],
+            ghost_grad_neuron_mask=ghost_grad_neuron_mask[i],
+        )
+        for i in range(len(member_contexts))
+    ]
+
+
+def _log_and_reset_feature_sparsity(
+    ctx: SAETrainContext,
+    use_wandb: bool,
+    n_training_steps: int,
+    wandb_suffix: str,
+):
+    feature_sparsity = ctx.feature_sparsity
+    log_feature_sparsity = _log_feature_sparsity(feature_sparsity)
+
+    if use_wandb:
+        wandb_histogram = wandb.Histogram(log_feature_sparsity.numpy())
+        wandb.log(
+            {
+                f"metrics/mean_log10_feature_sparsity{wandb_suffix}": log_feature_sparsity.mean().item(),
+                f"plots/feature_density_line_chart{wandb_suffix}": wandb_histogram,
+                f"sparsity/below_1e-5{wandb_suffix}": (feature_sparsity < 1e-5)
+                .sum()
+                .item(),
+                f"sparsity/below_1e-6{wandb_suffix}": (feature_sparsity < 1e-6)
+                .sum()
+                .item(),
+            },
+            step=n_training_steps,
+        )
+
+    # in place, the context of a fused SAE holds a view into the stacked scores
+    ctx.act_freq_scores.zero_()
+    ctx.n_frac_active_tokens = 0
+
+
 def _build_train_step_log_dict(
     sparse_autoencoder: SparseAutoencoder,
     output: TrainStepOutput,
@@ -435,18 +674,60 @@ def _save_checkpoint(
     train_contexts: list[SAETrainContext],
     checkpoint_name: int | str,
     wandb_aliases: list[str] | None = None,
+    checkpoint_writer: CheckpointWriter | None = None,
 ) -> SaveCheckpointOutput:
+    """
+    Saves the group and its log feature sparsities, and uploads them to wandb if it's
+    on. With a checkpoint_writer, the group is snapshotted to the CPU here and written
+    and uploaded on the writer's thread, so the files may not exist yet on return.
+    """
     path = (
         f"{sae_group.cfg.checkpoint_path}/{checkpoint_name}_{sae_group.get_name()}.pt"
     )
     for sae in sae_group:
         sae.set_decoder_norm_to_unit_norm()
-    sae_group.save_model(path)
     log_feature_sparsity_path = f"{sae_group.cfg.checkpoint_path}/{checkpoint_name}_{sae_group.get_name()}_log_feature_sparsity.pt"
     log_feature_sparsities = [
         _log_feature_sparsity(ctx.feature_sparsity) for ctx in train_contexts
     ]
-    torch.save(log_feature_sparsities, log_feature_sparsity_path)
+    if checkpoint_writer is None:
+        _write_checkpoint(
+            sae_group,
+            path,
+            log_feature_sparsities,
+            log_feature_sparsity_path,
+            wandb_aliases,
+        )
+    else:
+        snapshot, copied = snapshot_to_cpu(sae_group)
+
+        def write():
+            if copied is not None:
+                copied.synchronize()
+            _write_checkpoint(
+                snapshot,
+                path,
+                log_feature_sparsities,
+                log_feature_sparsity_path,
+                wandb_aliases,
+            )
+
+        checkpoint_writer.submit(write)
+    return SaveCheckpointOutput(path, log_feature_sparsity_path, log_feature_sparsities)
+
+
+def _write_checkpoint(
+    sae_group: SAEGroup,
+    path: str,
+    log_feature_sparsities: list[torch.Tensor],
+    log_feature_sparsity_path: str,
+    wandb_aliases: list[str] | None,
+):
+    # write then rename, so an interrupted write never leaves a truncated checkpoint
+    sae_group.save_model(path + ".tmp.pt")
+    os.replace(path + ".tmp.pt", path)
+    torch.save(log_feature_sparsities, log_feature_sparsity_path + ".tmp")
+    os.replace(log_feature_sparsity_path + ".tmp", log_feature_sparsity_path)
     if sae_group.cfg.log_to_wandb:
         model_artifact = wandb.Artifact(
             f"{sae_group.get_name()}",
@@ -463,7 +744,6 @@ def _save_checkpoint(
         )
         sparsity_artifact.add_file(log_feature_sparsity_path)
         wandb.log_artifact(sparsity_artifact)
-    return SaveCheckpointOutput(path, log_feature_sparsity_path, log_feature_sparsities)
 
 
 def _log_feature_sparsity(
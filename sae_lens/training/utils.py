@@ -3,6 +3,8 @@ from typing import Tuple
 
 import torch
 
+from sae_lens.training.activations_cache import ActivationsCache
+
 
 class BackwardsCompatibleUnpickler(pickle.Unpickler):
     """
@@ -33,8 +35,9 @@ def shuffle_activations_pairwise(datapath: str, buffer_idx_range: Tuple[int, int
             buffer_idx_range[0], buffer_idx_range[1], (1,)
         ).item()
 
-    buffer1 = torch.load(f"{datapath}/{buffer_idx1}.pt")
-    buffer2 = torch.load(f"{datapath}/{buffer_idx2}.pt")
+    cache = ActivationsCache(datapath)
+    buffer1 = cache.load_shard(int(buffer_idx1))
+    buffer2 = cache.load_shard(int(buffer_idx2))
     joint_buffer = torch.cat([buffer1, buffer2])
 
     # Shuffle them
@@ -43,5 +46,5 @@ def shuffle_activations_pairwise(datapath: str, buffer_idx_range: Tuple[int, int
     shuffled_buffer2 = joint_buffer[buffer1.shape[0] :]
 
     # Save them back
-    torch.save(shuffled_buffer1, f"{datapath}/{buffer_idx1}.pt")
-    torch.save(shuffled_buffer2, f"{datapath}/{buffer_idx2}.pt")
+    cache.write_shard(int(buffer_idx1), shuffled_buffer1)
+    cache.write_shard(int(buffer_idx2), shuffled_buffer2)
@@ -0,0 +1,131 @@
+import time
+from typing import Any, Callable, Iterator, cast
+
+import pytest
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from transformer_lens import HookedTransformer
+
+from sae_lens.training.activations_store import ActivationsStore, _iterate_batches
+from sae_lens.training.config import LanguageModelSAERunnerConfig
+
+
+def _get_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def _steps_per_sec(make_batches: Callable[[], Iterator[torch.Tensor]]) -> float:
+    # warm up, then time a full pass over the served half of the buffer
+    for _ in make_batches():
+        break
+    start = time.perf_counter()
+    n_steps = 0
+    for batch in make_batches():
+        batch.sum()  # touch the batch, like a training step would
+        n_steps += 1
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return n_steps / (time.perf_counter() - start)
+
+
+def test_batch_iterator_throughput_vs_dataloader():
+    device = _get_device()
+    # the served half of a default-sized buffer for a 512-dim hook point
+    n_batches_in_buffer, store_batch_size, context_size, d_in = 20, 32, 128, 512
+    train_batch_size = 4096
+    served = torch.randn(
+        store_batch_size * context_size * n_batches_in_buffer // 2,
+        1,
+        d_in,
+        device=device,
+    )
+
+    dataloader_steps_per_sec = _steps_per_sec(
+        lambda: iter(
+            DataLoader(
+                cast(Any, served),
+                batch_size=train_batch_size,
+                shuffle=True,
+            )
+        )
+    )
+    iterator_steps_per_sec = _steps_per_sec(
+        lambda: _iterate_batches(
+            served,
+            train_batch_size,
+            order=torch.randperm(served.shape[0], device=served.device),
+        )
+    )
+
+    print(
+        f"\nDataLoader: {dataloader_steps_per_sec:.1f} steps/sec\n"
+        f"batch iterator: {iterator_steps_per_sec:.1f} steps/sec\n"
+        f"speedup: {iterator_steps_per_sec / dataloader_steps_per_sec:.1f}x"
+    )
+    assert iterator_steps_per_sec > dataloader_steps_per_sec
+
+
+def _get_activations_with_run_with_cache(
+    store: ActivationsStore, batch_tokens: torch.Tensor
+) -> torch.Tensor:
+    # how activations were generated before hook-only capture, for comparison
+    act_names = [
+        store.hook_point.format(layer=layer) for layer in store.hook_point_layers
+    ]
+    layerwise_activations = store.model.run_with_cache(
+        batch_tokens,
+        names_filter=act_names,
+        stop_at_layer=max(store.hook_point_layers) + 1,
+        prepend_bos=store.prepend_bos,
+    )[1]
+    return torch.stack([layerwise_activations[name] for name in act_names], dim=2)
+
+
+def _tokens_per_sec(get_activations: Callable[[], Any], n_tokens: int) -> float:
+    get_activations()  # warm up
+    n_repeats = 5
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        get_activations()
+    return n_repeats * n_tokens / (time.perf_counter() - start)
+
+
+@pytest.mark.parametrize("model_name", ["gelu-2l", "gpt2"])
+def test_get_activations_throughput_vs_run_with_cache(model_name: str):
+    model = HookedTransformer.from_pretrained(model_name, device="cpu")
+    cfg = LanguageModelSAERunnerConfig(
+        model_name=model_name,
+        hook_point="blocks.{layer}.hook_resid_pre",
+        hook_point_layer=[0, 1],
+        d_in=model.cfg.d_model,
+        context_size=128,
+        store_batch_size=32,
+        device="cpu",
+    )
+    dataset = Dataset.from_list(
+        [{"tokens": torch.randint(1, model.cfg.d_vocab, (1024,)).tolist()}] * 100
+    )
+    store = ActivationsStore.from_config(
+        model, cfg, dataset=dataset, create_dataloader=False
+    )
+    batch_tokens = store.get_batch_tokens()
+
+    run_with_cache_tokens_per_sec = _tokens_per_sec(
+        lambda: _get_activations_with_run_with_cache(store, batch_tokens),
+        batch_tokens.numel(),
+    )
+    hooks_tokens_per_sec = _tokens_per_sec(
+        lambda: store.get_activations(batch_tokens), batch_tokens.numel()
+    )
+
+    print(
+        f"\n{model_name} run_with_cache: {run_with_cache_tokens_per_sec:.0f} tokens/sec\n"
+        f"{model_name} hook capture: {hooks_tokens_per_sec:.0f} tokens/sec\n"
+        f"speedup: {hooks_tokens_per_sec / run_with_cache_tokens_per_sec:.2f}x"
+    )
+    assert hooks_tokens_per_sec > run_with_cache_tokens_per_sec
@@ -0,0 +1,47 @@
+import time
+from typing import Callable
+
+import pytest
+import torch
+
+from sae_lens.training.sparse_autoencoder import _sparse_decode
+
+
+def _ms_per_call(fn: Callable[[], torch.Tensor], n_calls: int = 5) -> float:
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        fn()
+    return (time.perf_counter() - start) / n_calls * 1000
+
+
+def _sparse_feature_acts(n_tokens: int, d_sae: int, l0: int) -> torch.Tensor:
+    feature_acts = torch.zeros(n_tokens, d_sae)
+    # a few features may be drawn twice, which is fine for timing
+    active = torch.randint(0, d_sae, (n_tokens, l0))
+    return feature_acts.scatter_(1, active, torch.rand(n_tokens, l0))
+
+
+@pytest.mark.parametrize("l0", [20, 100])
+def test_sparse_decode_vs_dense_decode_on_cpu_across_expansion_factors(l0: int):
+    torch.manual_seed(0)
+    d_in, n_tokens = 512, 4096
+    rows = []
+    for expansion_factor in [4, 8, 16, 32, 64]:
+        d_sae = d_in * expansion_factor
+        W_dec = torch.randn(d_sae, d_in)
+        feature_acts = _sparse_feature_acts(n_tokens, d_sae, l0)
+        with torch.no_grad():
+            dense_ms = _ms_per_call(lambda: feature_acts @ W_dec)
+            sparse_ms = _ms_per_call(lambda: _sparse_decode(feature_acts, W_dec))
+        rows.append((expansion_factor, l0 / d_sae, dense_ms, sparse_ms))
+
+    print(f"\nl0 = {l0}, {n_tokens} tokens, d_in = {d_in}")
+    for expansion_factor, density, dense_ms, sparse_ms in rows:
+        print(
+            f"{expansion_factor}x (density {density:.4f}): dense {dense_ms:.1f}ms, "
+            f"sparse {sparse_ms:.1f}ms, speedup {dense_ms / sparse_ms:.2f}x"
+        )
+    # the sparse decode wins for large, sparse SAEs
+    _, _, dense_ms, sparse_ms = rows[-1]
+    assert sparse_ms < dense_ms
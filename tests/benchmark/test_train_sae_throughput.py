@@ -0,0 +1,95 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+import torch
+
+from sae_lens.training.config import LanguageModelSAERunnerConfig
+from sae_lens.training.sae_group import SAEGroup
+from sae_lens.training.train_sae_on_language_model import (
+    train_sae_group_on_language_model,
+)
+
+
+def _get_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+class _RandomActivationsStore:
+    """
+    Just the parts of an ActivationsStore the training loop uses, serving random
+    activations so the benchmark only times training.
+    """
+
+    def __init__(self, cfg: LanguageModelSAERunnerConfig):
+        self.batch = torch.randn(cfg.train_batch_size, 1, cfg.d_in, device=cfg.device)
+        self.storage_buffer = self.batch
+        self.model_lock = threading.Lock()
+
+    def next_batch(self) -> torch.Tensor:
+        return self.batch
+
+    def close(self):
+        pass
+
+
+def _steps_per_sec(cfg: LanguageModelSAERunnerConfig) -> float:
+    sae_group = SAEGroup(cfg)
+    total_training_steps = cfg.total_training_tokens // cfg.train_batch_size
+    start = time.perf_counter()
+    train_sae_group_on_language_model(
+        cast(Any, None),  # the model is only used for evals, which need wandb
+        sae_group,
+        cast(Any, _RandomActivationsStore(cfg)),
+        batch_size=cfg.train_batch_size,
+        feature_sampling_window=cfg.feature_sampling_window,
+        wandb_log_frequency=cfg.wandb_log_frequency,
+    )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return total_training_steps / (time.perf_counter() - start)
+
+
+@pytest.mark.parametrize("fused_sae_training", [False, True])
+def test_train_sae_group_throughput_with_and_without_sync_free_training(
+    tmp_path: Path, fused_sae_training: bool
+):
+    def make_cfg(sync_free_training: bool) -> LanguageModelSAERunnerConfig:
+        torch.manual_seed(0)
+        return LanguageModelSAERunnerConfig(
+            d_in=512,
+            expansion_factor=4,
+            l1_coefficient=[1e-3, 4e-3],
+            train_batch_size=4096,
+            total_training_tokens=4096 * 100,
+            b_dec_init_method="zeros",
+            lr_warm_up_steps=0,
+            # ghost grads from the first step, so their gating is in every step
+            use_ghost_grads=True,
+            dead_feature_window=0,
+            feature_sampling_window=1000,
+            wandb_log_frequency=10,
+            log_to_wandb=False,
+            device=_get_device(),
+            checkpoint_path=str(tmp_path),
+            fused_sae_training=fused_sae_training,
+            sync_free_training=sync_free_training,
+            verbose=False,
+        )
+
+    default_steps_per_sec = _steps_per_sec(make_cfg(sync_free_training=False))
+    sync_free_steps_per_sec = _steps_per_sec(make_cfg(sync_free_training=True))
+
+    print(
+        f"\ndefault: {default_steps_per_sec:.1f} steps/sec\n"
+        f"sync free: {sync_free_steps_per_sec:.1f} steps/sec\n"
+        f"speedup: {sync_free_steps_per_sec / default_steps_per_sec:.2f}x"
+    )
+    if torch.cuda.is_available():
+        assert sync_free_steps_per_sec > default_steps_per_sec
@@ -0,0 +1,94 @@
+from pathlib import Path
+from typing import Any
+
+import pytest
+import torch
+
+from sae_lens.analysis.feature_batches import FeatureBatchManifest, run_feature_batches
+
+
+class _SumTokensRunner:
+    """
+    Stands in for a dashboard runner: a batch's result is the sum of the tokens of its
+    features, and who computed it.
+    """
+
+    def __init__(self, fail_on_batch: int | None = None):
+        self.fail_on_batch = fail_on_batch
+        self.init_sae_session()
+
+    def init_sae_session(self):
+        self.model = "loaded"
+
+    def process_feature_batch(
+        self, batch_id: int, features: list[int], tokens: torch.Tensor
+    ) -> Any:
+        if batch_id == self.fail_on_batch:
+            raise RuntimeError("pre-empted")
+        assert self.model == "loaded"
+        return tokens[features].sum().item()
+
+
+def _feature_batches() -> dict[int, list[int]]:
+    return {1: [0, 1], 2: [2, 3], 3: [4, 5]}
+
+
+def test_run_feature_batches_records_completed_batches_and_skips_them(tmp_path: Path):
+    tokens = torch.arange(6).reshape(6, 1)
+    results: dict[int, Any] = {}
+
+    def on_batch_done(batch_id: int, result: Any):
+        results[batch_id] = result
+
+    manifest = FeatureBatchManifest(str(tmp_path), n_features_at_a_time=2)
+    with pytest.raises(RuntimeError):
+        run_feature_batches(
+            _SumTokensRunner(fail_on_batch=2),
+            _feature_batches(),
+            tokens,
+            manifest,
+            on_batch_done=on_batch_done,
+        )
+    assert results == {1: 1}
+
+    # a new run picks up the batches that weren't done from the manifest on disk
+    manifest = FeatureBatchManifest(str(tmp_path), n_features_at_a_time=2)
+    assert 1 in manifest and 2 not in manifest
+    run_feature_batches(
+        _SumTokensRunner(),
+        _feature_batches(),
+        tokens,
+        manifest,
+        on_batch_done=on_batch_done,
+    )
+    assert results == {1: 1, 2: 5, 3: 9}
+    assert FeatureBatchManifest(str(tmp_path), 2).completed_batches == {1, 2, 3}
+
+
+def test_run_feature_batches_across_worker_processes(tmp_path: Path):
+    tokens = torch.arange(6).reshape(6, 1)
+    results: dict[int, Any] = {}
+
+    def on_batch_done(batch_id: int, result: Any):
+        results[batch_id] = result
+
+    manifest = FeatureBatchManifest(str(tmp_path), n_features_at_a_time=2)
+    manifest.mark_completed(1)
+    run_feature_batches(
+        _SumTokensRunner(),
+        _feature_batches(),
+        tokens,
+        manifest,
+        n_workers=2,
+        on_batch_done=on_batch_done,
+    )
+    assert results == {2: 5, 3: 9}
+    assert manifest.completed_batches == {1, 2, 3}
+    # only the manifest is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["manifest.json"]
+
+
+def test_FeatureBatchManifest_refuses_batches_of_a_different_size(tmp_path: Path):
+    FeatureBatchManifest(str(tmp_path), n_features_at_a_time=2).mark_completed(1)
+    with pytest.raises(ValueError):
+        FeatureBatchManifest(str(tmp_path), n_features_at_a_time=4)
@@ -0,0 +1,162 @@
+import json
+from itertools import chain
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+from sae_lens.analysis.feature_batches import FeatureBatchManifest, run_feature_batches
+from sae_lens.analysis.neuronpedia_runner import (
+    OUT_OF_RANGE_TOKEN,
+    NeuronpediaRunner,
+    _unflatten,
+)
+from sae_lens.training.sae_group import SAEGroup
+from tests.unit.helpers import build_sae_cfg
+
+D_VOCAB = 20
+
+
+def _old_to_str_tokens(vocab_dict: dict[int, str], tokens: Any) -> Any:
+    # the per token lookup the runner used to do
+    if isinstance(tokens, int):
+        return vocab_dict[tokens] if tokens < D_VOCAB else OUT_OF_RANGE_TOKEN
+    tokens = torch.tensor(tokens)
+    str_tokens = [
+        (vocab_dict[t] if t < D_VOCAB else OUT_OF_RANGE_TOKEN)
+        for t in tokens.flatten().tolist()
+    ]
+    return np.reshape(str_tokens, tokens.shape).tolist()
+
+
+def _old_round_list(to_round: Any) -> list[float]:
+    return list(np.round(to_round, 3))
+
+
+def _old_activation(vocab_dict: dict[int, str], sd: Any) -> dict[str, Any]:
+    strs = []
+    posContribs = []
+    negContribs = []
+    for i in range(len(sd.token_ids)):
+        strs.append(_old_to_str_tokens(vocab_dict, sd.token_ids[i]))
+        for token_ids, logits, contribs in [
+            (sd.top_token_ids, sd.top_logits, posContribs),
+            (sd.bottom_token_ids, sd.bottom_logits, negContribs),
+        ]:
+            contrib = {}
+            tokens = [_old_to_str_tokens(vocab_dict, j) for j in token_ids[i]]
+            if len(tokens) > 0:
+                contrib["t"] = tokens
+                contrib["v"] = _old_round_list(logits[i])
+            contribs.append(contrib)
+    return {
+        "logitContributions": json.dumps({"pos": posContribs, "neg": negContribs}),
+        "tokens": strs,
+        "values": _old_round_list(sd.feat_acts),
+    }
+
+
+def _random_seq_data(generator: torch.Generator, seq_len: int) -> SimpleNamespace:
+    def token_ids(n: int) -> list[int]:
+        # some of them past the end of the vocab
+        return torch.randint(0, D_VOCAB + 5, (n,), generator=generator).tolist()
+
+    def logits(n: int) -> list[float]:
+        return (torch.randn(n, generator=generator, dtype=torch.float64) * 3).tolist()
+
+    # a varying number of logit contributions at each position, including none
+    n_contribs = torch.randint(0, 4, (seq_len,), generator=generator).tolist()
+    return SimpleNamespace(
+        token_ids=token_ids(seq_len),
+        feat_acts=logits(seq_len),
+        top_token_ids=[token_ids(n) for n in n_contribs],
+        top_logits=[logits(n) for n in n_contribs],
+        bottom_token_ids=[token_ids(n) for n in n_contribs[::-1]],
+        bottom_logits=[logits(n) for n in n_contribs[::-1]],
+    )
+
+
+def test_vectorized_outputs_match_the_per_token_ones():
+    runner = NeuronpediaRunner.__new__(NeuronpediaRunner)
+    vocab_dict = {i: f"tok{i}" for i in range(D_VOCAB - 2)}
+    for i in range(len(vocab_dict), D_VOCAB):
+        vocab_dict[i] = OUT_OF_RANGE_TOKEN
+    vocab_strs = np.array([vocab_dict[i] for i in range(D_VOCAB)], dtype=object)
+
+    generator = torch.Generator().manual_seed(0)
+    sds = [_random_seq_data(generator, seq_len) for seq_len in [5, 1, 8, 3]]
+
+    top_token_ids = [[3, 0, D_VOCAB + 1], [D_VOCAB - 1, 7, 2]]
+    assert runner.to_str_tokens_vectorized(
+        vocab_strs, top_token_ids
+    ) == _old_to_str_tokens(vocab_dict, top_token_ids)
+
+    seq_lengths = [len(sd.token_ids) for sd in sds]
+    seq_strs = _unflatten(
+        runner.to_str_tokens_vectorized(
+            vocab_strs, list(chain.from_iterable(sd.token_ids for sd in sds))
+        ),
+        seq_lengths,
+    )
+    seq_pos_contribs = _unflatten(
+        runner._logit_contributions(
+            vocab_strs,
+            [sd.top_token_ids for sd in sds],
+            [sd.top_logits for sd in sds],
+            seq_lengths,
+        ),
+        seq_lengths,
+    )
+    seq_neg_contribs = _unflatten(
+        runner._logit_contributions(
+            vocab_strs,
+            [sd.bottom_token_ids for sd in sds],
+            [sd.bottom_logits for sd in sds],
+            seq_lengths,
+        ),
+        seq_lengths,
+    )
+
+    for sd, strs, posContribs, negContribs in zip(
+        sds, seq_strs, seq_pos_contribs, seq_neg_contribs
+    ):
+        activation = {
+            "logitContributions": json.dumps({"pos": posContribs, "neg": negContribs}),
+            "tokens": strs,
+            "values": runner.round_list(sd.feat_acts),
+        }
+        assert activation == _old_activation(vocab_dict, sd)
+
+
+class _SessionReportingRunner(NeuronpediaRunner):
+    def process_feature_batch(
+        self, batch_id: int, features: list[int], tokens: torch.Tensor
+    ) -> Any:
+        # whether the worker's own session filled an activation buffer
+        return hasattr(self.activation_store, "dataloader")
+
+
+def test_workers_dont_fill_an_activation_buffer(tmp_path: Path):
+    dataset_path = str(tmp_path / "dataset")
+    Dataset.from_list([{"text": "hello world"}] * 10).save_to_disk(dataset_path)
+    sae_path = str(tmp_path / "sae_group.pt")
+    SAEGroup(build_sae_cfg(dataset_path=dataset_path)).save_model(sae_path)
+    output_folder = tmp_path / "outputs"
+    output_folder.mkdir()
+
+    runner = _SessionReportingRunner.__new__(_SessionReportingRunner)
+    runner.sae_path = sae_path
+    results: dict[int, Any] = {}
+    run_feature_batches(
+        runner,
+        {1: [0], 2: [1]},
+        torch.zeros(2, 6, dtype=torch.long),
+        FeatureBatchManifest(str(output_folder), n_features_at_a_time=1),
+        n_workers=2,
+        on_batch_done=results.__setitem__,
+    )
+
+    assert results == {1: False, 2: False}
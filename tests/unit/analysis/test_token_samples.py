@@ -0,0 +1,92 @@
+import warnings
+from pathlib import Path
+from typing import Any, cast
+
+import torch
+
+from sae_lens.analysis.token_samples import get_token_sample
+from tests.unit.helpers import build_sae_cfg
+
+
+class _CountingActivationsStore:
+    """
+    Batches of consecutive token ids, counting how many were streamed.
+    """
+
+    def __init__(self, store_batch_size: int, context_size: int):
+        self.batch_shape = (store_batch_size, context_size)
+        self.device = torch.device("cpu")
+        self.n_batches_streamed = 0
+
+    def get_batch_tokens(self) -> torch.Tensor:
+        n_tokens = self.batch_shape[0] * self.batch_shape[1]
+        start = self.n_batches_streamed * n_tokens
+        self.n_batches_streamed += 1
+        return torch.arange(start, start + n_tokens).reshape(self.batch_shape)
+
+
+def test_get_token_sample_is_cached_and_reused(tmp_path: Path):
+    cfg = build_sae_cfg(seed=0)
+    store = _CountingActivationsStore(cfg.store_batch_size, cfg.context_size)
+
+    tokens = get_token_sample(
+        cast(Any, store), cfg, 8, 10, cache_dir=str(tmp_path / "token_samples")
+    )
+    assert tokens.shape == (10, cfg.context_size)
+    assert store.n_batches_streamed == 8
+
+    cached_tokens = get_token_sample(
+        cast(Any, store), cfg, 8, 10, cache_dir=str(tmp_path / "token_samples")
+    )
+    assert store.n_batches_streamed == 8
+    assert torch.equal(cached_tokens, tokens)
+
+
+def test_get_token_sample_returns_the_same_kind_of_tensor_when_cached(tmp_path: Path):
+    cfg = build_sae_cfg(seed=0)
+    store = _CountingActivationsStore(cfg.store_batch_size, cfg.context_size)
+    cache_dir = str(tmp_path / "token_samples")
+
+    tokens = get_token_sample(cast(Any, store), cfg, 8, 10, cache_dir=cache_dir)
+    cached_tokens = get_token_sample(cast(Any, store), cfg, 8, 10, cache_dir=cache_dir)
+
+    assert cached_tokens.device == tokens.device
+    assert cached_tokens.dtype == tokens.dtype
+    # writable, and writing to it doesn't touch the cache
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        cached_tokens[0, 0] = -1
+    reloaded_tokens = get_token_sample(
+        cast(Any, store), cfg, 8, 10, cache_dir=cache_dir
+    )
+    assert torch.equal(reloaded_tokens, tokens)
+
+
+def test_get_token_sample_caches_each_seed_and_sample_size_separately(tmp_path: Path):
+    cache_dir = str(tmp_path / "token_samples")
+    cfg = build_sae_cfg(seed=0)
+    store = _CountingActivationsStore(cfg.store_batch_size, cfg.context_size)
+
+    get_token_sample(cast(Any, store), cfg, 8, 10, cache_dir=cache_dir)
+    get_token_sample(cast(Any, store), cfg, 8, 12, cache_dir=cache_dir)
+    get_token_sample(
+        cast(Any, store), build_sae_cfg(seed=1), 8, 10, cache_dir=cache_dir
+    )
+    assert store.n_batches_streamed == 24
+    assert len(list(Path(cache_dir).glob("*.npy"))) == 3
+
+
+def test_get_token_sample_is_seeded():
+    cfg = build_sae_cfg(seed=0)
+    samples = [
+        get_token_sample(
+            cast(
+                Any, _CountingActivationsStore(cfg.store_batch_size, cfg.context_size)
+            ),
+            cfg,
+            8,
+            10,
+        )
+        for _ in range(2)
+    ]
+    assert torch.equal(samples[0], samples[1])
@@ -0,0 +1,151 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+import torch
+
+from sae_lens.training.activations_cache import (
+    CACHE_METADATA_FILENAME,
+    ActivationsCache,
+)
+from sae_lens.training.utils import shuffle_activations_pairwise
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_ActivationsCache_round_trips_shards(tmp_path: Path, dtype: torch.dtype):
+    cache = ActivationsCache.create(str(tmp_path), num_layers=2, d_in=3, dtype=dtype)
+    shard0 = torch.randn(5, 2, 3).to(dtype)
+    shard1 = torch.randn(4, 2, 3).to(dtype)
+    cache.write_shard(0, shard0)
+    cache.write_shard(1, shard1)
+
+    # reopen from disk, all we need is in the header
+    cache = ActivationsCache(str(tmp_path))
+    assert not cache.is_legacy
+    assert cache.dtype == dtype
+    assert cache.n_shards == 2
+    assert cache.n_activations == 9
+    assert torch.equal(cache.load_shard(0), shard0)
+    assert torch.equal(cache.load_shard(1), shard1)
+
+    with open(tmp_path / CACHE_METADATA_FILENAME) as f:
+        metadata = json.load(f)
+    assert metadata["shard_rows"] == [5, 4]
+    assert cache.n_dataset_examples is None
+    assert os.path.getsize(tmp_path / "0.bin") == shard0.numel() * shard0.itemsize
+
+
+def test_ActivationsCache_load_shard_does_not_write_through_to_disk(tmp_path: Path):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=4, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.ones(3, 1, 4))
+    cache.load_shard(0).zero_()
+    assert torch.equal(cache.load_shard(0), torch.ones(3, 1, 4))
+
+
+def test_ActivationsCache_can_overwrite_shards(tmp_path: Path):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=2, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.zeros(3, 1, 2))
+    cache.write_shard(0, torch.ones(3, 1, 2))
+    assert cache.n_shards == 1
+    assert torch.equal(cache.load_shard(0), torch.ones(3, 1, 2))
+    with pytest.raises(ValueError):
+        cache.write_shard(2, torch.ones(3, 1, 2))
+
+
+def test_ActivationsCache_reads_legacy_pt_caches(tmp_path: Path):
+    shards = [torch.randn(4, 1, 3) for _ in range(3)]
+    for i, shard in enumerate(shards):
+        torch.save(shard, tmp_path / f"{i}.pt")
+
+    cache = ActivationsCache(str(tmp_path))
+    assert cache.is_legacy
+    assert cache.n_shards == 3
+    assert cache.n_activations == 12
+    for i, shard in enumerate(shards):
+        assert torch.equal(cache.load_shard(i), shard)
+
+
+def test_shuffle_activations_pairwise_keeps_all_activations(tmp_path: Path):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=1, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.arange(0, 10.0).reshape(10, 1, 1))
+    cache.write_shard(1, torch.arange(10, 20.0).reshape(10, 1, 1))
+
+    shuffle_activations_pairwise(str(tmp_path), buffer_idx_range=(0, 2))
+
+    cache = ActivationsCache(str(tmp_path))
+    assert cache.shard_rows == [10, 10]
+    all_acts = torch.cat([cache.load_shard(0), cache.load_shard(1)]).flatten()
+    assert sorted(all_acts.tolist()) == list(range(20))
+
+
+def test_ActivationsCache_shuffle_only_writes_a_block_order(tmp_path: Path):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=1, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.arange(0, 10.0).reshape(10, 1, 1))
+    cache.write_shard(1, torch.arange(10, 17.0).reshape(7, 1, 1))
+    shard_bytes = (tmp_path / "0.bin").read_bytes()
+
+    assert cache.read_order() == [(0, 0, None), (1, 0, None)]
+    cache.shuffle(seed=0, block_size=4)
+    assert (tmp_path / "0.bin").read_bytes() == shard_bytes
+
+    # reopening picks up the shuffle
+    cache = ActivationsCache(str(tmp_path))
+    read_order = cache.read_order()
+    assert sorted(read_order) == [
+        (0, 0, 4),
+        (0, 4, 8),
+        (0, 8, 10),
+        (1, 0, 4),
+        (1, 4, 7),
+    ]
+    rows = torch.cat(
+        [cache.load_shard(shard)[start:end] for shard, start, end in read_order]
+    )
+    assert sorted(rows.flatten().tolist()) == list(range(17))
+
+    # the same seed gives the same order, reshuffling with another seed is cheap
+    cache.shuffle(seed=0, block_size=4)
+    assert cache.read_order() == read_order
+    orders = set()
+    for seed in range(1, 6):
+        cache.shuffle(seed=seed, block_size=4)
+        orders.add(tuple(cache.read_order()))
+    assert len(orders) > 1
+
+
+def test_ActivationsCache_writing_a_shard_drops_the_shuffle(tmp_path: Path):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=1, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.zeros(8, 1, 1))
+    cache.shuffle(seed=0, block_size=2)
+    cache.write_shard(1, torch.zeros(8, 1, 1))
+    assert ActivationsCache(str(tmp_path)).read_order() == [(0, 0, None), (1, 0, None)]
+
+
+def test_ActivationsCache_shuffle_is_not_supported_for_legacy_caches(tmp_path: Path):
+    torch.save(torch.zeros(4, 1, 1), tmp_path / "0.pt")
+    with pytest.raises(ValueError):
+        ActivationsCache(str(tmp_path)).shuffle(seed=0)
+
+
+def test_ActivationsCache_records_how_many_dataset_examples_it_covers(
+    tmp_path: Path,
+):
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=1, dtype=torch.float32
+    )
+    cache.write_shard(0, torch.zeros(4, 1, 1), n_dataset_examples=3)
+    cache.write_shard(1, torch.zeros(4, 1, 1), n_dataset_examples=7)
+    # rewriting a shard while shuffling doesn't change what the cache covers
+    cache.write_shard(0, torch.ones(4, 1, 1))
+    assert ActivationsCache(str(tmp_path)).n_dataset_examples == 7
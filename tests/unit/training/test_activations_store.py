@@ -1,12 +1,18 @@
 from collections.abc import Iterable
 from math import ceil
+from pathlib import Path
 
 import pytest
 import torch
 from datasets import Dataset, IterableDataset
 from transformer_lens import HookedTransformer
 
-from sae_lens.training.activations_store import ActivationsStore
+from sae_lens.training.activations_cache import ActivationsCache
+from sae_lens.training.activations_store import (
+    ActivationsStore,
+    _iterate_batches,
+    _pack_tokens,
+)
 from sae_lens.training.config import LanguageModelSAERunnerConfig
 from tests.unit.helpers import build_sae_cfg, load_model_cached
 
@@ -218,3 +224,315 @@ def test_activations_store__get_next_dataset_tokens__tokenizes_each_example_in_o
     assert activation_store._get_next_dataset_tokens().tolist() == tokenize_with_bos(
         ts_model, "hello world3"
     )
+
+
+def test_pack_tokens_without_bos_is_a_plain_reshape():
+    stream = torch.arange(10)
+    batch, n_consumed = _pack_tokens(
+        stream, n_rows=2, context_size=4, bos_token_id=None
+    )
+    assert batch.tolist() == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert n_consumed == 8
+
+
+def test_pack_tokens_inserts_bos_at_row_starts_that_lack_one():
+    stream = torch.tensor([1, 2, 3, 4, 5, 0, 6, 7, 8, 9, 10, 11])
+    batch, n_consumed = _pack_tokens(stream, n_rows=3, context_size=3, bos_token_id=0)
+    assert batch.tolist() == [[1, 2, 3], [0, 4, 5], [0, 6, 7]]
+    assert n_consumed == 8
+
+
+def test_activations_store__get_batch_tokens__carries_over_unused_documents(
+    ts_model: HookedTransformer,
+):
+    assert ts_model.tokenizer is not None
+    bos = ts_model.tokenizer.bos_token_id
+    dataset = Dataset.from_list([{"tokens": [i]} for i in range(5, 105)])
+    cfg = build_sae_cfg(store_batch_size=2, context_size=4, prepend_bos=True)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+
+    # the second row needs a BOS inserted, so it ends 1 token early. The document
+    # after it is dropped (as it would be when packing one document at a time),
+    # but the one after that was already pulled and has to be reused.
+    assert activation_store.get_batch_tokens().tolist() == [
+        [5, 6, 7, 8],
+        [bos, 9, 10, 11],
+    ]
+    assert activation_store.get_batch_tokens().tolist() == [
+        [13, 14, 15, 16],
+        [bos, 17, 18, 19],
+    ]
+
+
+def test_activations_store__prefetch_activations_refills_in_the_background(
+    ts_model: HookedTransformer,
+):
+    dataset = Dataset.from_list([{"tokens": list(range(1, 200))}] * 500)
+    cfg = build_sae_cfg(prefetch_activations=True)
+    activation_store = ActivationsStore.from_config(ts_model, cfg, dataset=dataset)
+    assert activation_store._prefetcher is not None
+
+    n_batches_per_refill = (
+        cfg.store_batch_size * cfg.context_size * cfg.n_batches_in_buffer // 2
+    ) // cfg.train_batch_size
+    for _ in range(3 * n_batches_per_refill):
+        batch = activation_store.next_batch()
+        assert batch.shape == (cfg.train_batch_size, 1, cfg.d_in)
+
+    activation_store.close()
+    assert activation_store._prefetcher is None
+    # keeps working synchronously once closed
+    for _ in range(2 * n_batches_per_refill):
+        batch = activation_store.next_batch()
+        assert batch.shape == (cfg.train_batch_size, 1, cfg.d_in)
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_activations_store__reads_buffers_from_the_activations_cache(
+    ts_model: HookedTransformer, tmp_path: Path, legacy: bool
+):
+    cfg = build_sae_cfg(
+        use_cached_activations=True,
+        cached_activations_path=str(tmp_path),
+        total_training_tokens=20,
+        store_batch_size=2,
+        context_size=3,
+        n_batches_in_buffer=2,
+    )
+    shards = [
+        torch.arange(10 * i, 10 * (i + 1), dtype=torch.float32)
+        .reshape(10, 1, 1)
+        .expand(10, 1, cfg.d_in)
+        for i in range(3)
+    ]
+    if legacy:
+        for i, shard in enumerate(shards):
+            torch.save(shard.clone(), tmp_path / f"{i}.pt")
+    else:
+        cache = ActivationsCache.create(
+            str(tmp_path), num_layers=1, d_in=cfg.d_in, dtype=torch.float32
+        )
+        for i, shard in enumerate(shards):
+            cache.write_shard(i, shard)
+
+    dataset = Dataset.from_list([{"text": "hello world"}] * 10)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    # buffers are read in order, picking up mid-file where the last one stopped
+    buffer_rows = []
+    for _ in range(3):
+        buffer = activation_store.get_buffer(cfg.n_batches_in_buffer)
+        assert buffer.shape[1:] == (1, cfg.d_in)
+        buffer_rows.append(buffer[:, 0, 0].tolist())
+    assert buffer_rows[0] == list(range(0, 12))
+    assert buffer_rows[1] == list(range(12, 24))
+    # only 30 activations on disk, so the last buffer comes up short
+    assert buffer_rows[2] == list(range(24, 30))
+
+
+def test_activations_store__follows_the_cache_shuffle_index(
+    ts_model: HookedTransformer, tmp_path: Path
+):
+    cfg = build_sae_cfg(
+        use_cached_activations=True,
+        cached_activations_path=str(tmp_path),
+        total_training_tokens=20,
+        store_batch_size=2,
+        context_size=3,
+        n_batches_in_buffer=2,
+    )
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=cfg.d_in, dtype=torch.float32
+    )
+    for i in range(3):
+        shard = torch.arange(10 * i, 10 * (i + 1), dtype=torch.float32)
+        cache.write_shard(i, shard.reshape(10, 1, 1).expand(10, 1, cfg.d_in))
+    cache.shuffle(seed=1, block_size=5)
+
+    expected_rows = [
+        row
+        for shard, start, end in cache.read_order()
+        for row in range(10 * shard, 10 * shard + 10)[start:end]
+    ]
+    dataset = Dataset.from_list([{"text": "hello world"}] * 10)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    rows = []
+    for _ in range(3):
+        rows += activation_store.get_buffer(cfg.n_batches_in_buffer)[:, 0, 0].tolist()
+    assert rows == expected_rows
+
+
+def test_activations_store__storage_dtype_is_separate_from_the_compute_dtype(
+    ts_model: HookedTransformer,
+):
+    dataset = Dataset.from_list([{"tokens": list(range(1, 200))}] * 500)
+    cfg = build_sae_cfg(storage_dtype=torch.bfloat16)
+    activation_store = ActivationsStore.from_config(ts_model, cfg, dataset=dataset)
+
+    assert activation_store.get_buffer(2).dtype == torch.bfloat16
+    # the held back activations are a view of the buffer, so they're never upcast
+    # all at once
+    assert activation_store.storage_buffer.dtype == torch.bfloat16
+    n_batches_per_refill = (
+        cfg.store_batch_size * cfg.context_size * cfg.n_batches_in_buffer // 2
+    ) // cfg.train_batch_size
+    for _ in range(3 * n_batches_per_refill):
+        batch = activation_store.next_batch()
+        assert batch.dtype == torch.float32
+        assert batch.shape == (cfg.train_batch_size, 1, cfg.d_in)
+
+
+def test_activations_store__mixing_buffer_is_refilled_in_place(
+    ts_model: HookedTransformer, tmp_path: Path
+):
+    # 8 activations per half buffer, each row labelled by its position on disk
+    cfg = build_sae_cfg(
+        use_cached_activations=True,
+        cached_activations_path=str(tmp_path),
+        total_training_tokens=100,
+        store_batch_size=2,
+        context_size=4,
+        n_batches_in_buffer=2,
+        train_batch_size=2,
+    )
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=cfg.d_in, dtype=torch.float32
+    )
+    acts = torch.arange(200, dtype=torch.float32).reshape(200, 1, 1)
+    cache.write_shard(0, acts.expand(200, 1, cfg.d_in))
+    dataset = Dataset.from_list([{"text": "hello world"}] * 10)
+    activation_store = ActivationsStore.from_config(ts_model, cfg, dataset=dataset)
+    mixing_buffer = activation_store._mixing_buffer
+    assert mixing_buffer.shape == (16, 1, cfg.d_in)
+
+    served = []
+    for _ in range(40):
+        served += activation_store.next_batch()[:, 0, 0].tolist()
+    # the buffer is never reallocated
+    assert activation_store._mixing_buffer is mixing_buffer
+    # every activation is served at most once, and everything read so far is
+    # either served or still held in storage
+    storage_buffer = activation_store.storage_buffer
+    # the stored half is kept at the front of the buffer, so this is a view of it
+    assert storage_buffer.data_ptr() == mixing_buffer.data_ptr()
+    held = storage_buffer[:, 0, 0].tolist()
+    assert len(set(served)) == len(served)
+    assert sorted(served + held) == list(range(len(served) + len(held)))
+
+
+def test_iterate_batches_yields_consecutive_views():
+    activations = torch.arange(10.0).reshape(10, 1, 1)
+    batches = list(_iterate_batches(activations, batch_size=4))
+    assert [b.flatten().tolist() for b in batches] == [
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+        [8, 9],
+    ]
+    # no copies
+    assert all(
+        b.data_ptr() == activations[4 * i].data_ptr() for i, b in enumerate(batches)
+    )
+
+
+def test_iterate_batches_gathers_batches_in_order_and_casts_them():
+    activations = torch.arange(10.0).reshape(10, 1, 1)
+    order = torch.tensor([3, 9, 0, 5, 1, 8, 2, 7, 4, 6])
+    batches = list(
+        _iterate_batches(activations, batch_size=4, order=order, dtype=torch.bfloat16)
+    )
+    assert [b.flatten().tolist() for b in batches] == [
+        [3, 9, 0, 5],
+        [1, 8, 2, 7],
+        [4, 6],
+    ]
+    assert all(b.dtype == torch.bfloat16 for b in batches)
+
+
+def test_activations_store__streams_from_the_dataset_once_the_cache_runs_out(
+    ts_model: HookedTransformer, tmp_path: Path
+):
+    # every document has its own tokens, so we can tell if any come back
+    dataset = Dataset.from_list(
+        [{"tokens": list(range(5 * i + 1, 5 * i + 6))} for i in range(200)]
+    )
+    cfg = build_sae_cfg(
+        store_batch_size=2,
+        context_size=4,
+        n_batches_in_buffer=2,
+        prepend_bos=False,
+        total_training_tokens=100,
+    )
+
+    # cache 3 batches worth of activations
+    caching_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    cached_tokens = torch.cat([caching_store.get_batch_tokens() for _ in range(3)])
+    cache = ActivationsCache.create(
+        str(tmp_path), num_layers=1, d_in=cfg.d_in, dtype=torch.float32
+    )
+    cache.write_shard(
+        0,
+        caching_store.get_activations(cached_tokens).reshape(-1, 1, cfg.d_in),
+        n_dataset_examples=caching_store.n_dataset_examples_consumed,
+    )
+
+    cfg.use_cached_activations = True
+    cfg.cached_activations_path = str(tmp_path)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    assert activation_store.get_buffer(2).shape[0] == 16
+    # the cache runs out halfway through this buffer
+    assert activation_store.get_buffer(2).shape[0] == 8
+    assert activation_store.streaming_after_cache
+
+    # streaming picks up right where the caching run stopped
+    streamed_tokens = activation_store.get_batch_tokens()
+    assert streamed_tokens.tolist() == caching_store.get_batch_tokens().tolist()
+    assert not set(streamed_tokens.flatten().tolist()) & set(
+        cached_tokens.flatten().tolist()
+    )
+    assert activation_store.get_buffer(2).shape[0] == 16
+
+
+def test_activations_store__get_activations_writes_into_out_and_matches_run_with_cache(
+    ts_model: HookedTransformer,
+):
+    dataset = Dataset.from_list([{"tokens": list(range(1, 200))}] * 50)
+    cfg = build_sae_cfg(
+        hook_point="blocks.{layer}.hook_resid_pre", hook_point_layer=[0, 1]
+    )
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    batch = activation_store.get_batch_tokens()
+    _, cache = ts_model.run_with_cache(batch, prepend_bos=cfg.prepend_bos)
+    expected = torch.stack(
+        [cache["blocks.0.hook_resid_pre"], cache["blocks.1.hook_resid_pre"]], dim=2
+    )
+
+    out = torch.zeros(*batch.shape, 2, cfg.d_in, dtype=torch.bfloat16)
+    activations = activation_store.get_activations(batch, out=out)
+    assert activations is out
+    assert torch.allclose(out.float(), expected, atol=0.1, rtol=0.02)
+    assert torch.allclose(activation_store.get_activations(batch), expected, atol=1e-5)
+
+
+def test_activations_store__get_activations_with_autocast(
+    ts_model: HookedTransformer,
+):
+    dataset = Dataset.from_list([{"tokens": list(range(1, 200))}] * 50)
+    cfg = build_sae_cfg(autocast_lm=True)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, dataset=dataset, create_dataloader=False
+    )
+    activations = activation_store.get_activations(activation_store.get_batch_tokens())
+    assert activations.dtype == cfg.dtype
+    assert activations.shape == (cfg.store_batch_size, cfg.context_size, 1, cfg.d_in)
+    assert activations.isfinite().all()
@@ -0,0 +1,146 @@
+import os
+import threading
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+import torch
+
+from sae_lens.training.checkpoint_writer import CheckpointWriter, snapshot_to_cpu
+from sae_lens.training.sae_group import SAEGroup
+from sae_lens.training.train_sae_on_language_model import (
+    SAETrainContext,
+    _save_checkpoint,
+    train_sae_group_on_language_model,
+)
+from tests.unit.helpers import build_sae_cfg
+
+
+def test_CheckpointWriter_runs_writes_in_order_off_the_calling_thread():
+    writer = CheckpointWriter(max_pending=1)
+    written = []
+    for i in range(5):
+        writer.submit(lambda i=i: written.append((i, threading.current_thread())))
+    writer.flush()
+
+    assert [i for i, _ in written] == list(range(5))
+    assert all(thread is not threading.current_thread() for _, thread in written)
+    writer.close()
+
+
+def test_CheckpointWriter_reraises_a_failed_write_in_the_calling_thread():
+    writer = CheckpointWriter()
+
+    def fail():
+        raise OSError("disk full")
+
+    writer.submit(fail)
+    with pytest.raises(OSError, match="disk full"):
+        writer.flush()
+    # the error is only raised once, and the writer keeps working
+    written = []
+    writer.submit(lambda: written.append(1))
+    writer.close()
+    assert written == [1]
+
+
+@torch.no_grad()
+def test_snapshot_to_cpu_copies_every_tensor():
+    sae_group = SAEGroup(build_sae_cfg(d_in=8, expansion_factor=2))
+    sae = sae_group.autoencoders[0]
+    sae.get_dead_neuron_indices(torch.ones(16, dtype=torch.bool), version=0)
+
+    snapshot, copied = snapshot_to_cpu(sae_group)
+    sae.W_dec.add_(1.0)
+
+    assert copied is None  # nothing was on the GPU
+    snapshot_sae = snapshot.autoencoders[0]
+    assert isinstance(snapshot_sae.W_dec, torch.nn.Parameter)
+    assert torch.allclose(snapshot_sae.W_dec + 1.0, sae.W_dec)
+    # the dead neuron cache isn't part of the SAE's state
+    assert snapshot_sae._dead_neuron_indices is None
+    assert snapshot.cfg == sae_group.cfg
+
+
+@pytest.mark.parametrize("async_checkpoint", [False, True])
+def test_save_checkpoint_writes_the_group_and_its_sparsities(
+    tmp_path: Path, async_checkpoint: bool
+):
+    sae_group = SAEGroup(
+        build_sae_cfg(d_in=8, expansion_factor=2, checkpoint_path=str(tmp_path))
+    )
+    train_contexts = [
+        SAETrainContext(
+            act_freq_scores=torch.rand(16),
+            n_forward_passes_since_fired=torch.zeros(16),
+            n_frac_active_tokens=1,
+            optimizer=cast(Any, None),
+            scheduler=cast(Any, None),
+        )
+    ]
+    checkpoint_writer = CheckpointWriter() if async_checkpoint else None
+
+    res = _save_checkpoint(
+        sae_group, train_contexts, "final", checkpoint_writer=checkpoint_writer
+    )
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [os.path.basename(res.path), os.path.basename(res.log_feature_sparsity_path)]
+    )
+    loaded = SAEGroup.load_from_pretrained(res.path)
+    assert isinstance(loaded, SAEGroup)
+    assert torch.equal(loaded.autoencoders[0].W_dec, sae_group.autoencoders[0].W_dec)
+    log_feature_sparsities = torch.load(
+        res.log_feature_sparsity_path, weights_only=True
+    )
+    assert torch.equal(log_feature_sparsities[0], res.log_feature_sparsities[0])
+
+
+class _FailingActivationsStore:
+    """
+    Has a buffer to initialize the SAEs from, but fails on the first training batch.
+    """
+
+    def __init__(self, d_in: int):
+        self.storage_buffer = torch.randn(32, 1, d_in)
+        self.n_closes = 0
+
+    def next_batch(self) -> torch.Tensor:
+        raise RuntimeError("dataset went away")
+
+    def close(self):
+        self.n_closes += 1
+
+
+def test_train_sae_group_on_language_model_cleans_up_when_training_fails(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    checkpoint_writers: list[CheckpointWriter] = []
+
+    class _RecordingCheckpointWriter(CheckpointWriter):
+        def __init__(self):
+            super().__init__()
+            checkpoint_writers.append(self)
+
+    monkeypatch.setattr(
+        "sae_lens.training.train_sae_on_language_model.CheckpointWriter",
+        _RecordingCheckpointWriter,
+    )
+    sae_group = SAEGroup(
+        build_sae_cfg(d_in=8, expansion_factor=2, async_checkpointing=True)
+    )
+    activation_store = _FailingActivationsStore(d_in=8)
+
+    with pytest.raises(RuntimeError, match="dataset went away"):
+        train_sae_group_on_language_model(
+            model=cast(Any, None),
+            sae_group=sae_group,
+            activation_store=cast(Any, activation_store),
+            batch_size=4,
+        )
+
+    assert activation_store.n_closes >= 1
+    assert len(checkpoint_writers) == 1
+    assert checkpoint_writers[0]._closed
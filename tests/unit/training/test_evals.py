@@ -0,0 +1,200 @@
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from sae_lens.training.evals import (
+    EvalTokens,
+    get_group_recons_metrics,
+    get_recons_metrics,
+    recons_loss_batched,
+)
+from sae_lens.training.sparse_autoencoder import SparseAutoencoder
+from tests.unit.helpers import build_sae_cfg
+
+
+@pytest.fixture(scope="module")
+def model() -> HookedTransformer:
+    cfg = HookedTransformerConfig(
+        n_layers=3,
+        d_model=32,
+        d_head=8,
+        n_heads=4,
+        d_mlp=64,
+        d_vocab=100,
+        n_ctx=16,
+        act_fn="gelu",
+        device="cpu",
+        seed=0,
+    )
+    return HookedTransformer(cfg)
+
+
+def _losses_with_separate_forward_passes(
+    sae: SparseAutoencoder, model: HookedTransformer, tokens: torch.Tensor
+) -> list[torch.Tensor]:
+    hook_point = sae.cfg.hook_point
+    head_index = sae.cfg.hook_point_head_index
+
+    def replacement_hook(activations: torch.Tensor, hook: Any):
+        if head_index is not None:
+            activations[:, :, head_index] = sae(activations[:, :, head_index]).sae_out
+            return activations
+        if "hook_z" in hook_point:
+            return sae(activations.flatten(-2, -1)).sae_out.reshape(activations.shape)
+        return sae(activations).sae_out
+
+    def zero_ablate_hook(activations: torch.Tensor, hook: Any):
+        return torch.zeros_like(activations)
+
+    return [
+        model(tokens, return_type="loss"),
+        model.run_with_hooks(
+            tokens, return_type="loss", fwd_hooks=[(hook_point, replacement_hook)]
+        ),
+        model.run_with_hooks(
+            tokens, return_type="loss", fwd_hooks=[(hook_point, zero_ablate_hook)]
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "hook_point, hook_point_layer, d_in, head_index",
+    [
+        ("blocks.0.hook_resid_pre", 0, 32, None),
+        ("blocks.2.hook_resid_pre", 2, 32, None),
+        ("blocks.1.hook_mlp_out", 1, 32, None),
+        ("blocks.1.attn.hook_z", 1, 32, None),
+        ("blocks.1.attn.hook_z", 1, 8, 2),
+    ],
+)
+@torch.no_grad()
+def test_get_recons_metrics_matches_separate_forward_passes(
+    model: HookedTransformer,
+    hook_point: str,
+    hook_point_layer: int,
+    d_in: int,
+    head_index: int | None,
+):
+    sae = SparseAutoencoder(
+        build_sae_cfg(
+            hook_point=hook_point,
+            hook_point_layer=hook_point_layer,
+            d_in=d_in,
+            hook_point_head_index=head_index,
+        )
+    )
+    sae.eval()
+    tokens = torch.randint(0, 100, (4, 16))
+
+    recons_metrics = get_recons_metrics(sae, model, tokens)
+
+    loss, recons_loss, zero_abl_loss = _losses_with_separate_forward_passes(
+        sae, model, tokens
+    )
+    assert torch.allclose(recons_metrics.loss, loss, atol=1e-5)
+    assert torch.allclose(recons_metrics.recons_loss, recons_loss, atol=1e-5)
+    assert torch.allclose(recons_metrics.zero_abl_loss, zero_abl_loss, atol=1e-5)
+    assert recons_metrics.l2_norm_in.shape == (4, 16)
+    assert recons_metrics.l2_norm_out.shape == (4, 16)
+    assert recons_metrics.kl_div is not None
+    assert recons_metrics.loss_delta is not None
+    assert recons_metrics.kl_div.shape == (4, 16)
+    assert (recons_metrics.kl_div > -1e-5).all()
+    assert torch.allclose(
+        recons_metrics.loss_delta.mean(), recons_loss - loss, atol=1e-5
+    )
+
+
+@pytest.mark.parametrize("max_copies_per_pass", [None, 2])
+@torch.no_grad()
+def test_get_group_recons_metrics_matches_each_sae_on_its_own(
+    model: HookedTransformer, max_copies_per_pass: int | None
+):
+    saes = [
+        SparseAutoencoder(
+            build_sae_cfg(
+                hook_point=hook_point,
+                hook_point_layer=hook_point_layer,
+                d_in=d_in,
+                hook_point_head_index=head_index,
+            )
+        )
+        for hook_point, hook_point_layer, d_in, head_index in [
+            ("blocks.2.hook_resid_pre", 2, 32, None),
+            ("blocks.1.hook_mlp_out", 1, 32, None),
+            ("blocks.1.hook_mlp_out", 1, 32, None),
+            ("blocks.1.attn.hook_z", 1, 8, 2),
+        ]
+    ]
+    for sae in saes:
+        sae.eval()
+    tokens = torch.randint(0, 100, (4, 16))
+
+    group_recons_metrics = get_group_recons_metrics(
+        saes, model, tokens, max_copies_per_pass=max_copies_per_pass
+    )
+
+    assert len(group_recons_metrics) == len(saes)
+    for sae, recons_metrics in zip(saes, group_recons_metrics):
+        expected = get_recons_metrics(sae, model, tokens)
+        for actual_metric, expected_metric in zip(recons_metrics, expected):
+            assert actual_metric is not None and expected_metric is not None
+            assert torch.allclose(actual_metric, expected_metric, atol=1e-5)
+
+
+class _RandomTokensStore:
+    def __init__(self):
+        self.n_batches_taken = 0
+
+    def get_batch_tokens(self) -> torch.Tensor:
+        self.n_batches_taken += 1
+        return torch.randint(0, 100, (4, 16))
+
+
+def test_EvalTokens_are_sampled_once_and_persisted(tmp_path: Path):
+    store = _RandomTokensStore()
+    path = str(tmp_path / "eval_tokens.pt")
+
+    eval_tokens = EvalTokens.from_activation_store(cast(Any, store), 3, path=path)
+    assert eval_tokens.batches.shape == (3, 4, 16)
+    assert store.n_batches_taken == 3
+
+    reloaded = EvalTokens.from_activation_store(cast(Any, store), 3, path=path)
+    assert store.n_batches_taken == 3
+    assert torch.equal(reloaded.batches, eval_tokens.batches)
+
+
+@torch.no_grad()
+def test_recons_loss_batched_on_eval_tokens_reuses_their_clean_residuals(
+    model: HookedTransformer,
+):
+    sae = SparseAutoencoder(
+        build_sae_cfg(hook_point="blocks.1.hook_resid_pre", hook_point_layer=1, d_in=32)
+    )
+    sae.eval()
+    store = _RandomTokensStore()
+    eval_tokens = EvalTokens.from_activation_store(cast(Any, store), 2)
+
+    losses_df = recons_loss_batched(
+        sae, model, cast(Any, store), eval_tokens=eval_tokens
+    )
+    assert store.n_batches_taken == 2
+    clean_residuals = eval_tokens.clean_residuals(model)
+    assert eval_tokens.clean_residuals(model) is clean_residuals
+    assert all(residual.device.type == "cpu" for residual in clean_residuals)
+
+    for i, batch_tokens in enumerate(eval_tokens.batches):
+        recons_metrics = get_recons_metrics(sae, model, batch_tokens)
+        assert losses_df["loss"][i] == pytest.approx(recons_metrics.loss.item())
+        assert losses_df["recons_loss"][i] == pytest.approx(
+            recons_metrics.recons_loss.item(), abs=1e-5
+        )
+        assert losses_df["zero_abl_loss"][i] == pytest.approx(
+            recons_metrics.zero_abl_loss.item(), abs=1e-5
+        )
+        assert losses_df["l2_ratio"][i] == pytest.approx(
+            (recons_metrics.l2_norm_out / recons_metrics.l2_norm_in).mean().item()
+        )
@@ -0,0 +1,131 @@
+import copy
+
+import pytest
+import torch
+
+from sae_lens.training.fused_sae_group import FusedSAEGroup
+from sae_lens.training.sae_group import SAEGroup
+from sae_lens.training.train_sae_on_language_model import (
+    _build_fused_train_contexts,
+    _build_train_context,
+    _fused_train_step,
+    _train_step,
+)
+from tests.unit.helpers import build_sae_cfg
+
+
+@pytest.fixture
+def sae_group() -> SAEGroup:
+    torch.manual_seed(0)
+    cfg = build_sae_cfg(
+        hook_point="blocks.{layer}.hook_mlp_out",
+        hook_point_layer=[0, 1],
+        l1_coefficient=[1e-3, 1e-2],
+        lp_norm=[1, 2],
+        lr=[1e-3, 3e-3],
+        use_ghost_grads=True,
+        dead_feature_window=1,
+        d_in=16,
+        expansion_factor=2,
+    )
+    cfg.d_sae = 32
+    return SAEGroup(cfg)
+
+
+@pytest.mark.parametrize("sync_free_training", [False, True])
+def test_FusedSAEGroup_forward_matches_its_members(
+    sae_group: SAEGroup, sync_free_training: bool
+):
+    saes = sae_group.autoencoders
+    for sae in saes:
+        torch.nn.init.normal_(sae.b_dec)
+        sae.cfg.sync_free_training = sync_free_training
+    fused = FusedSAEGroup(saes)
+    x = torch.randn(len(saes), 10, 16)
+    dead_neuron_mask = torch.rand(len(saes), 32) > 0.5
+    dead_neuron_mask[0] = False  # no dead neurons, so no ghost grad loss
+
+    output = fused(x, dead_neuron_mask)
+
+    for i, sae in enumerate(saes):
+        expected = sae(x[i], dead_neuron_mask[i])
+        assert torch.allclose(output.sae_out[i], expected.sae_out, atol=1e-5)
+        assert torch.allclose(output.feature_acts[i], expected.feature_acts, atol=1e-5)
+        assert torch.allclose(output.mse_loss[i], expected.mse_loss, atol=1e-6)
+        assert torch.allclose(output.l1_loss[i], expected.l1_loss, atol=1e-6)
+        assert torch.allclose(
+            output.ghost_grad_loss[i], expected.ghost_grad_loss, atol=1e-6
+        )
+        assert torch.allclose(output.loss[i], expected.loss, atol=1e-6)
+    assert output.ghost_grad_loss[0] == 0
+
+
+def test_FusedSAEGroup_members_share_its_weights(sae_group: SAEGroup):
+    saes = sae_group.autoencoders
+    expected_W_dec = saes[1].W_dec.detach().clone()
+    fused = FusedSAEGroup(saes)
+    assert torch.equal(fused.W_dec[1], expected_W_dec)
+
+    with torch.no_grad():
+        fused.W_enc.add_(1.0)
+    assert torch.equal(saes[0].W_enc, fused.W_enc[0])
+    assert torch.equal(saes[1].W_enc, fused.W_enc[1])
+
+
+def test_fused_train_step_matches_training_each_sae(sae_group: SAEGroup):
+    all_layers = [0, 1]
+    reference_group = copy.deepcopy(sae_group)
+    reference_contexts = [
+        _build_train_context(sae, total_training_steps=100) for sae in reference_group
+    ]
+    train_contexts = [
+        _build_train_context(sae, total_training_steps=100, fused=True)
+        for sae in sae_group
+    ]
+    (fused_ctx,) = _build_fused_train_contexts(sae_group, train_contexts, all_layers)
+
+    for step in range(6):
+        layer_acts = torch.randn(8, len(all_layers), 16)
+        fused_outputs = _fused_train_step(
+            fused_ctx=fused_ctx,
+            layer_acts=layer_acts,
+            member_contexts=train_contexts,
+            feature_sampling_window=4,
+            use_wandb=False,
+            n_training_steps=step,
+            batch_size=8,
+            wandb_suffixes=[""] * len(train_contexts),
+        )
+        for sae, ctx, fused_output in zip(
+            reference_group, reference_contexts, fused_outputs
+        ):
+            output = _train_step(
+                sparse_autoencoder=sae,
+                layer_acts=layer_acts,
+                ctx=ctx,
+                feature_sampling_window=4,
+                use_wandb=False,
+                n_training_steps=step,
+                all_layers=all_layers,
+                batch_size=8,
+                wandb_suffix="",
+            )
+            assert torch.allclose(fused_output.loss, output.loss, atol=1e-5)
+            assert torch.equal(
+                fused_output.ghost_grad_neuron_mask, output.ghost_grad_neuron_mask
+            )
+
+    for sae, reference_sae in zip(sae_group, reference_group):
+        for param, reference_param in zip(sae.parameters(), reference_sae.parameters()):
+            assert torch.allclose(param, reference_param, atol=1e-5)
+    for ctx, reference_ctx in zip(train_contexts, reference_contexts):
+        assert torch.equal(ctx.act_freq_scores, reference_ctx.act_freq_scores)
+        assert torch.equal(
+            ctx.n_forward_passes_since_fired,
+            reference_ctx.n_forward_passes_since_fired,
+        )
+        assert ctx.n_frac_active_tokens == reference_ctx.n_frac_active_tokens
+        assert (
+            ctx.optimizer.param_groups[0]["lr"]
+            == reference_ctx.optimizer.param_groups[0]["lr"]
+        )
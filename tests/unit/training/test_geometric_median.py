@@ -0,0 +1,66 @@
+import torch
+
+from sae_lens.training.geometric_median import (
+    compute_approximate_geometric_median,
+    compute_geometric_median,
+)
+
+
+def test_compute_approximate_geometric_median_matches_compute_geometric_median():
+    torch.manual_seed(0)
+    points = torch.randn(1000, 16) * 10 + torch.randn(16) * 5
+    weights = torch.rand(1000)
+
+    expected = compute_geometric_median(points, weights=weights).median
+    # all the points, a few at a time
+    median = compute_approximate_geometric_median(
+        points, weights=weights, max_points=None, chunk_size=64
+    ).median
+    assert torch.allclose(median, expected, atol=1e-4)
+
+
+def test_compute_approximate_geometric_median_of_strided_lower_precision_points():
+    torch.manual_seed(0)
+    # like a layer's slice of the activation buffer
+    buffer = (torch.randn(1000, 2, 16) * 10).to(torch.bfloat16)
+    points = buffer[:, 1, :]
+
+    expected = compute_geometric_median(points.float()).median
+    median = compute_approximate_geometric_median(points, max_points=None).median
+    assert median.dtype == torch.float32
+    assert torch.allclose(median, expected, atol=1e-3)
+
+
+def test_compute_approximate_geometric_median_subsamples_points():
+    torch.manual_seed(0)
+    points = torch.randn(20_000, 8) + 3.0
+
+    result = compute_approximate_geometric_median(points, max_points=2000)
+    assert torch.allclose(result.median, torch.full((8,), 3.0), atol=0.15)
+
+
+def test_compute_approximate_geometric_median_warm_starts_from_init_median():
+    torch.manual_seed(0)
+    points = torch.randn(1000, 16) * 10
+
+    cold_start = compute_approximate_geometric_median(
+        points, max_points=None, do_log=True
+    )
+    warm_start = compute_approximate_geometric_median(
+        points, max_points=None, init_median=cold_start.median, do_log=True
+    )
+    # starting from the answer, there's nothing left to do
+    assert len(warm_start.logs) < len(cold_start.logs)
+    assert warm_start.termination == "function value converged within tolerance"
+    assert torch.allclose(warm_start.median, cold_start.median, atol=1e-4)
+
+
+def test_compute_approximate_geometric_median_of_several_sets_of_points():
+    torch.manual_seed(0)
+    points = torch.randn(1000, 3, 16) * torch.tensor([1.0, 10.0, 100.0])[:, None]
+
+    medians = compute_approximate_geometric_median(points, max_points=None).median
+    assert medians.shape == (3, 16)
+    for i in range(3):
+        expected = compute_geometric_median(points[:, i, :]).median
+        assert torch.allclose(medians[i], expected, rtol=1e-4, atol=1e-4 * 10**i)
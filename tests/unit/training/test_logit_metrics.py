@@ -0,0 +1,85 @@
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from sae_lens.training.evals import final_residual
+from sae_lens.training.logit_metrics import (
+    LossDeltaHistogram,
+    kl_divergence,
+    token_losses,
+    unembed_logsumexp,
+)
+
+
+def _model() -> HookedTransformer:
+    cfg = HookedTransformerConfig(
+        n_layers=2,
+        d_model=16,
+        d_head=4,
+        n_heads=4,
+        d_mlp=32,
+        d_vocab=100,
+        n_ctx=8,
+        act_fn="gelu",
+        device="cpu",
+        seed=0,
+    )
+    return HookedTransformer(cfg)
+
+
+@torch.no_grad()
+def test_token_losses_from_vocab_chunks_match_the_models_loss():
+    model = _model()
+    tokens = torch.randint(0, 100, (3, 8))
+
+    residual = final_residual(model, tokens)
+    # a chunk size that doesn't divide the vocab
+    lse = unembed_logsumexp(model, residual, vocab_chunk_size=7)
+
+    assert torch.allclose(lse, model(tokens).logsumexp(dim=-1), atol=1e-5)
+    assert torch.allclose(
+        token_losses(model, residual, tokens, lse),
+        model(tokens, return_type="loss", loss_per_token=True),
+        atol=1e-5,
+    )
+
+
+@torch.no_grad()
+def test_kl_divergence_from_vocab_chunks_matches_the_full_logits():
+    model = _model()
+    tokens = torch.randint(0, 100, (3, 8))
+    clean_residual = final_residual(model, tokens)
+    residuals = clean_residual + torch.randn(2, *clean_residual.shape)
+
+    kl_div = kl_divergence(
+        model,
+        clean_residual,
+        unembed_logsumexp(model, clean_residual),
+        residuals,
+        torch.stack([unembed_logsumexp(model, residual) for residual in residuals]),
+        vocab_chunk_size=7,
+    )
+
+    clean_log_probs = model.unembed(clean_residual).log_softmax(dim=-1)
+    for residual, residual_kl_div in zip(residuals, kl_div):
+        log_probs = model.unembed(residual).log_softmax(dim=-1)
+        expected = (clean_log_probs.exp() * (clean_log_probs - log_probs)).sum(-1)
+        assert torch.allclose(residual_kl_div, expected, atol=1e-5)
+    assert torch.allclose(
+        kl_divergence(
+            model,
+            clean_residual,
+            unembed_logsumexp(model, clean_residual),
+            clean_residual[None],
+            unembed_logsumexp(model, clean_residual)[None],
+        ),
+        torch.zeros(3, 8),
+        atol=1e-5,
+    )
+
+
+def test_LossDeltaHistogram_counts_out_of_range_deltas_in_the_end_bins():
+    histogram = LossDeltaHistogram(min=-1.0, max=1.0, n_bins=4)
+    histogram.update(torch.tensor([-5.0, -0.75, 0.25, 0.3]))
+    histogram.update(torch.tensor([[0.9, 5.0]]))
+
+    assert histogram.counts.tolist() == [2, 0, 2, 2]
@@ -9,7 +9,7 @@ from torch.optim.lr_scheduler import (
     LRScheduler,
 )
 
-from sae_lens.training.optim import get_scheduler
+from sae_lens.training.optim import LearningRateHolder, StackedAdam, get_scheduler
 
 LR = 0.1
 
@@ -197,3 +197,54 @@ def test_get_scheduler_cosineannealingwarmrestarts(optimizer: Adam):
     assert isinstance(main_scheduler, CosineAnnealingWarmRestarts)
     assert main_scheduler.T_0 == 4
     assert main_scheduler.eta_min == 0.05
+
+
+def test_StackedAdam_matches_Adam_on_each_member():
+    lrs = [0.1, 0.01, 0.001]
+    members = [torch.randn(3, 4) for _ in lrs]
+    stacked_param = torch.nn.Parameter(torch.stack(members))
+    lr_holders = [LearningRateHolder(lr) for lr in lrs]
+    stacked_optimizer = StackedAdam([stacked_param], lr_holders=lr_holders)
+
+    params = [torch.nn.Parameter(member.clone()) for member in members]
+    optimizers = [Adam([param], lr=lr) for param, lr in zip(params, lrs)]
+
+    for _ in range(5):
+        grad = torch.randn(len(lrs), 3, 4)
+        stacked_param.grad = grad
+        stacked_optimizer.step()
+        for i, (param, optimizer) in enumerate(zip(params, optimizers)):
+            param.grad = grad[i].clone()
+            optimizer.step()
+
+    for i, param in enumerate(params):
+        assert torch.allclose(stacked_param[i], param, atol=1e-6)
+
+
+def test_StackedAdam_follows_each_members_scheduler():
+    stacked_param = torch.nn.Parameter(torch.zeros(2, 1))
+    lr_holders = [LearningRateHolder(LR), LearningRateHolder(LR)]
+    stacked_optimizer = StackedAdam([stacked_param], lr_holders=lr_holders)
+    schedulers = [
+        get_scheduler(
+            "constant",
+            lr_holder,
+            lr=LR,
+            training_steps=10,
+            warm_up_steps=warm_up_steps,
+            decay_steps=0,
+            lr_end=0.0,
+            num_cycles=1,
+        )
+        for lr_holder, warm_up_steps in zip(lr_holders, [0, 4])
+    ]
+
+    stacked_param.grad = torch.ones(2, 1)
+    stacked_optimizer.step()
+    for scheduler in schedulers:
+        scheduler.step()
+
+    # Adam's first step moves each parameter by its lr
+    assert stacked_param[0].item() == pytest.approx(-LR)
+    assert stacked_param[1].item() == pytest.approx(-LR / 4)
+    assert lr_holders[1].param_groups[0]["lr"] == pytest.approx(2 * LR / 4)
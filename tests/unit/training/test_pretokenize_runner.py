@@ -0,0 +1,99 @@
+from pathlib import Path
+
+import pytest
+from datasets import Dataset
+from transformer_lens import HookedTransformer
+from transformers import AutoTokenizer
+
+from sae_lens.training.activations_store import ActivationsStore
+from sae_lens.training.config import PretokenizeRunnerConfig
+from sae_lens.training.pretokenize_runner import pretokenize_runner
+from tests.unit.helpers import build_sae_cfg
+
+TEXTS = [f"hello world {i}, and some more text" * (i % 3 + 1) for i in range(60)]
+
+
+@pytest.mark.parametrize("num_proc", [1, 2])
+def test_pretokenize_runner_packs_documents_into_rows_starting_with_bos(
+    ts_model: HookedTransformer, tmp_path: Path, num_proc: int
+):
+    assert ts_model.tokenizer is not None
+    bos = ts_model.tokenizer.bos_token_id
+    cfg = PretokenizeRunnerConfig(
+        tokenizer_name=ts_model.tokenizer.name_or_path,
+        context_size=10,
+        num_proc=num_proc,
+        batch_size=30,
+        save_path=str(tmp_path / "tokenized"),
+    )
+    dataset = pretokenize_runner(
+        cfg, dataset=Dataset.from_list([{"text": text} for text in TEXTS])
+    )
+
+    assert dataset.column_names == ["tokens"]
+    rows = dataset["tokens"]
+    assert all(len(row) == 10 and row[0] == bos for row in rows)
+
+    # apart from BOS tokens, the rows hold each batch of documents in order,
+    # minus the tail of each batch that didn't fill a row
+    packed = [token for row in rows for token in row if token != bos]
+    for texts in [TEXTS[:30], TEXTS[30:]]:
+        batch = [token for text in texts for token in ts_model.tokenizer.encode(text)]
+        n_packed = 0
+        while n_packed < len(packed) and n_packed < len(batch):
+            if packed[n_packed] != batch[n_packed]:
+                break
+            n_packed += 1
+        assert len(batch) - 10 < n_packed <= len(batch)
+        packed = packed[n_packed:]
+    assert packed == []
+
+
+def test_pretokenize_runner_needs_a_bos_token_to_prepend_one(
+    ts_model: HookedTransformer, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    assert ts_model.tokenizer is not None
+    tokenizer = AutoTokenizer.from_pretrained(ts_model.tokenizer.name_or_path)
+    tokenizer.bos_token = None
+    monkeypatch.setattr(
+        "sae_lens.training.pretokenize_runner.AutoTokenizer.from_pretrained",
+        lambda _: tokenizer,
+    )
+    cfg = PretokenizeRunnerConfig(
+        tokenizer_name=ts_model.tokenizer.name_or_path,
+        context_size=10,
+        num_proc=1,
+        save_path=str(tmp_path / "tokenized"),
+    )
+    dataset = Dataset.from_list([{"text": text} for text in TEXTS])
+
+    with pytest.raises(ValueError, match="has no BOS token"):
+        pretokenize_runner(cfg, dataset=dataset)
+
+    cfg.prepend_bos = False
+    rows = pretokenize_runner(cfg, dataset=dataset)["tokens"]
+    assert all(len(row) == 10 for row in rows)
+
+
+def test_activations_store_reads_pretokenized_datasets_from_disk(
+    ts_model: HookedTransformer, tmp_path: Path
+):
+    assert ts_model.tokenizer is not None
+    save_path = str(tmp_path / "tokenized")
+    pretokenize_cfg = PretokenizeRunnerConfig(
+        tokenizer_name=ts_model.tokenizer.name_or_path,
+        context_size=6,
+        num_proc=1,
+        save_path=save_path,
+    )
+    dataset = pretokenize_runner(
+        pretokenize_cfg, dataset=Dataset.from_list([{"text": t} for t in TEXTS])
+    )
+
+    cfg = build_sae_cfg(dataset_path=save_path, context_size=6, store_batch_size=4)
+    activation_store = ActivationsStore.from_config(
+        ts_model, cfg, create_dataloader=False
+    )
+    assert activation_store.is_dataset_tokenized
+    # the rows already start with BOS, so they're used as they are
+    assert activation_store.get_batch_tokens().tolist() == dataset["tokens"][:4]
@@ -1,4 +1,5 @@
 import os
+import pickle
 from pathlib import Path
 from typing import Any
 
@@ -10,7 +11,13 @@ from transformer_lens import HookedTransformer
 from sae_lens.training.config import LanguageModelSAERunnerConfig
 from sae_lens.training.sparse_autoencoder import (
     SparseAutoencoder,
+    _GhostDecode,
     _per_item_mse_loss_with_target_norm,
+    _sparse_decode,
+)
+from sae_lens.training.train_sae_on_language_model import (
+    _build_train_context,
+    _train_step,
 )
 from tests.unit.helpers import build_sae_cfg
 
@@ -191,6 +198,274 @@ def test_SparseAutoencoder_forward_ghost_grad_loss_only_adds_gradients_to_dead_n
     assert sae.W_dec.grad[3, :].abs().sum() > 0.001
 
 
+def test_SparseAutoencoder_sync_free_ghost_grad_loss_matches_default():
+    cfg = build_sae_cfg(d_in=2, d_sae=4, use_ghost_grads=True)
+    sae = SparseAutoencoder(cfg)
+    sync_free_sae = SparseAutoencoder(
+        build_sae_cfg(d_in=2, d_sae=4, use_ghost_grads=True, sync_free_training=True)
+    )
+    sync_free_sae.load_state_dict(sae.state_dict())
+    x = torch.randn(3, 2)
+
+    for dead_neuron_mask in [
+        torch.tensor([False, True, False, True]),
+        torch.tensor([False, False, False, False]),
+    ]:
+        sae.zero_grad()
+        sync_free_sae.zero_grad()
+        forward_out = sae.forward(x=x, dead_neuron_mask=dead_neuron_mask)
+        sync_free_forward_out = sync_free_sae.forward(
+            x=x, dead_neuron_mask=dead_neuron_mask
+        )
+        assert torch.allclose(
+            sync_free_forward_out.ghost_grad_loss, forward_out.ghost_grad_loss
+        )
+        forward_out.loss.backward()
+        sync_free_forward_out.loss.backward()
+        for param, sync_free_param in zip(sae.parameters(), sync_free_sae.parameters()):
+            assert param.grad is not None and sync_free_param.grad is not None
+            assert torch.allclose(sync_free_param.grad, param.grad, atol=1e-6)
+
+
+def test_SparseAutoencoder_chunked_ghost_grads_match_selecting_dead_neurons(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    # several chunks, the last one partial
+    monkeypatch.setattr("sae_lens.training.sparse_autoencoder.GHOST_GRAD_CHUNK_SIZE", 3)
+    sae = SparseAutoencoder(build_sae_cfg(d_in=4, d_sae=16, use_ghost_grads=True))
+    hidden_pre = torch.randn(5, 16, requires_grad=True)
+    dead_neuron_mask = torch.rand(16) < 0.5
+
+    dead_neuron_indices = sae.get_dead_neuron_indices(dead_neuron_mask)
+    ghost_out = _GhostDecode.apply(
+        hidden_pre,
+        sae.W_dec,
+        dead_neuron_indices,
+        torch.ones(dead_neuron_indices.shape[0]),
+    )
+    assert isinstance(ghost_out, torch.Tensor)
+    # the original implementation
+    selected_ghost_out = (
+        torch.exp(hidden_pre[:, dead_neuron_mask]) @ sae.W_dec[dead_neuron_mask, :]
+    )
+    assert torch.allclose(ghost_out, selected_ghost_out, atol=1e-6)
+
+    grad_ghost_out = torch.randn_like(ghost_out)
+    hidden_pre_grad, W_dec_grad = torch.autograd.grad(
+        ghost_out, [hidden_pre, sae.W_dec], grad_ghost_out
+    )
+    selected_hidden_pre_grad, selected_W_dec_grad = torch.autograd.grad(
+        selected_ghost_out, [hidden_pre, sae.W_dec], grad_ghost_out
+    )
+    assert torch.allclose(hidden_pre_grad, selected_hidden_pre_grad, atol=1e-5)
+    assert torch.allclose(W_dec_grad, selected_W_dec_grad, atol=1e-5)
+
+
+def test_SparseAutoencoder_get_dead_neuron_indices_are_cached_per_version():
+    sae = SparseAutoencoder(build_sae_cfg(d_in=2, d_sae=4, use_ghost_grads=True))
+    dead_neuron_mask = torch.tensor([False, True, False, True])
+
+    indices = sae.get_dead_neuron_indices(dead_neuron_mask, version=0)
+    assert indices.tolist() == [1, 3]
+    # the same version reuses the cached indices, even if the mask has changed. Training
+    # only keeps the version when no neuron has died since
+    assert sae.get_dead_neuron_indices(dead_neuron_mask.flip(0), version=0) is indices
+
+    # a new version, or no version at all, looks them up again
+    dead_neuron_mask[0] = True
+    assert sae.get_dead_neuron_indices(dead_neuron_mask, version=1).tolist() == [
+        0,
+        1,
+        3,
+    ]
+    assert sae.get_dead_neuron_indices(dead_neuron_mask[:2]).tolist() == [0, 1]
+
+
+def test_train_step_looks_up_dead_neurons_again_as_soon_as_one_dies():
+    cfg = build_sae_cfg(
+        d_in=2, d_sae=4, use_ghost_grads=True, dead_feature_window=2, seed=0
+    )
+    sae = SparseAutoencoder(cfg)
+    ctx = _build_train_context(sae, total_training_steps=10)
+    # the SAE never fires, so the counts only go up by one a step, unless reset here
+    sae.b_enc.data.fill_(-100.0)
+
+    def train_step(n_forward_passes_since_fired: list[float], n_training_steps: int):
+        ctx.n_forward_passes_since_fired.copy_(
+            torch.tensor(n_forward_passes_since_fired)
+        )
+        return _train_step(
+            sparse_autoencoder=sae,
+            layer_acts=torch.randn(3, 1, 2),
+            ctx=ctx,
+            feature_sampling_window=1000,
+            use_wandb=False,
+            n_training_steps=n_training_steps,
+            all_layers=[sae.hook_point_layer],
+            batch_size=3,
+            wandb_suffix="",
+        )
+
+    assert train_step([0, 0, 0, 0], 0).ghost_grad_loss == 0.0
+    # neuron 1 dies in the middle of a window, and gets ghost grads straight away
+    assert train_step([0, 3, 0, 0], 1).ghost_grad_loss > 0.0
+    assert sae._dead_neuron_indices is not None
+    assert sae._dead_neuron_indices.tolist() == [1]
+    assert train_step([0, 4, 0, 3], 2).ghost_grad_loss > 0.0
+    assert sae._dead_neuron_indices.tolist() == [1, 3]
+    # neuron 1 coming back to life doesn't need the indices looking up again
+    version = ctx.dead_neuron_mask_version
+    assert train_step([0, 0, 0, 4], 3).ghost_grad_loss > 0.0
+    assert ctx.dead_neuron_mask_version == version
+    assert sae._dead_neuron_indices.tolist() == [1, 3]
+    # and with every cached neuron alive again there's no ghost grad loss
+    assert train_step([0, 0, 0, 0], 4).ghost_grad_loss == 0.0
+
+
+def test_SparseAutoencoder_ghost_grads_ignore_revived_neurons_in_cached_indices():
+    sae = SparseAutoencoder(build_sae_cfg(d_in=2, d_sae=4, use_ghost_grads=True))
+    x = torch.randn(3, 2)
+    # neuron 3 has come back to life since the indices were cached
+    sae.get_dead_neuron_indices(torch.tensor([False, True, False, True]), version=0)
+    dead_neuron_mask = torch.tensor([False, True, False, False])
+
+    cached_out = sae(x, dead_neuron_mask, dead_neuron_mask_version=0)
+    expected_out = sae(x, dead_neuron_mask)
+
+    assert torch.allclose(cached_out.ghost_grad_loss, expected_out.ghost_grad_loss)
+
+
+def test_SparseAutoencoder_doesnt_pickle_its_dead_neuron_indices():
+    sae = SparseAutoencoder(build_sae_cfg(d_in=2, d_sae=4, use_ghost_grads=True))
+    sae.get_dead_neuron_indices(torch.tensor([False, True, False, True]), version=0)
+
+    unpickled_sae = pickle.loads(pickle.dumps(sae))
+
+    assert unpickled_sae._dead_neuron_indices is None
+    assert unpickled_sae._dead_neuron_indices_version is None
+    assert sae._dead_neuron_indices is not None
+
+
+@pytest.mark.parametrize("density", [0.01, 0.5])
+def test_sparse_decode_matches_dense_decode(density: float):
+    W_dec = torch.randn(64, 8, requires_grad=True)
+    feature_acts = torch.rand(4, 3, 64) * (torch.rand(4, 3, 64) < density)
+    feature_acts[0, 0] = 0.0  # an item with no active features
+    feature_acts.requires_grad_(True)
+
+    decoded = _sparse_decode(feature_acts, W_dec)
+    dense_decoded = feature_acts @ W_dec
+    assert torch.allclose(decoded, dense_decoded, atol=1e-6)
+
+    W_dec_grad, feature_acts_grad = torch.autograd.grad(
+        decoded.sum(), [W_dec, feature_acts]
+    )
+    dense_W_dec_grad, dense_feature_acts_grad = torch.autograd.grad(
+        dense_decoded.sum(), [W_dec, feature_acts]
+    )
+    assert torch.allclose(W_dec_grad, dense_W_dec_grad, atol=1e-6)
+    # sparse decode has no gradient for inactive features, which relu would zero anyway
+    active = feature_acts > 0
+    assert torch.allclose(
+        feature_acts_grad[active], dense_feature_acts_grad[active], atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("active_per_item, uses_sparse_path", [(1, True), (3, False)])
+def test_sparse_decode_matches_dense_decode_on_both_sides_of_the_density_threshold(
+    monkeypatch: pytest.MonkeyPatch, active_per_item: int, uses_sparse_path: bool
+):
+    # the threshold is 0.03 * 64 = 1.92 active features per item
+    monkeypatch.setattr(
+        "sae_lens.training.sparse_autoencoder.SPARSE_DECODE_MAX_DENSITY", 0.03
+    )
+    n_embedding_bag_calls = 0
+    embedding_bag = torch.nn.functional.embedding_bag
+
+    def counting_embedding_bag(*args: Any, **kwargs: Any) -> torch.Tensor:
+        nonlocal n_embedding_bag_calls
+        n_embedding_bag_calls += 1
+        return embedding_bag(*args, **kwargs)
+
+    monkeypatch.setattr(torch.nn.functional, "embedding_bag", counting_embedding_bag)
+    W_dec = torch.randn(64, 8)
+    active = torch.rand(300, 64).argsort(dim=-1)[:, :active_per_item]
+    feature_acts = torch.zeros(300, 64).scatter_(
+        1, active, torch.rand(300, active_per_item)
+    )
+
+    decoded = _sparse_decode(feature_acts, W_dec)
+
+    assert n_embedding_bag_calls == int(uses_sparse_path)
+    assert torch.allclose(decoded, feature_acts @ W_dec, atol=1e-6)
+
+
+def test_sparse_decode_cant_be_combined_with_sync_free_training():
+    with pytest.raises(ValueError, match="sync_free_training"):
+        LanguageModelSAERunnerConfig(sparse_decode=True, sync_free_training=True)
+
+
+def test_SparseAutoencoder_forward_with_sparse_decode_matches_dense(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    # always take the sparse path, however many features are active
+    monkeypatch.setattr(
+        "sae_lens.training.sparse_autoencoder.SPARSE_DECODE_MAX_DENSITY", 1.0
+    )
+    sae = SparseAutoencoder(build_sae_cfg(d_in=8, d_sae=32))
+    sparse_sae = SparseAutoencoder(build_sae_cfg(d_in=8, d_sae=32, sparse_decode=True))
+    sparse_sae.load_state_dict(sae.state_dict())
+    x = torch.randn(10, 8)
+
+    forward_out = sae(x)
+    sparse_forward_out = sparse_sae(x)
+    assert torch.allclose(sparse_forward_out.sae_out, forward_out.sae_out, atol=1e-5)
+    assert torch.allclose(sparse_forward_out.loss, forward_out.loss, atol=1e-6)
+
+    forward_out.loss.backward()
+    sparse_forward_out.loss.backward()
+    for param, sparse_param in zip(sae.parameters(), sparse_sae.parameters()):
+        assert param.grad is not None and sparse_param.grad is not None
+        assert torch.allclose(sparse_param.grad, param.grad, atol=1e-6)
+
+
+@pytest.mark.parametrize("sparse_decode", [False, True])
+def test_SparseAutoencoder_encode_decode_and_reconstruct_match_forward(
+    sparse_decode: bool,
+):
+    sae = SparseAutoencoder(
+        build_sae_cfg(d_in=8, d_sae=32, sparse_decode=sparse_decode)
+    )
+    with torch.no_grad():
+        torch.nn.init.normal_(sae.b_enc)
+        torch.nn.init.normal_(sae.b_dec)
+    x = torch.randn(4, 3, 8)
+    forward_out = sae(x)
+
+    feature_acts = sae.encode(x)
+    assert torch.allclose(feature_acts, forward_out.feature_acts, atol=1e-6)
+    assert torch.allclose(sae.decode(feature_acts), forward_out.sae_out, atol=1e-5)
+    assert torch.allclose(sae.reconstruct(x), forward_out.sae_out, atol=1e-5)
+
+
+def test_SparseAutoencoder_encode_decode_and_reconstruct_write_into_out():
+    sae = SparseAutoencoder(build_sae_cfg(d_in=8, d_sae=32))
+    x = torch.randn(10, 8)
+    expected_sae_out = sae(x).sae_out
+
+    feature_acts_buffer = torch.empty(10, 32)
+    feature_acts = sae.encode(x, out=feature_acts_buffer)
+    assert feature_acts.data_ptr() == feature_acts_buffer.data_ptr()
+    sae_out_buffer = torch.empty(10, 8)
+    sae_out = sae.decode(feature_acts, out=sae_out_buffer)
+    assert sae_out.data_ptr() == sae_out_buffer.data_ptr()
+    assert torch.allclose(sae_out_buffer, expected_sae_out, atol=1e-5)
+
+    # the input can be overwritten with its reconstruction
+    sae.reconstruct(x, out=x)
+    assert torch.allclose(x, expected_sae_out, atol=1e-5)
+
+
 def test_per_item_mse_loss_with_norm_matches_original_implementation() -> None:
     input = torch.randn(3, 2)
     target = torch.randn(3, 2)